@@ -0,0 +1,292 @@
+# Alarms evaluated by LeidenLogger on every new reading, with notifications sent from a background thread.
+
+# The rules are read from a JSON, TOML or YAML file (see ConfigFile.py):
+#
+#     sinks:                                   # where notifications go (default: standard output)
+#       - {type: log, file: alarms.log}
+#       - {type: command, command: [notify-send, Leiden]}     # the message is appended as the last argument
+#       - {type: webhook, url: 'http://localhost:8000/alarm'} # the event is POSTed as JSON
+#     rules:
+#       - name: IVC pressure
+#         stream: pressure                     # temperature, pressure or level
+#         channel: IVC                         # LakeShore channel, gauge (condsr, still, dump, pot, IVC, custom) or LHe/LN2
+#         above: 1.0e-4
+#         clear: 5.0e-5                        # hysteresis: the alarm ends below this value
+#         delay: 60                            # the condition must hold for 60 s
+#       - name: Still warming up
+#         stream: temperature
+#         channel: 3
+#         rate_above: 0.01                     # per minute, fitted over the last window seconds (default 600)
+#       - name: Pressure readings stopped
+#         stream: pressure
+#         stale: 300                           # no reading (of the channel, or of any channel) for 300 s
+#       - name: Mixing chamber warm while the still is cold
+#         conditions:                          # all conditions must hold at the same time
+#           - {stream: temperature, channel: 16, above: 0.1}
+#           - {stream: temperature, channel: 3, below: 1.0}
+#
+# A condition has one of above, below, rate_above, rate_below and stale. Readings are dispatched only to the
+# conditions of their channel, and rates are updated with Equilibrium.SlidingRegression, so the cost per reading does
+# not depend on the number of rules or on the amount of history. Staleness and delays are checked by Tick().
+# Readings that are nan are ignored.
+
+import os
+import sys
+import json
+import time
+import queue
+import threading
+import subprocess
+import urllib.request
+
+import ConfigFile
+from Equilibrium import SlidingRegression
+
+
+Streams = ( 'temperature', 'pressure', 'level' )
+Kinds = ( 'above', 'below', 'rate_above', 'rate_below', 'stale' )
+
+
+class Condition( object ):
+
+    def __init__( self, spec ):
+        self.stream = spec.get( 'stream' )
+        if self.stream not in Streams:
+            raise ValueError( 'stream must be one of %s, not %s' % ( ', '.join(Streams), self.stream ) )
+
+        # LakeShore channels are stored as in LeidenLogger ('16'), other channels by name.
+        channel = spec.get( 'channel' )
+        if channel!=None and self.stream=='temperature':
+            channel = '%d' % int( channel )
+        self.channel = None if channel==None else str( channel )
+
+        kinds = [ k for k in Kinds if k in spec ]
+        if len( kinds )!=1:
+            raise ValueError( 'a condition needs exactly one of %s' % ', '.join(Kinds) )
+        self.kind = kinds[0]
+        self.threshold = float( spec[ self.kind ] )
+        self.clear = float( spec.get( 'clear', self.threshold ) )
+        if self.channel==None and self.kind!='stale':
+            raise ValueError( 'condition %s needs a channel' % self.kind )
+
+        self.regression = SlidingRegression( float( spec.get( 'window', 600 ) ) ) if self.kind.startswith('rate') else None
+
+        self.active = False
+        self.value = None
+        self.last = None
+
+
+    def Describe( self ):
+        what = '%s %s' % ( self.stream, self.channel ) if self.channel!=None else self.stream
+        if self.kind=='stale':
+            return '%s not read for %g s' % ( what, self.threshold )
+        return '%s %s %g' % ( what, self.kind.replace( '_', ' ' ), self.threshold )
+
+
+    # Update the state with a new reading.
+    def Add( self, t, value ):
+        self.last = t
+        if self.kind=='stale':
+            self.active = False
+            return
+
+        if self.regression:
+            self.regression.Add( t, value )
+            fit = self.regression.Slope()
+            if fit==None:
+                return
+            value = fit[0]*60
+
+        self.value = value
+        if self.kind.endswith('above'):
+            self.active = value > ( self.clear if self.active else self.threshold )
+        else:
+            self.active = value < ( self.clear if self.active else self.threshold )
+
+
+    def Tick( self, now ):
+        if self.kind=='stale' and self.last!=None:
+            self.active = now-self.last > self.threshold
+
+
+class Rule( object ):
+
+    def __init__( self, spec ):
+        self.name = spec.get( 'name' )
+        if not self.name:
+            raise ValueError( 'every rule needs a name' )
+        specs = spec.get( 'conditions', [ spec ] )
+        try:
+            self.conditions = [ Condition( c ) for c in specs ]
+        except ( ValueError, TypeError ) as e:
+            raise ValueError( 'rule %s: %s' % ( self.name, e ) )
+        self.delay = float( spec.get( 'delay', 0 ) )
+        self.severity = spec.get( 'severity', 'warning' )
+        self.message = spec.get( 'message' )
+
+        self.active = False
+        self.since = None
+
+
+    # Returns an event if the alarm started or ended.
+    def Evaluate( self, now ):
+        if all( c.active for c in self.conditions ):
+            if self.since==None:
+                self.since = now
+            if not self.active and now-self.since >= self.delay:
+                self.active = True
+                return self.Event( now, 'active' )
+        else:
+            self.since = None
+            if self.active:
+                self.active = False
+                return self.Event( now, 'cleared' )
+        return None
+
+
+    def Event( self, now, state ):
+        text = self.message or ' and '.join( c.Describe() for c in self.conditions )
+        values = [ c.value for c in self.conditions if c.value!=None ]
+        if values:
+            text += ' (%s)' % ', '.join( '%.4g' % v for v in values )
+        return { 'time' : now, 'name' : self.name, 'state' : state, 'severity' : self.severity,
+                 'message' : '%s %s: %s' % ( 'ALARM' if state=='active' else 'CLEARED', self.name, text ) }
+
+
+# Sinks receive the events in the notification thread.
+
+class LogSink( object ):
+
+    def __init__( self, file=None ):
+        self.file = file
+
+    def Send( self, event ):
+        line = '%s %s' % ( time.strftime( '%Y-%m-%d %H:%M:%S', time.localtime( event['time'] ) ), event['message'] )
+        if self.file:
+            with open( self.file, 'a' ) as f:
+                print( line, file=f )
+        else:
+            print( '#', line )
+
+
+# Runs the command with the message as last argument. The event is also passed in the environment variables
+# LEIDEN_ALARM_NAME, LEIDEN_ALARM_STATE, LEIDEN_ALARM_SEVERITY and LEIDEN_ALARM_MESSAGE.
+class CommandSink( object ):
+
+    def __init__( self, command, timeout=30 ):
+        self.command = command if isinstance( command, list ) else command.split()
+        self.timeout = timeout
+
+    def Send( self, event ):
+        env = dict( os.environ )
+        for key in ( 'name', 'state', 'severity', 'message' ):
+            env[ 'LEIDEN_ALARM_'+key.upper() ] = str( event[key] )
+        subprocess.run( self.command+[ event['message'] ], env=env, timeout=self.timeout )
+
+
+# POSTs the event as a JSON document.
+class WebhookSink( object ):
+
+    def __init__( self, url, timeout=10 ):
+        self.url = url
+        self.timeout = timeout
+
+    def Send( self, event ):
+        request = urllib.request.Request( self.url, data=json.dumps( event ).encode(), headers={ 'Content-Type' : 'application/json' } )
+        urllib.request.urlopen( request, timeout=self.timeout ).close()
+
+
+SinkTypes = { 'log' : LogSink, 'command' : CommandSink, 'webhook' : WebhookSink }
+
+
+class AlarmEngine( object ):
+
+    def __init__( self, rules, sinks ):
+        self.rules = rules
+        self.sinks = sinks
+
+        # Conditions of each (stream, channel). Stale conditions without channel are updated by every reading of the stream.
+        self.index = {}
+        for r in rules:
+            for c in r.conditions:
+                self.index.setdefault( ( c.stream, c.channel ), [] ).append( ( c, r ) )
+
+        self.queue = queue.Queue()
+        self.thread = threading.Thread( target=self.Notify, name='AlarmEngine', daemon=True )
+        self.thread.start()
+
+
+    # New reading of a channel of a stream at Unix time t.
+    def Add( self, stream, channel, value, t=None ):
+        if value==None or value!=value:
+            return
+        t = time.time() if t==None else t
+        for key in ( ( stream, str(channel) ), ( stream, None ) ):
+            for c, r in self.index.get( key, () ):
+                c.Add( t, value )
+                self.Evaluate( r, t )
+
+
+    # Check staleness and delays. Called periodically by the logger.
+    def Tick( self, now=None ):
+        now = time.time() if now==None else now
+        for r in self.rules:
+            for c in r.conditions:
+                if c.last==None:
+                    c.last = now
+                c.Tick( now )
+            self.Evaluate( r, now )
+
+
+    def Evaluate( self, rule, now ):
+        event = rule.Evaluate( now )
+        if event:
+            self.queue.put( event )
+
+
+    # Names of the active alarms.
+    def Active( self ):
+        return [ r.name for r in self.rules if r.active ]
+
+
+    # Notification thread: a failing sink is reported and does not stop the others.
+    def Notify( self ):
+        while True:
+            event = self.queue.get()
+            if event==None:
+                return
+            for s in self.sinks:
+                try:
+                    s.Send( event )
+                except Exception as e:
+                    print( '# AlarmEngine: failed to notify %s: %s' % ( type(s).__name__, e ), file=sys.stderr )
+
+
+    # Send the pending notifications and stop the thread.
+    def Close( self, timeout=30 ):
+        self.queue.put( None )
+        self.thread.join( timeout )
+
+
+# Create the engine from a rules file. Raises ValueError if the file is not valid.
+def Load( filename ):
+    config = ConfigFile.LoadStructured( filename )
+    if not isinstance( config, dict ) or not isinstance( config.get('rules'), list ):
+        raise ValueError( '%s: expected a list of rules under the key rules' % filename )
+
+    rules = [ Rule( r ) for r in config['rules'] ]
+    names = [ r.name for r in rules ]
+    if len( set(names) )!=len( names ):
+        raise ValueError( '%s: rule names must be unique' % filename )
+
+    sinks = []
+    for s in config.get( 'sinks', [ { 'type' : 'log' } ] ):
+        s = dict( s )
+        kind = s.pop( 'type', None )
+        if kind not in SinkTypes:
+            raise ValueError( '%s: sink type must be one of %s, not %s' % ( filename, ', '.join(SinkTypes), kind ) )
+        try:
+            sinks.append( SinkTypes[kind]( **s ) )
+        except TypeError as e:
+            raise ValueError( '%s: sink %s: %s' % ( filename, kind, e ) )
+    return AlarmEngine( rules, sinks )
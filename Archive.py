@@ -0,0 +1,153 @@
+# Compressed archival of the output files of LeidenLogger.
+
+# With --segment-size or --segment-hours, LeidenLogger continues each output file in a new segment when it has
+# grown too large or too old, and hands the closed segment to a Compressor. The Compressor compresses the segments
+# one after the other in a background thread, with zstd if the zstandard module is installed and gzip otherwise,
+# so foo_pres.txt becomes foo_pres.txt.zst (or foo_pres.txt.gz). The plain file is only removed once the
+# compressed file is complete, so an interrupted compression loses nothing.
+# Open() reads plain and compressed files alike, decompressing while the file is read, so that LogReader,
+# merge_log.py and TimeAlign.py accept compressed segments as they are.
+#
+# Files that were not rotated, e.g. those of earlier runs, can be compressed from the commandline:
+#     python Archive.py foo_temp.txt foo_pres.txt ...
+
+import io
+import os
+import sys
+import gzip
+import queue
+import getopt
+import shutil
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Extensions of the compressed files, and the one used for new files.
+Extensions = ( '.zst', '.gz' )
+Extension = '.zst' if zstandard is not None else '.gz'
+
+
+def Compressed( filename ):
+    return filename.endswith( Extensions )
+
+
+# Name under which a file currently exists: the file itself or its compressed version. None if neither exists.
+def Find( filename ):
+    for name in [ filename ]+[ filename+e for e in Extensions ]:
+        if os.path.exists( name ):
+            return name
+    return None
+
+
+# Open a plain or compressed file for reading, in mode 'rb' or 'rt'. Compressed files are decompressed
+# as they are read; they can be read sequentially and seek forward, but not backward.
+def Open( filename, mode='rb' ):
+    if filename.endswith('.gz'):
+        return gzip.open( filename, mode )
+
+    if filename.endswith('.zst'):
+        if zstandard is None:
+            raise ImportError( 'reading %s requires the zstandard module' % filename )
+        f = io.BufferedReader( zstandard.ZstdDecompressor().stream_reader( open( filename, 'rb' ), closefd=True ), 1<<16 )
+        return f if mode=='rb' else io.TextIOWrapper( f )
+
+    return open( filename, mode )
+
+
+# Compress a file to filename+Extension and remove it. Returns the name of the compressed file.
+def Compress( filename ):
+    target = filename+Extension
+    with open( filename, 'rb' ) as src, open( target+'.tmp', 'wb' ) as dst:
+        if zstandard is not None:
+            zstandard.ZstdCompressor( level=10 ).copy_stream( src, dst )
+        else:
+            with gzip.GzipFile( filename=os.path.basename( filename ), mode='wb', fileobj=dst ) as z:
+                shutil.copyfileobj( src, z, 1<<20 )
+    shutil.copystat( filename, target+'.tmp' )
+    os.replace( target+'.tmp', target )
+    os.remove( filename )
+
+    # The index of LogReader refers to the plain file, and is rebuilt for the compressed one when it is read.
+    if os.path.exists( filename+'.idx' ):
+        os.remove( filename+'.idx' )
+    return target
+
+
+# Compresses the files passed to Add() in a background thread.
+class Compressor( object ):
+
+    def __init__( self ):
+        self.files = 0
+        self.before = 0
+        self.after = 0
+
+        self.queue = queue.Queue()
+        self.thread = threading.Thread( target=self.Run, name='Compressor', daemon=True )
+        self.thread.start()
+
+
+    def Add( self, filename ):
+        self.queue.put( filename )
+
+
+    # A file that cannot be compressed is reported and left as it is.
+    def Run( self ):
+        while True:
+            filename = self.queue.get()
+            if filename==None:
+                return
+            try:
+                size = os.path.getsize( filename )
+                target = Compress( filename )
+            except OSError as e:
+                print( '# Archive: failed to compress %s: %s' % ( filename, e ), file=sys.stderr )
+                continue
+            self.files += 1
+            self.before += size
+            self.after += os.path.getsize( target )
+
+
+    def Snapshot( self ):
+        return { 'files' : self.files, 'pending' : self.queue.qsize(), 'bytes_in' : self.before, 'bytes_out' : self.after }
+
+
+    # Compress the pending files and stop the thread.
+    def Close( self, timeout=None ):
+        self.queue.put( None )
+        self.thread.join( timeout )
+
+
+def main():
+    opts, args = getopt.getopt( sys.argv[1:], "h", ["help"] )
+
+    for opt, arg in opts:
+        if opt in ("-h","--help"):
+            print("usage: "+sys.argv[0]+" file1 file2 ...\n")
+            print("Compress the given output files of LeidenLogger with %s, replacing file1 by file1%s, etc." % ( Extension[1:], Extension ))
+            print("The compressed files can be read by LogReader, merge_log.py and TimeAlign.py as they are.\n")
+            print("\t-h/--help \t\t display help message.\n")
+            sys.exit()
+
+    if not args:
+        print('# Archive: no file specified (see --help).')
+        sys.exit(1)
+
+    for filename in args:
+        if Compressed( filename ):
+            print( '# Archive: %s is already compressed.' % filename )
+            continue
+        try:
+            size = os.path.getsize( filename )
+            target = Compress( filename )
+        except OSError as e:
+            print( '# Archive: failed to compress %s: %s' % ( filename, e ) )
+            sys.exit(1)
+        print( '# Archive: %s: %d -> %d bytes' % ( target, size, os.path.getsize( target ) ) )
+
+
+if __name__ == "__main__":
+    main()
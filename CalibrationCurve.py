@@ -0,0 +1,124 @@
+# Thermometer calibration curves, used to compute temperatures from resistances without asking the controller.
+
+# A curve is a table of breakpoints (sensor units, temperature in K) as stored by the LakeShore 372 and in
+# Lake Shore .340 files. In data format 3 the units are Ohm, in data format 4 they are log10 of the resistance.
+# Between breakpoints, the temperature is interpolated linearly in the units of the table as done by the controller.
+# Resistances outside of the table give nan.
+# Conversion of many readings at once uses numpy.interp if numpy is installed, and bisection otherwise.
+
+import bisect
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Names of the data formats of the 372. Format 7 (cubic spline) is interpolated linearly here.
+DataFormats = { 3 : 'Ohms/Kelvin', 4 : 'Log Ohms/Kelvin', 7 : 'Ohms/Kelvin (cubic spline)' }
+
+
+class CalibrationCurve( object ):
+
+    # units and kelvin are the breakpoints in any order, fmt is the data format of the units.
+    def __init__( self, units, kelvin, fmt=4, name='', serial='', limit=None ):
+        self.format = int( fmt )
+        if self.format not in DataFormats:
+            raise ValueError( 'unsupported curve data format %s' % fmt )
+
+        points = sorted( zip( [ float(u) for u in units ], [ float(k) for k in kelvin ] ) )
+        if len( points )<2:
+            raise ValueError( 'a calibration curve needs at least two breakpoints' )
+        if any( points[i][0]==points[i+1][0] for i in range( len(points)-1 ) ):
+            raise ValueError( 'calibration curve has repeated breakpoints' )
+
+        self.units = [ p[0] for p in points ]
+        self.kelvin = [ p[1] for p in points ]
+        self.name = name
+        self.serial = serial
+        self.limit = limit if limit!=None else max( self.kelvin )
+
+        if numpy is not None:
+            self.units_array = numpy.array( self.units )
+            self.kelvin_array = numpy.array( self.kelvin )
+
+
+    # Units of the table for a resistance in Ohm.
+    def Units( self, ohm ):
+        if self.format==4:
+            return math.log10( ohm ) if ohm>0 else float('nan')
+        return ohm
+
+
+    # Temperature in K for a resistance in Ohm.
+    def Kelvin( self, ohm ):
+        x = self.Units( ohm )
+        if not self.units[0] <= x <= self.units[-1]:
+            return float('nan')
+
+        i = min( bisect.bisect_right( self.units, x ), len(self.units)-1 )
+        x0, x1 = self.units[i-1], self.units[i]
+        T0, T1 = self.kelvin[i-1], self.kelvin[i]
+        return T0 + (T1-T0)*(x-x0)/(x1-x0)
+
+
+    # Temperatures for a sequence of resistances. Returns a numpy array if numpy is installed, otherwise a list.
+    def KelvinArray( self, ohms ):
+        if numpy is None:
+            return [ self.Kelvin( r ) for r in ohms ]
+
+        ohms = numpy.asarray( ohms, dtype=float )
+        if self.format==4:
+            with numpy.errstate( divide='ignore', invalid='ignore' ):
+                x = numpy.where( ohms>0, numpy.log10( ohms ), numpy.nan )
+        else:
+            x = ohms
+        return numpy.interp( x, self.units_array, self.kelvin_array, left=numpy.nan, right=numpy.nan )
+
+
+# Read a Lake Shore .340 curve file.
+# The header consists of "key: value" lines (Sensor Model, Serial Number, Data Format, SetPoint Limit, ...),
+# followed by the breakpoints as lines of index, units and temperature.
+def Read340( filename ):
+    header = {}
+    units, kelvin = [], []
+
+    with open( filename ) as f:
+        for line in f:
+            words = line.split()
+            if len( words )==3 and ':' not in line:
+                try:
+                    units.append( float( words[1] ) )
+                    kelvin.append( float( words[2] ) )
+                except ValueError:
+                    pass
+            elif ':' in line:
+                key, value = line.split( ':', 1 )
+                if value.split():
+                    header[ key.strip().lower() ] = value.split()[0]
+
+    try:
+        fmt = int( header.get( 'data format', 4 ) )
+        limit = float( header['setpoint limit'] ) if 'setpoint limit' in header else None
+    except ValueError:
+        raise ValueError( '%s: invalid header of curve file' % filename )
+
+    return CalibrationCurve( units, kelvin, fmt, name=header.get( 'sensor model', '' ), serial=header.get( 'serial number', '' ), limit=limit )
+
+
+# Write a curve as a Lake Shore .340 file, e.g. to keep a copy of a curve read from the controller.
+# Breakpoints are written in order of increasing units.
+def Write340( curve, filename ):
+    with open( filename, 'w' ) as f:
+        print( 'Sensor Model:   %s' % curve.name, file=f )
+        print( 'Serial Number:  %s' % curve.serial, file=f )
+        print( 'Data Format:    %d      (%s)' % ( curve.format, DataFormats[curve.format] ), file=f )
+        print( 'SetPoint Limit: %.4f      (Kelvin)' % curve.limit, file=f )
+        print( 'Temperature coefficient:  %d (%s)' % ( (1,'Negative') if curve.kelvin[0]>curve.kelvin[-1] else (2,'Positive') ), file=f )
+        print( 'Number of Breakpoints:   %d' % len( curve.units ), file=f )
+        print( '', file=f )
+        print( 'No.   Units      Temperature (K)', file=f )
+        print( '', file=f )
+        for i, ( x, T ) in enumerate( zip( curve.units, curve.kelvin ) ):
+            print( '%3d  %.6f  %.6f' % ( i+1, x, T ), file=f )
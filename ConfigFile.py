@@ -0,0 +1,39 @@
+# Reading of structured configuration files (sweep plans, alarm rules, logger configuration).
+
+# The format is chosen by the file extension:
+#     .json           JSON (standard library)
+#     .toml           TOML (tomllib, standard library from Python 3.11, or the tomli package)
+#     .yaml / .yml    YAML (requires the PyYAML package)
+
+import os
+import json
+
+
+# Read the file and return its content as nested dictionaries and lists.
+def LoadStructured( filename ):
+    ext = os.path.splitext( filename )[1].lower()
+
+    if ext=='.json':
+        with open( filename ) as f:
+            return json.load( f )
+
+    if ext=='.toml':
+        try:
+            import tomllib
+        except ImportError:
+            try:
+                import tomli as tomllib
+            except ImportError:
+                raise ImportError( 'reading %s requires Python 3.11 or the tomli package' % filename )
+        with open( filename, 'rb' ) as f:
+            return tomllib.load( f )
+
+    if ext in ('.yaml','.yml'):
+        try:
+            import yaml
+        except ImportError:
+            raise ImportError( 'reading %s requires the PyYAML package' % filename )
+        with open( filename ) as f:
+            return yaml.safe_load( f )
+
+    raise ValueError( 'unknown format of configuration file %s (use .json, .toml or .yaml)' % filename )
@@ -53,6 +53,7 @@ class CryoMagLevelMeter( SerialDevice ):
                     return True
                 else:
                     self.log('# CryoMag: received', reply, 'in response to', cmd )
+                    self.stats.Retry('CHAN')
             
             self.log('# CryoMag Error: failed to set default channel after %d attempts' % self.max_attempt)
             
@@ -64,15 +65,37 @@ class CryoMagLevelMeter( SerialDevice ):
 
     
     # Define its own read method.
+    # Lines are framed on the linefeed; the carriage return sent before it is removed.
     def read( self ):
-        return SerialDevice.read( self ).replace('\r','')
+        return SerialDevice.read( self ).rstrip('\r')
+    
+    
+    # Send a query and return the reply, or None if there was none.
+    def Query( self, cmd ):
+        self.write(cmd)
+        return self.ReceiveReply(cmd)
+    
+    
+    # Read the reply to the query cmd (see SerialDevice.Pipeline).
+    # The command is echoed on its own line before the reply. An echo followed by the reply on the same line is accepted as well.
+    def ReceiveReply( self, cmd ):
+        echo = self.read()
+        if not echo.startswith(cmd):
+            self.log('# CryoMag: received', repr(echo), 'in response to', cmd )
+            self.reset_input()
+            return None
+        
+        reply = echo[len(cmd):].strip()
+        if reply=='':
+            reply = self.read()
+            if self.status!='complete':
+                return None
+        return reply
     
     
     # Return the current default channel
     def GetDefaultChannel(self):
-        cmd = 'CHAN?'
-        self.write('CHAN?')
-        return self.read().replace(cmd,'')
+        return self.Query('CHAN?')
 
 
     # Return the current unit
@@ -82,11 +105,11 @@ class CryoMagLevelMeter( SerialDevice ):
         
         for i in range(1,self.max_attempt+1):
             
-            self.write(cmd)
+            reply = self.Query(cmd)
+            if reply:
+                return reply
             
-            reply = self.read()
-            if reply.find(cmd)>0:
-                return reply.replace(cmd,'')
+            self.stats.Retry(cmd)
             
         return ''
     
@@ -107,39 +130,64 @@ class CryoMagLevelMeter( SerialDevice ):
         
         for i in range(1,self.max_attempt+1):
             
-            self.write(cmd)
-            reply = self.read()
+            if i>1:
+                self.stats.Retry('MEAS?')
             
-            if reply.find(cmd) >= 0:
-                
-                # Since the original command is also echoed, first remove it.
-                lev = reply.replace( cmd, '').split()
-                
-                # It seems very occasionally the obtained liquid level is empty after removing the echoed command.
-                if len(lev)<2:
-                    
-                    self.log('# CryoMag Error: GetLiquidLevel not in correct format:', reply)
-                    self.log('# Making one more attempt...')
-                    self.reset_input()
-                
-                # Response has at least the required number of fields. Next, check unit.
-                else:
-                
-                    # return the 
-                    if lev[1]=='cm':
-                        return float(lev[0])
-                    elif lev[1]=='in':
-                        return float(lev[0]*2.54)
-                    elif lev[1]=='%':
-                        self.log('# CryoMag Warning: returning liquid level in %' )
-                        return float(lev[0])
-                    else:
-                        self.log('# CryoMag Error: unknown unit in', reply)
-                        #return 
+            reply = self.Query(cmd)
+            
+            if reply!=None:
+                level = self.ParseLevel(reply)
+                if level!=None:
+                    return level
             
-            else:
-                self.log('# CryoMag: received', reply, 'in response to', cmd )
-                self.reset_input()
-                
         self.log('# CryoMag Error: failed to measure liquid level after %d attempts' % self.max_attempt)
-        return None
\ No newline at end of file
+        return None
+    
+    
+    # Read the liquid levels of several channels with one pipelined batch of MEAS? queries.
+    # Channels without a valid reply are measured again with GetLiquidLevel.
+    def GetLiquidLevels(self, channels=(1,2)):
+        
+        cmds = [ 'MEAS? %s' % ch for ch in channels ]
+        replies = self.Pipeline( cmds )
+        
+        levels = []
+        for ch, reply in zip( channels, replies ):
+            level = self.ParseLevel(reply) if reply!=None else None
+            if level==None:
+                self.stats.Retry('MEAS?')
+                level = self.GetLiquidLevel(ch)
+            levels.append( level )
+        return levels
+    
+    
+    # Convert the reply to MEAS? (without the echoed command) to cm. Returns None if the reply is not valid.
+    def ParseLevel(self, reply):
+        
+        lev = reply.split()
+        
+        # It seems very occasionally the obtained liquid level is empty after removing the echoed command.
+        if len(lev)<2:
+            
+            self.log('# CryoMag Error: GetLiquidLevel not in correct format:', reply)
+            self.log('# Making one more attempt...')
+            self.reset_input()
+            return None
+        
+        try:
+            value = float(lev[0])
+        except ValueError:
+            self.log('# CryoMag Error: GetLiquidLevel not a number:', reply)
+            return None
+        
+        # Response has at least the required number of fields. Next, check unit.
+        if lev[1]=='cm':
+            return value
+        elif lev[1]=='in':
+            return value*2.54
+        elif lev[1]=='%':
+            self.log('# CryoMag Warning: returning liquid level in %' )
+            return value
+        else:
+            self.log('# CryoMag Error: unknown unit in', reply)
+            return None
\ No newline at end of file
@@ -0,0 +1,212 @@
+# Counters and latency histograms for serial transactions.
+
+# Every SerialDevice owns a DeviceStats object. For each command (e.g. SCAN?, RDGK?, PRx, MEAS?) it counts
+# the transactions, the bytes sent, the reads that ended on timeout instead of on the termination character
+# (and among them those that received an incomplete frame), the retries of the drivers and the time spent in fixed waits, and it records the latency of every read
+# in a histogram.
+
+# The histograms use HDR-style buckets: each power of two is divided into a fixed number of linear sub-buckets,
+# so that the relative precision is constant (better than 1% with 128 sub-buckets) over the whole range.
+# Recording a value costs one frexp and one dictionary update, which is negligible compared to a serial transaction.
+
+# All DeviceStats objects are kept in the module-level list registry, so that the statistics of all devices
+# can be dumped on demand (see Report).
+
+import math
+import re
+import time
+
+
+# All statistics objects created so far.
+registry = []
+
+# Upper bounds in seconds of the cumulative latency buckets exported to monitoring (see MetricsServer.py).
+bounds = [ 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1., 2., 5. ]
+
+
+# Latency histogram with logarithmic buckets and linear sub-buckets.
+class LatencyHistogram( object ):
+
+    # Values are recorded in seconds with the specified number of sub-buckets per power of two.
+    def __init__( self, subbuckets=128 ):
+        self.subbuckets = subbuckets
+        self.buckets = {}
+        self.count = 0
+        self.sum = 0.
+        self.min = None
+        self.max = None
+
+
+    # Bucket index of a value. Values equal or below zero go to bucket None.
+    def Index( self, v ):
+        if v<=0:
+            return None
+        m, e = math.frexp( v )
+        return e*self.subbuckets + int( (m-0.5)*2*self.subbuckets )
+
+
+    # Upper edge of the bucket with the specified index.
+    def UpperEdge( self, i ):
+        if i==None:
+            return 0.
+        e, sub = divmod( i, self.subbuckets )
+        return math.ldexp( 0.5 + (sub+1)/(2*self.subbuckets), e )
+
+
+    # Record one value.
+    def Record( self, v ):
+        i = self.Index( v )
+        self.buckets[i] = self.buckets.get(i,0)+1
+        self.count += 1
+        self.sum += v
+        if self.min==None or v<self.min:
+            self.min = v
+        if self.max==None or v>self.max:
+            self.max = v
+
+
+    # Value below which fraction q of the recorded values lie (upper edge of the bucket).
+    # The buckets are copied first since the histogram may be read from another thread (e.g. HTTP server).
+    def Percentile( self, q ):
+        if self.count==0:
+            return None
+        target = q*self.count
+        n = 0
+        buckets = dict( self.buckets )
+        for i in sorted( buckets, key=lambda k : float('-inf') if k==None else k ):
+            n += buckets[i]
+            if n>=target:
+                return min( self.UpperEdge(i), self.max )
+        return self.max
+
+
+    # Cumulative counts at the specified upper bounds, as needed for Prometheus histograms.
+    def Cumulative( self, bounds ):
+        counts = [0]*len(bounds)
+        for i, c in dict( self.buckets ).items():
+            edge = self.UpperEdge(i)
+            for n, b in enumerate( bounds ):
+                if edge<=b:
+                    counts[n] += c
+        return counts
+
+
+
+# Statistics of a single command.
+class CommandStats( object ):
+
+    def __init__( self ):
+        self.count = 0
+        self.bytes = 0
+        self.timeouts = 0
+        self.partial = 0
+        self.retries = 0
+        self.latency = LatencyHistogram()
+
+
+    # Summary as a dictionary. Latencies are in seconds.
+    def Snapshot( self ):
+        return { 'count' : self.count,
+                 'bytes' : self.bytes,
+                 'timeouts' : self.timeouts,
+                 'partial' : self.partial,
+                 'retries' : self.retries,
+                 'reads' : self.latency.count,
+                 'latency_sum' : self.latency.sum,
+                 'p50' : self.latency.Percentile(0.5),
+                 'p90' : self.latency.Percentile(0.9),
+                 'p99' : self.latency.Percentile(0.99),
+                 'max' : self.latency.max,
+                 'buckets' : list( zip( bounds, self.latency.Cumulative( bounds ) ) ) }
+
+
+
+# Statistics of one serial device, by command.
+class DeviceStats( object ):
+
+    # Leading mnemonic of a command, e.g. 'RDGK?05' -> 'RDGK?', 'MEAS? 1' -> 'MEAS?', 'SCAN 05,0' -> 'SCAN'
+    mnemonic = re.compile( r'[A-Za-z*]+\??' )
+
+    def __init__( self, name ):
+        self.name = name
+        self.commands = {}
+
+        # Command of the transaction in progress, and the time the last write or read finished.
+        self.current = None
+        self.last = time.perf_counter()
+
+        # Total time spent in fixed waits.
+        self.sleep = 0.
+
+        registry.append( self )
+
+
+    # Extract the command key from a message.
+    def Key( self, msg ):
+        m = self.mnemonic.match( msg )
+        return m.group(0) if m else repr( msg.strip() )
+
+
+    # Statistics of a command, created on first use.
+    def Get( self, key ):
+        if key not in self.commands:
+            self.commands[key] = CommandStats()
+        return self.commands[key]
+
+
+    # A command has been written. Following reads are attributed to this command.
+    def Write( self, key, nbytes ):
+        self.current = key
+        s = self.Get( key )
+        s.count += 1
+        s.bytes += nbytes
+        self.last = time.perf_counter()
+
+
+    # A read has finished with the status set by SerialDevice.read. Latency is measured from the end of the previous write or read.
+    # If the read did not end on the termination character, it is counted as timeout, and also as partial if some bytes were received.
+    def Read( self, status ):
+        now = time.perf_counter()
+        s = self.Get( self.current )
+        s.latency.Record( now-self.last )
+        if status!='complete':
+            s.timeouts += 1
+        if status in ( 'partial', 'overflow' ):
+            s.partial += 1
+        self.last = now
+
+
+    # A driver retries a command.
+    def Retry( self, key ):
+        self.Get( key ).retries += 1
+
+
+    # A fixed wait of t seconds.
+    def Sleep( self, t ):
+        self.sleep += t
+
+
+    # Summary as a dictionary.
+    def Snapshot( self ):
+        return { 'sleep' : self.sleep,
+                 'commands' : { str(k) : s.Snapshot() for k,s in dict( self.commands ).items() } }
+
+
+
+# Remove statistics from the registry, e.g. those of a connection that failed or was replaced.
+def Unregister( stats ):
+    if stats in registry:
+        registry.remove( stats )
+
+
+# Print the statistics of all registered devices in a human-readable table.
+def Report( file ):
+    print( '# Serial transaction statistics at', time.strftime('%Y-%m-%d %H:%M:%S'), file=file )
+    for dev in registry:
+        print( '# %s: %.1f s in fixed waits' % ( dev.name, dev.sleep ), file=file )
+        print( '#   %-12s %8s %8s %8s %8s %10s %10s %10s %10s' % ( 'command', 'count', 'timeout', 'partial', 'retry', 'p50 (ms)', 'p90 (ms)', 'p99 (ms)', 'max (ms)' ), file=file )
+        for key in sorted( dev.commands, key=str ):
+            s = dev.commands[key].Snapshot()
+            ms = [ '%10.2f' % (s[q]*1e3) if s[q]!=None else '%10s' % '-' for q in ('p50','p90','p99','max') ]
+            print( '#   %-12s %8d %8d %8d %8d %s' % ( key, s['count'], s['timeouts'], s['partial'], s['retries'], ' '.join(ms) ), file=file )
+    file.flush()
@@ -0,0 +1,59 @@
+# Supervision of the devices of LeidenLogger.
+
+# An exception raised while a device is read (e.g. a USB-serial adapter that was reset, or a garbled reply)
+# is reported to the watchdog of that device instead of terminating the logger. The device is then closed,
+# and reopened after a delay that doubles after every failed attempt (exponential backoff, up to maxbackoff),
+# while the other devices continue to be read. The watchdog only keeps the state and the timing; opening and
+# closing the device is done by the logger.
+
+class DeviceWatchdog( object ):
+
+    def __init__( self, name, backoff=5., maxbackoff=300. ):
+        self.name = name
+        self.backoff = backoff
+        self.maxbackoff = maxbackoff
+
+        self.up = True
+        self.down_since = None
+        self.delay = backoff
+        self.next_attempt = None
+
+        # The device that failed, so that the new connection can take over its state.
+        self.device = None
+
+        self.failures = 0
+        self.reconnects = 0
+        self.last_error = None
+
+
+    # Record a failure of the device, or of an attempt to reopen it, at time now.
+    def Failed( self, error, now ):
+        self.failures += 1
+        self.last_error = '%s: %s' % ( type(error).__name__, error )
+        if self.up:
+            self.up = False
+            self.down_since = now
+            self.delay = self.backoff
+        else:
+            self.delay = min( 2*self.delay, self.maxbackoff )
+        self.next_attempt = now+self.delay
+
+
+    # Whether the next attempt to reopen the device is due.
+    def Due( self, now ):
+        return not self.up and now>=self.next_attempt
+
+
+    # The device has been reopened. Returns the duration of the interruption.
+    def Recovered( self, now ):
+        gap = now-self.down_since
+        self.up = True
+        self.down_since = None
+        self.device = None
+        self.reconnects += 1
+        return gap
+
+
+    def Snapshot( self ):
+        return { 'up' : self.up, 'down_since' : self.down_since, 'failures' : self.failures,
+                 'reconnects' : self.reconnects, 'last_error' : self.last_error }
@@ -0,0 +1,203 @@
+# Estimators used by LeidenSequencer to decide when the sample has reached equilibrium.
+
+# ExponentialFit fits the transient of the sample temperature after a change of heater power with
+#     T(t) = Tinf + A * exp( -t/tau )
+# and returns the predicted equilibrium temperature Tinf with its uncertainty.
+# For a fixed tau the model is linear in Tinf and A, so these are obtained in closed form by least squares.
+# tau is found by a scan over a logarithmic grid followed by a golden-section refinement.
+# The uncertainty of Tinf includes the uncertainty of tau, estimated from the curvature of the residuals.
+# A series without a significant trend, e.g. at a setpoint that is already stable, has no finite tau; its mean
+# is then taken as Tinf, with the standard error of the mean as uncertainty.
+
+import math
+from collections import deque
+
+
+class ExponentialFit( object ):
+
+    # Range of time constants in seconds considered by the fit, and number of grid points in the initial scan.
+    # Longer series are averaged in groups of consecutive readings down to maxpoints before fitting.
+    # A series is constant if the slope of a straight line through it is below significance standard errors.
+    def __init__( self, taumin=10., taumax=1e5, ngrid=40, maxpoints=1000, significance=2. ):
+        self.taumin = taumin
+        self.taumax = taumax
+        self.ngrid = ngrid
+        self.maxpoints = maxpoints
+        self.significance = significance
+
+
+    # Average groups of k consecutive readings, so that the cost of the fit does not grow with the sampling rate.
+    def Bin( self, t, T ):
+        k = -( -len(t)//self.maxpoints )
+        if k<=1:
+            return t, T
+        tb = [ sum( t[i:i+k] )/len( t[i:i+k] ) for i in range( 0, len(t), k ) ]
+        Tb = [ sum( T[i:i+k] )/len( T[i:i+k] ) for i in range( 0, len(T), k ) ]
+        return tb, Tb
+
+
+    # Linear least squares for fixed tau. Returns (Tinf, A, sum of squared residuals, variance factor of Tinf).
+    def Linear( self, t, T, tau ):
+        n = len(t)
+        x = [ math.exp( -ti/tau ) for ti in t ]
+        sx = sum( x )
+        sy = sum( T )
+        sxx = sum( xi*xi for xi in x )
+        sxy = sum( xi*yi for xi,yi in zip(x,T) )
+
+        det = n*sxx - sx*sx
+        if det<=0:
+            return None
+        A = ( n*sxy - sx*sy )/det
+        Tinf = ( sy - A*sx )/n
+        ssr = sum( ( yi-Tinf-A*xi )**2 for xi,yi in zip(x,T) )
+        return Tinf, A, ssr, sxx/det
+
+
+    # Fit the series T measured at times t (seconds, any origin).
+    # Returns a dictionary with tinf, sigma (uncertainty of tinf), tau, amplitude, and n (points fitted after binning), or None if the fit is not possible.
+    # If the best tau lies at the upper end of the range, the asymptote is not constrained: sigma is infinite,
+    # unless the series has no significant slope, in which case tinf and sigma are its mean and standard error.
+    def Fit( self, t, T ):
+        t, T = self.Bin( t, T )
+        n = len(t)
+        if n<5:
+            return None
+
+        t0 = t[0]
+        t = [ ti-t0 for ti in t ]
+
+        # Residuals as function of u = ln(tau)
+        def SSR( u ):
+            r = self.Linear( t, T, math.exp(u) )
+            return r[2] if r else float('inf')
+
+        umin, umax = math.log( self.taumin ), math.log( self.taumax )
+        grid = [ umin + (umax-umin)*i/(self.ngrid-1) for i in range( self.ngrid ) ]
+        values = [ SSR(u) for u in grid ]
+        k = values.index( min(values) )
+
+        # Golden-section search between the neighbours of the best grid point.
+        a, b = grid[ max(0,k-1) ], grid[ min(self.ngrid-1,k+1) ]
+        g = ( math.sqrt(5)-1 )/2
+        c, d = b-g*(b-a), a+g*(b-a)
+        fc, fd = SSR(c), SSR(d)
+        for i in range( 30 ):
+            if fc<fd:
+                b, d, fd = d, c, fc
+                c = b-g*(b-a)
+                fc = SSR(c)
+            else:
+                a, c, fc = c, d, fd
+                d = a+g*(b-a)
+                fd = SSR(d)
+        u = (a+b)/2
+
+        r = self.Linear( t, T, math.exp(u) )
+        if r==None:
+            return None
+        Tinf, A, ssr, var = r
+
+        result = { 'tinf' : Tinf, 'amplitude' : A, 'tau' : math.exp(u), 'n' : n, 'sigma' : float('inf') }
+        if u>=umax-1e-6:
+            return self.Constant( t, T, result )
+        if n<=3:
+            return result
+
+        # Statistical uncertainty of Tinf at fixed tau, plus the contribution of the uncertainty of tau.
+        s2 = ssr/(n-3)
+        h = 0.05
+        rp, rm = self.Linear( t, T, math.exp(u+h) ), self.Linear( t, T, math.exp(u-h) )
+        sigma2 = s2*var
+        if rp and rm:
+            curvature = ( rp[2] - 2*ssr + rm[2] )/h**2
+            slope = ( rp[0] - rm[0] )/(2*h)
+            if curvature>0:
+                sigma2 += slope**2 * 2*s2/curvature
+            else:
+                sigma2 = float('inf')
+
+        result['sigma'] = math.sqrt( sigma2 )
+        return result
+
+
+    # Mean and standard error of a series without a significant slope, in place of an unconstrained fit.
+    def Constant( self, t, T, result ):
+        line = SlidingRegression( float('inf') )
+        for ti, Ti in zip( t, T ):
+            line.Add( ti, Ti )
+        slope = line.Slope()
+        if slope==None or abs( slope[0] ) > self.significance*slope[1]:
+            return result
+
+        n = len(T)
+        mean = sum( T )/n
+        result['tinf'] = mean
+        result['amplitude'] = 0.
+        result['sigma'] = math.sqrt( sum( (Ti-mean)**2 for Ti in T )/( n*(n-1) ) )
+        return result
+
+
+# SlidingRegression fits a straight line to the readings within the last window seconds and gives the slope
+# and its uncertainty. The sums of the least-squares fit are updated when a reading enters or leaves the window,
+# so each update costs O(1) regardless of the number of readings in the window.
+# Times are taken relative to the first reading to keep the sums well conditioned.
+
+
+class SlidingRegression( object ):
+
+    def __init__( self, window ):
+        self.window = window
+        self.Reset()
+
+
+    # Forget all readings, e.g. at a new setpoint.
+    def Reset( self ):
+        self.points = deque()
+        self.t0 = None
+        self.n = 0
+        self.st = self.sy = self.stt = self.sty = self.syy = 0.
+
+
+    # Add the reading y at time t (seconds) and drop the readings older than the window.
+    def Add( self, t, y ):
+        if self.t0==None:
+            self.t0 = t
+        t -= self.t0
+        self.points.append( (t,y) )
+        self.Update( t, y, 1 )
+
+        while self.points and self.points[0][0] < t-self.window:
+            told, yold = self.points.popleft()
+            self.Update( told, yold, -1 )
+
+
+    def Update( self, t, y, sign ):
+        self.n += sign
+        self.st += sign*t
+        self.sy += sign*y
+        self.stt += sign*t*t
+        self.sty += sign*t*y
+        self.syy += sign*y*y
+
+
+    # Time span covered by the readings in the window.
+    def Span( self ):
+        return self.points[-1][0]-self.points[0][0] if self.points else 0.
+
+
+    # Slope (per second) and its standard error, or None if there are fewer than three readings.
+    def Slope( self ):
+        n = self.n
+        if n<3:
+            return None
+        det = n*self.stt - self.st*self.st
+        if det<=0:
+            return None
+        slope = ( n*self.sty - self.st*self.sy )/det
+        intercept = ( self.sy - slope*self.st )/n
+
+        # Residual sum of squares from the sums. Rounding can make it slightly negative.
+        ssr = self.syy - intercept*self.sy - slope*self.sty
+        sigma = ( max( ssr, 0. )/(n-2) * n/det )**0.5
+        return slope, sigma
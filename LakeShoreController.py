@@ -16,6 +16,49 @@
 from SerialDevice import SerialDevice
 import sys
 import time
+import bisect
+
+
+# Upper limits of the current in A of the sample heater ranges 1 to 8. Range 0 switches the heater off.
+HeaterRangeLimits = [ 31.6e-6, 100e-6, 316e-6, 1e-3, 3.16e-3, 10e-3, 31.6e-3, 100e-3 ]
+
+
+# Range code of the sample heater for the specified power in W and heater resistance in Ohm.
+# Raises ValueError if the power is negative or the required current exceeds the largest range (100 mA).
+# This does not access the controller, so that power setpoints can be checked before a sweep starts.
+def HeaterRangeCode( power, resistance ):
+    if power<0:
+        raise ValueError( 'negative heater power %.3e W' % power )
+    if power==0:
+        return '0'
+    if resistance==None or not resistance>0:
+        raise ValueError( 'invalid heater resistance %s Ohm' % resistance )
+
+    # compute current required for the specified power
+    # power is in Watt
+    current = ( power/resistance ) ** 0.5
+    if current<1.e-15:
+        return '0'
+
+    # The range is the first one whose limit is above the current.
+    n = bisect.bisect_right( HeaterRangeLimits, current )
+    if n==len( HeaterRangeLimits ):
+        raise ValueError( 'current %.3e A for %.3e W exceeds the largest heater range (100 mA) with %g Ohm' % ( current, power, resistance ) )
+    return str( n+1 )
+
+
+# Range codes for a list of powers, e.g. all setpoints of a sweep, which can then be passed to SetHeaterPower.
+# Raises ValueError listing all setpoints that cannot be set.
+def PlanHeaterRanges( powers, resistance ):
+    ranges, errors = [], []
+    for n, power in enumerate( powers ):
+        try:
+            ranges.append( HeaterRangeCode( power, resistance ) )
+        except ValueError as e:
+            errors.append( 'setpoint %d: %s' % ( n+1, e ) )
+    if errors:
+        raise ValueError( '; '.join( errors ) )
+    return ranges
 
 
 # LakeShoreController is derived from SerialDevice
@@ -30,6 +73,12 @@ class LakeShoreController( SerialDevice ):
         # This resistance is updated later by reading from the controller.
         self.resistance = -1
         
+        # Heater range code and power setpoint (as sent with MOUT) last confirmed by the controller, or None if unknown.
+        # SetHeaterPower skips the commands for a range or power the controller already has. Note that changes made
+        # on the front panel are not noticed.
+        self.heater_range = None
+        self.heater_output = None
+        
         # This maximum number of channel can be changed for other LakeShore models.
         self.MaxChannel = 16
         
@@ -37,6 +86,9 @@ class LakeShoreController( SerialDevice ):
         # This is necessary whenever a parameter is read from the controller or when while True is used.
         self.max_attempt = 10
         
+        # Calibration curves of the channels (by channel number) used to compute the temperature locally from the resistance.
+        self.curves = {}
+        
         self.log("# Created LakeShore372 controller.", "Max. number of channels:", self.MaxChannel)
     
     
@@ -78,6 +130,9 @@ class LakeShoreController( SerialDevice ):
             # Otherwise try again
             if reply==ch+',0':
                 return reply
+            
+            if i>1:
+                self.stats.Retry('SCAN')
                 
             # send the query
             # sometimes on first query, it does physical switch while response is null, so read twice
@@ -87,13 +142,18 @@ class LakeShoreController( SerialDevice ):
             if len(reply)<4:
                 reply = self.GetCurrentChannel()
 
-        self.log('# Failed to set the right channel to %s after %d attempts' % (ch,max_try) )
+        self.log('# Failed to set the right channel to %s after %d attempts' % (ch,self.max_attempt) )
         return reply
         
         
     # Read the temperature in Kelvin of the specified channel
     # Note: this function does NOT guarantee accurate reading: one must make sure the scanner is set at the right channel.
+    # If a calibration curve is loaded for the channel, the resistance is read and converted locally.
     def ReadKelvin(self, ch):
+        curve = self.curves.get( int(ch) )
+        if curve:
+            return curve.Kelvin( self.ReadOhm( ch ) )
+        
         self.write( 'RDGK?'+ch )
         reply = self.read()
         return float( reply )
@@ -108,6 +168,95 @@ class LakeShoreController( SerialDevice ):
         return float( reply )
     
     
+    # Read both the temperature and the resistance of the channel.
+    # With a calibration curve loaded for the channel, this takes a single transaction instead of two.
+    # Otherwise both queries are pipelined, and a reading that was not received is queried again on its own.
+    def ReadKelvinOhm(self, ch):
+        curve = self.curves.get( int(ch) )
+        if curve:
+            R = self.ReadOhm( ch )
+            return curve.Kelvin( R ), R
+        
+        K, R = self.Pipeline( [ 'RDGK?'+ch, 'RDGR?'+ch ] )
+        K = float( K ) if K!=None else self.ReadKelvin( ch )
+        R = float( R ) if R!=None else self.ReadOhm( ch )
+        return K, R
+    
+    
+    # Keep the calibration curves of the previous connection.
+    def TakeOver(self, old):
+        SerialDevice.TakeOver( self, old )
+        self.curves = old.curves
+        self.resistance = old.resistance
+    
+    
+    # Use the calibration curve for the channel when reading temperatures, or stop using one if curve is None.
+    def LoadCurve(self, ch, curve):
+        if curve==None:
+            self.curves.pop( int(ch), None )
+            return
+        self.curves[ int(ch) ] = curve
+        self.log( '# Channel %s: converting resistance to temperature with curve %s %s (%d breakpoints)' % ( ch, curve.name, curve.serial, len(curve.units) ) )
+    
+    
+    # Read the calibration curve assigned to the channel from the controller.
+    # Returns None if no curve is assigned to the channel.
+    def GetCurve(self, ch):
+        self.write( 'INCRV?'+ch )
+        number = int( self.read() )
+        if number==0:
+            return None
+        
+        self.write( 'CRVHDR?%d' % number )
+        header = self.read().split(',')
+        if len( header )<5:
+            raise ValueError( 'invalid header of curve %d: %s' % ( number, ','.join(header) ) )
+        
+        # The table ends at the first empty breakpoint.
+        units, kelvin = [], []
+        for i in range( 1, 201 ):
+            self.write( 'CRVPT?%d,%d' % ( number, i ) )
+            point = self.read().split(',')
+            if float( point[0] )==0 and float( point[1] )==0:
+                break
+            units.append( float( point[0] ) )
+            kelvin.append( float( point[1] ) )
+        
+        from CalibrationCurve import CalibrationCurve
+        return CalibrationCurve( units, kelvin, int( header[2] ), name=header[0].strip(), serial=header[1].strip(), limit=float( header[3] ) )
+    
+    
+    # Average successive temperature readings of a channel until the standard error of the mean is below sem (in K)
+    # or the time budget (in seconds) is used up. At least nmin and at most nmax readings are taken.
+    # Without sem and budget, nmin readings are averaged. Each reading is passed to record, if given.
+    # Returns the mean, the standard deviation and the number of readings.
+    def ReadKelvinAverage(self, ch, sem=None, budget=None, nmin=3, nmax=1000, record=None):
+        n, mean, m2 = 0, 0., 0.
+        start = time.time()
+        while n<nmax:
+            x = self.ReadKelvin( ch )
+            if record:
+                record( x )
+
+            # Running mean and sum of squared deviations (Welford)
+            n += 1
+            d = x-mean
+            mean += d/n
+            m2 += d*(x-mean)
+
+            if n<nmin:
+                continue
+            if sem==None and budget==None:
+                break
+            if sem!=None and ( m2/(n-1)/n )**0.5 <= sem:
+                break
+            if budget!=None and time.time()-start >= budget:
+                break
+
+        std = ( m2/(n-1) )**0.5 if n>1 else 0.
+        return mean, std, n
+    
+    
     # Query for the present setting of the sample heater resistance
     # This value is needed by LeidenSequencer to pick the right current range when setting heater power
     def GetHeaterResistance( self ):
@@ -120,63 +269,55 @@ class LakeShoreController( SerialDevice ):
                 return float( fdbk[0] )
             else:
                 self.log('# Failed to get heater resistance on attempt %d. Trying again...' % t)
+                self.stats.Retry('HTRSET?')
 
-        self.log('# Failed to get heater resistance after %d attempts.' % self.max_attemp)
+        self.log('# Failed to get heater resistance after %d attempts.' % self.max_attempt)
         return None
 
     
     # Configure the sample heater resistance
     # This value is needed by the LakeShore controller to set the right current for the specified power
+    # The command is skipped if the controller already has this resistance.
     def SetHeaterResistance( self, R ):
+        if self.resistance==float(R):
+            return self.resistance
         
         # Format the resistance to have the right width and zero-padding
         R = '{:0>7s}'.format( '{:.3f}'.format( float(R) ) )
         
         command = 'HTRSET 0,'+R+',0,0,2'
         self.write( command )
+        self.heater_range = None
+        self.heater_output = None
         
         self.log('# Setting heater resistance to be %s Ohm' % R )
-        return self.GetHeaterResistance()
+        self.resistance = self.GetHeaterResistance()
+        return self.resistance
 
 
     # There is a maximum current range. The current required for the specified power must be smaller than this.
-    # For the meaning of the code, see the manual.
-    def ConfigHeaterRange( self, power ):
+    # For the meaning of the code, see the manual. The range can be given if it has been computed beforehand
+    # (see PlanHeaterRanges). Raises ValueError if the power cannot be set, before anything is sent.
+    def ConfigHeaterRange( self, power, rang=None ):
         
         # if resistance is not properly set, signal
-        if self.resistance == -1:
+        if self.resistance == -1 or self.resistance == None:
             self.resistance = self.GetHeaterResistance()
         
-        # compute current required for the specified power
-        # power is in Watt
-        current = ( power/self.resistance ) ** 0.5
-        
-        rang = '0'
-        if current<1.e-15:
-            rang='0'
-        elif current<31.6e-6:
-            rang='1'
-        elif current<100e-6:
-            rang='2'
-        elif current<316e-6:
-            rang='3'
-        elif current<1e-3:
-            rang='4'
-        elif current<3.16e-3:
-            rang='5'
-        elif current<10e-3:
-            rang='6'
-        elif current<31.6e-3:
-            rang='7'
-        elif current<100e-3:
-            rang='8'
-            
+        if rang==None:
+            rang = HeaterRangeCode( power, self.resistance )
+        if rang==self.heater_range:
+            return rang
+        
         self.write( 'RANGE 0,'+rang )
         
-        self.log('# Expected current for %.3e W is %.3e A' % ( power, current) )
+        if power>0:
+            self.log('# Expected current for %.3e W is %.3e A' % ( power, ( power/self.resistance ) ** 0.5 ) )
         self.log('# Setting heater range to ' + rang )
 
-        return self.GetHeaterRange()
+        reply = self.GetHeaterRange()
+        self.heater_range = rang if reply==rang else None
+        return reply
 
     
     # Query for the range code of the sample heater
@@ -185,12 +326,25 @@ class LakeShoreController( SerialDevice ):
         return self.read()
     
     
-    # Set the sample heater output power
-    def SetHeaterPower( self, power):
-        ran = self.ConfigHeaterRange( power)
-        self.write( 'MOUT 0,'+'{:.2e}'.format(power) )
+    # Set the sample heater output power, and the range if needed (see ConfigHeaterRange).
+    # Returns the power reported by the controller, or the setpoint if the controller already had it.
+    def SetHeaterPower( self, power, rang=None ):
+        self.ConfigHeaterRange( power, rang )
+        
+        setpoint = '{:.2e}'.format(power)
+        if setpoint==self.heater_output:
+            return setpoint
+        
+        self.write( 'MOUT 0,'+setpoint )
         self.log('# Setting heater power to be %.3e W' % power )
-        return self.GetHeaterPower()
+        
+        reply = self.GetHeaterPower()
+        try:
+            confirmed = abs( float(reply)-float(setpoint) ) <= 1e-3*abs( float(setpoint) )
+        except ValueError:
+            confirmed = False
+        self.heater_output = setpoint if confirmed else None
+        return reply
     
     
     # Query for the current setting of sample heater output power in Watt.
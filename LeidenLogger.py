@@ -4,25 +4,26 @@
 
 # This program will log the temperature, pressure and the cryogen liquid level of the Leiden fridge.
 
+import os
 import sys
 import datetime
 import time
 import getopt
 import signal
 
-# Miscellaneous, needed if server is to be run within this program.
-# Currently, all server related direct functions are not working.
-
-from _thread import *
-import threading
-import socket
-
 # Modules needed for managing device connections.
 
 from LakeShoreController import LakeShoreController
 from PfeifferGauge       import PfeifferGauge
 from CryoMagLevelMeter   import CryoMagLevelMeter
 
+import DeviceStats
+from LevelForecast import LevelForecast
+from DeviceWatchdog import DeviceWatchdog
+
+# The modules of optional features (MetricsServer, SerialBroker, CalibrationCurve, SQLiteSink, AlarmEngine,
+# ConfigFile and Archive) are imported where the feature is enabled, so that they do not slow down every start.
+
 
 # Time-keeping. Returns current datetime in python structure.
 def Now():
@@ -34,6 +35,45 @@ def TimeStamp():
     return Now().timestamp()
 
 
+# Settings of the configuration file (see --config), with the same names and meaning as the options.
+# Values are given as in the options or as lists and numbers, e.g. freq: 30:10:60 or freq: [30, 10, 60].
+# Each function converts the value of the file and raises ValueError or TypeError if it is not valid.
+
+def ColonList( value ):
+    if isinstance( value, (list,tuple) ):
+        return [ '' if v==None else str(v) for v in value ]
+    return str( value ).split(':')
+
+
+# Intervals of the three devices. Empty entries keep the present interval.
+def ConfigFreq( value ):
+    freq = [ None if v.strip()=='' else float(v) for v in ColonList( value ) ]
+    if len( freq )>3 or any( f!=None and f<=0 for f in freq ):
+        raise ValueError( 'freq must be up to three positive intervals in seconds' )
+    return freq
+
+
+def ConfigChannels( value ):
+    channels = [ '%d' % int(c) for c in ColonList( value ) ]
+    if not channels or any( int(c)<1 or int(c)>16 for c in channels ):
+        raise ValueError( 'channel must be a list of LakeShore channels between 1 and 16' )
+    return channels
+
+
+def OptionalFloat( value ):
+    return None if value==None else float( value )
+
+
+ConfigSettings = { 'freq' : ConfigFreq,
+                   'channel' : ConfigChannels,
+                   'timeout' : float,
+                   'delta' : float,
+                   'sem' : OptionalFloat,
+                   'budget' : OptionalFloat,
+                   'lhe-threshold' : OptionalFloat,
+                   'alarms' : lambda v : None if v==None else str(v) }
+
+
 # The actual logger function
 class LeidenLogger( object ):
     
@@ -48,6 +88,7 @@ class LeidenLogger( object ):
         # Default prefix of the output filenames.
         # If it is "", output will not be enables.
         self.prefix = ""
+        self.PrefixBase = ""
         
         # Serial port used to communicate to the device.
         self.port = ["","",""]
@@ -79,17 +120,116 @@ class LeidenLogger( object ):
         # Server file. This file will be periodically read by a server script to print fridge status.
         self.ServerOutput = "leiden_status.txt"
         
+        # File to which the serial transaction statistics are periodically written, and the interval in seconds.
+        # The statistics can also be printed at any time by sending SIGUSR1 to the process.
+        self.StatsOutput = None
+        self.StatsInterval = 600
+        self.StatsPrevDump = TimeStamp()
+        
+        # Port of the HTTP server exporting /metrics and /status.json. None disables the server.
+        self.HTTPPort = None
+        self.HTTPServer = None
+        
+        # Acquisition health: number of readings per stream, duration of the last full LakeShore scan,
+        # and the delay of the event loop beyond its nominal period of 1 s.
+        self.Samples = { 'temperature' : 0, 'pressure' : 0, 'liquid_level' : 0 }
+        self.ScanDuration = None
+        self.LoopLag = 0
+        self.LoopLagMax = 0
+        
+        # Time of the latest reading of each stream.
+        self.Updated = {}
+        
+        # If the serial ports are shared through the serial broker, readings of the LakeShore made by
+        # other programs (e.g. LeidenSequencer) are received through this subscription.
+        self.Broker = None
+        self.BrokerEvents = None
+        
+        # Adaptive averaging of the LakeShore temperature: target standard error of the mean in K and time budget per channel in s.
+        # By default a single reading is taken. TempStd and TempCount hold the spread and number of readings of each channel.
+        self.SEM = None
+        self.Budget = None
+        self.TempStd = {}
+        self.TempCount = {}
+        
+        # Calibration curves for computing the temperature locally from the resistance, as pairs of channel and
+        # .340 file (None to read the curve from the controller). See --curve.
+        self.CurveSpecs = []
+        
+        # SQLite database receiving all readings (see SQLiteSink), and whether the text files are written as well.
+        self.DatabaseFile = None
+        self.Database = None
+        self.TextOutput = True
+        
+        # Rotation of the output files into segments of at most SegmentSize bytes or SegmentTime seconds (see --segment-size
+        # and --segment-hours), and the Compressor of the closed segments (see Archive.py). Segments holds the names of
+        # the files of this run for each stream, and SegmentStart the time the current file was started.
+        self.SegmentSize = None
+        self.SegmentTime = None
+        self.Segments = [ [], [], [] ]
+        self.SegmentStart = [ None, None, None ]
+        self.Compressor = None
+        self.HeaderTime = None
+        
+        # Alarm rules evaluated on every reading (see AlarmEngine and --alarms).
+        self.AlarmFile = None
+        self.AlarmVersion = None
+        self.Alarms = None
+        
+        # Configuration file watched for changes (see --config), the time of the last check, the modification times
+        # of the file and of the alarm rules when they were last loaded, and the error of the last attempt to load them.
+        self.ConfigFile = None
+        self.ConfigInterval = 2
+        self.ConfigChecked = 0
+        self.ConfigVersion = None
+        self.ConfigError = None
+        
+        # Forecast of the liquid helium level (see LevelForecast): level in cm at which a transfer is due,
+        # the forecaster, and the latest forecast (published by Snapshot).
+        self.LHeThreshold = None
+        self.LHeForecast = None
+        self.LHeStatus = None
+        
         
         # === Variables initialized, program action starts from here ===
         
         # Read configuration from commandline.
         self.ConfigureOpt( argv )
         
+        # Settings of the configuration file take precedence over the command line.
+        if self.ConfigFile!=None:
+            try:
+                self.ApplyConfig( self.ReadConfig(), startup=True )
+                self.ConfigVersion = self.ConfigFileVersion()
+            except ( OSError, ImportError, ValueError, TypeError ) as e:
+                print( '# LeidenLogger: failed to read the configuration file %s:' % self.ConfigFile, e )
+                sys.exit(1)
+        
+        # With the broker, all devices are accessed through it.
+        if self.Broker!=None:
+            import SerialBroker
+            SerialBroker.address = self.Broker
+            self.port = [ 'broker/'+p if p!='' else p for p in self.port ]
+        
         # LakeShore, Pfeiffer and CryoMagnetics device handler files.
         self.lscontroller = None
         self.pfcontroller = None
         self.cmcontroller = None
         
+        # Watchdogs of the three devices, in the same order (see Supervise).
+        self.Watchdog = [ DeviceWatchdog('LakeShore'), DeviceWatchdog('Pfeiffer'), DeviceWatchdog('CryoMagnetics') ]
+        
+        # Invalid alarm rules are reported before any device is opened.
+        if self.AlarmFile!=None:
+            import AlarmEngine
+            try:
+                self.AlarmVersion = os.stat( self.AlarmFile ).st_mtime_ns
+                self.Alarms = AlarmEngine.Load( self.AlarmFile )
+            except ( OSError, ImportError, ValueError ) as e:
+                print( '# LeidenLogger: failed to load the alarm rules:', e )
+                sys.exit(1)
+            print( '# LeidenLogger: evaluating %d alarm rules from %s' % ( len(self.Alarms.rules), self.AlarmFile ) )
+        
         # Try to establish communication to the devices. If failed, terminate.
         try:
             self.ConfigureLakeShore()
@@ -101,40 +241,23 @@ class LeidenLogger( object ):
             
             self.SetupSignalHandler()
             
+            if self.HTTPPort!=None:
+                import MetricsServer
+                self.HTTPServer = MetricsServer.StartServer( self, self.HTTPPort )
+                print('# LeidenLogger: serving /metrics and /status.json on port %d' % self.HTTPPort )
+            
         except:
             self.Close()
             raise
     
     
-    # Start the server.
-    # This function is no longer used, and it has never worked.
-    def StartServer( self ):
-        self.server_socket = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
-        self.server_socket.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEADDR, 1 )
-        self.server_socket.bind( ('', self.ServerPort) )
-        self.server_socket.listen( 1 )
-        print('# Starting http server on port %d' % self.ServerPort )
-        
-        while True:
-            print('# Waiting to accept')
-            client, addr = self.server_socket.accept()
-            req_data = client.recv(1024).decode('utf-8')
-            print('# received', req_data)
-            #if req_data.find('GET /status') >=0 :
-            response = 'HTTP/1.1 200 OK\n\nHello World!'
-                #response +=
-            client.sendall( response.encode('utf-8') )
-            print('# sent')
-            
-            client.close()
-        
-    
     # Create the output files.
     def ConfigureOutput( self ):
         
         # If prefix is not specified, then all output redirected to standard output.
+        # Without text files (--no-text), the output is discarded but still opened, since it decides which devices are read.
         if self.prefix=="":
-            self.output = [ sys.stdout for f in self.port ]
+            self.output = [ sys.stdout if self.TextOutput else open( os.devnull, "w" ) for f in self.port ]
         
         # If output is specified, then check if the corresponding port is specified.
         # If port is not specified, then do not create the output file.
@@ -143,12 +266,25 @@ class LeidenLogger( object ):
             #self.output = [ open( self.prefix+f, "w", buffering=1) for f in self.suffix ]
             for n,f in enumerate( self.suffix ):
                 if self.port[n] != "" and self.port[n] != None:
-                    self.output[n] = open( self.prefix+f, "w", buffering=1)
+                    self.output[n] = open( self.prefix+f if self.TextOutput else os.devnull, "w", buffering=1)
+                    if self.TextOutput:
+                        self.Segments[n] = [ self.prefix+f ]
+                        self.SegmentStart[n] = TimeStamp()
                 else:
                     self.output[n] = None
                     
         print('# LeidenLogger: opened following files' )
         print('#', [ f.name for f in self.output if f!=None ] )
+        
+        if self.SegmentSize!=None or self.SegmentTime!=None:
+            import Archive
+            self.Compressor = Archive.Compressor()
+            print('# LeidenLogger: closed segments are compressed to %s' % Archive.Extension )
+        
+        if self.DatabaseFile!=None:
+            import SQLiteSink
+            self.Database = SQLiteSink.SQLiteSink( self.DatabaseFile )
+            print('# LeidenLogger: writing readings to database %s' % self.DatabaseFile )
     
     
     # Write the header of the three output files.
@@ -157,41 +293,62 @@ class LeidenLogger( object ):
         
         # LakeShore header
         if self.output[ self.lsindex ]:
-            file = self.output[ self.lsindex ]
-            print('#', TimeStamp(), file = file )
-            print('#', end=', ', file = file)
-            for c in self.lschannels:
-                print("time, T%s, R%s," % (c,c), end=' ', file=file)
-            print('', file=file)
-            print('# LakeShore AC Bridge Temperature Controller', file = file )
-            print("# Time is measured in second, temperature in Kelvin and resistance in Ohm.", file=file)
+            self.WriteTemperatureHeader( self.output[ self.lsindex ] )
             
         # Pfeiffer header
         if self.output[ self.pfindex ]:
-            file = self.output[ self.pfindex ]
-            print('#', TimeStamp(), file = file )
-            endchar = ', '
-            print("# time since start", end=endchar, file=file)
-            for c in self.PFHeader:
-                if c==self.PFHeader[-1]:
-                    endchar = '\n'
-                print( c, end=endchar, file=file)
-            print('', file=file)
-            print('# Pfeiffer TPG366 Vacuum Gauge', file = file )
-            print('# Time measured in second and pressure in mbar.', file=file)
-            print('# Note: gauge channel is default. It could have been altered without software update.', file=file)
-            print('# Note: mbar is default. Pressure unit could be changed on the gauge controller. Please check!', file=file)
-            print('# Note: Channel 6 (custom) is by default capillary, but it could be connected to elsewhere.', file=file)
+            self.WritePressureHeader( self.output[ self.pfindex ] )
         
         # CryoMagnetics header
         if self.output[ self.cmindex ]:
-            file = self.output[ self.cmindex ]
-            print('#', TimeStamp(), file = file )
-            print("# time since start", end='', file=file)
-            for c in [', LHe (cm)', ', LN2 (cm)']:
-                print( c, end='', file=file)
-            print('', file=file)
-            print('# CryoMagnetics Cryogen Level Meter LM-510', file = file )
+            self.WriteLevelHeader( self.output[ self.cmindex ] )
+    
+    
+    # Timestamp on the first line of the output files. All files of the run have the same, so that merge_log.py
+    # joins the segments without offset.
+    def HeaderTimeStamp( self ):
+        if self.HeaderTime==None:
+            self.HeaderTime = TimeStamp()
+        return self.HeaderTime
+    
+    
+    # Headers of the pressure and liquid level files. Like the temperatures, the times in a file continued
+    # in a new segment are still measured from the start of the run.
+    def WritePressureHeader( self, file ):
+        print('#', self.HeaderTimeStamp(), file = file )
+        endchar = ', '
+        print("# time since start", end=endchar, file=file)
+        for c in self.PFHeader:
+            if c==self.PFHeader[-1]:
+                endchar = '\n'
+            print( c, end=endchar, file=file)
+        print('', file=file)
+        print('# Pfeiffer TPG366 Vacuum Gauge', file = file )
+        print('# Time measured in second and pressure in mbar.', file=file)
+        print('# Note: gauge channel is default. It could have been altered without software update.', file=file)
+        print('# Note: mbar is default. Pressure unit could be changed on the gauge controller. Please check!', file=file)
+        print('# Note: Channel 6 (custom) is by default capillary, but it could be connected to elsewhere.', file=file)
+    
+    
+    def WriteLevelHeader( self, file ):
+        print('#', self.HeaderTimeStamp(), file = file )
+        print("# time since start", end='', file=file)
+        for c in [', LHe (cm)', ', LN2 (cm)']:
+            print( c, end='', file=file)
+        print('', file=file)
+        print('# CryoMagnetics Cryogen Level Meter LM-510', file = file )
+    
+    
+    # Header of the temperature file, with the enabled channels as columns.
+    # The times in a file continued after a change of the channels are still measured from the start of the run.
+    def WriteTemperatureHeader( self, file ):
+        print('#', self.HeaderTimeStamp(), file = file )
+        print('#', end=', ', file = file)
+        for c in self.lschannels:
+            print("time, T%s, R%s," % (c,c), end=' ', file=file)
+        print('', file=file)
+        print('# LakeShore AC Bridge Temperature Controller', file = file )
+        print("# Time is measured in second, temperature in Kelvin and resistance in Ohm.", file=file)
     
     
     # Main part of the program
@@ -204,19 +361,35 @@ class LeidenLogger( object ):
         try:   
             print('# LeidenLogger: executing event loop...')
             
+            LoopStart = TimeStamp()
+            
             while True:
                 
                 # if autoscan is false, then update only pressure (and liquid level),
                 # and check if autoscan should be turned back on.
-                self.UpdateAutoScan()
+                # A failure of one device does not stop the others (see Supervise).
+                self.Supervise( self.lsindex, self.UpdateAutoScan )
                 
-                self.UpdateTemperature( self.UpdatePressure, self.UpdateLiquidLevel )
-                self.UpdatePressure()                        
-                self.UpdateLiquidLevel()
+                self.Supervise( self.lsindex, self.UpdateTemperature, self.SupervisedPressure, self.SupervisedLiquidLevel )
+                self.SupervisedPressure()
+                self.SupervisedLiquidLevel()
+                
+                self.Supervise( self.lsindex, self.UpdateFromBroker )
                 
                 self.UpdateServer()
+                self.UpdateStats()
+                self.UpdateDatabase()
+                self.UpdateAlarms()
+                self.UpdateConfig()
+                self.UpdateSegments()
 
                 time.sleep( 1 )
+                
+                # Measure how much longer than the nominal 1 s the iteration took.
+                now = TimeStamp()
+                self.LoopLag = now-LoopStart-1
+                self.LoopLagMax = max( self.LoopLag, self.LoopLagMax )
+                LoopStart = now
 
         except:
             print('# LeidenLogger: exception has ocurred. Terminating...')
@@ -224,6 +397,109 @@ class LeidenLogger( object ):
             raise
     
     
+    # The device with the given index (lsindex, pfindex or cmindex), and replacing it.
+    def Device( self, index ):
+        return [ self.lscontroller, self.pfcontroller, self.cmcontroller ][index]
+    
+    
+    def SetDevice( self, index, device ):
+        if index==self.lsindex:
+            self.lscontroller = device
+        elif index==self.pfindex:
+            self.pfcontroller = device
+        else:
+            self.cmcontroller = device
+    
+    
+    # Call func for the device with the given index, unless the device is not enabled or is disconnected.
+    # An exception closes the device, which is then reopened by later calls (see DeviceWatchdog),
+    # so that a failing device does not terminate the logger.
+    def Supervise( self, index, func, *args ):
+        if self.port[index]=='':
+            return
+        
+        watchdog = self.Watchdog[index]
+        if not watchdog.up:
+            if watchdog.Due( TimeStamp() ):
+                self.Reconnect( index )
+            return
+        
+        try:
+            func( *args )
+        except Exception as e:
+            self.DeviceFailed( index, e )
+    
+    
+    # Pressure and liquid level updates are also called during the LakeShore scan, so they are supervised separately.
+    def SupervisedPressure( self ):
+        self.Supervise( self.pfindex, self.UpdatePressure )
+    
+    
+    def SupervisedLiquidLevel( self ):
+        self.Supervise( self.cmindex, self.UpdateLiquidLevel )
+    
+    
+    # Close a device that failed, and record the gap in its output file.
+    def DeviceFailed( self, index, error ):
+        now = TimeStamp()
+        watchdog = self.Watchdog[index]
+        first = watchdog.up
+        watchdog.Failed( error, now )
+        print( '# LeidenLogger: %s failed (%s). Reconnecting in %g s...' % ( watchdog.name, watchdog.last_error, watchdog.delay ) )
+        
+        if not first:
+            return
+        
+        device = self.Device( index )
+        self.SetDevice( index, None )
+        if device:
+            watchdog.device = device
+            try:
+                device.close()
+            except Exception:
+                pass
+        self.RecordEvent( index, now, 'communication with %s lost (%s)' % ( watchdog.name, watchdog.last_error ) )
+    
+    
+    # Reopen a failed device. The new connection takes over the state of the old one (statistics, calibration curves,
+    # warning flags), and the present scanner channel is read again, so that it is not taken for manual activity.
+    def Reconnect( self, index ):
+        watchdog = self.Watchdog[index]
+        print( '# LeidenLogger: reconnecting %s at %s' % ( watchdog.name, self.port[index] ) )
+        
+        device = None
+        try:
+            device = [ LakeShoreController, PfeifferGauge, CryoMagLevelMeter ][index]( self.port[index] )
+            if watchdog.device:
+                device.TakeOver( watchdog.device )
+            if index==self.lsindex:
+                self.LSPrevChannel = device.GetCurrentChannel()
+                self.LSPrevReading = TimeStamp()-2*self.freq[self.lsindex]
+        except Exception as e:
+            if device:
+                # The statistics of the failed attempt would otherwise be reported next to those of the device.
+                if not watchdog.device or device.stats is not watchdog.device.stats:
+                    DeviceStats.Unregister( device.stats )
+                try:
+                    device.close()
+                except Exception:
+                    pass
+            self.DeviceFailed( index, e )
+            return
+        
+        self.SetDevice( index, device )
+        now = TimeStamp()
+        gap = watchdog.Recovered( now )
+        print( '# LeidenLogger: %s reconnected after %.0f s' % ( watchdog.name, gap ) )
+        self.RecordEvent( index, now, '%s reconnected after %.0f s' % ( watchdog.name, gap ) )
+    
+    
+    # Interruptions and changes of the settings are marked in the output file by a comment line starting with the time since start.
+    def RecordEvent( self, index, now, text ):
+        if self.output[index]:
+            print( '# %d: %s' % ( now-self.starttime, text ), file=self.output[index] )
+    
+    
     # Update the server file.
     def UpdateServer( self ):
         
@@ -236,17 +512,281 @@ class LeidenLogger( object ):
             print( '\nTemperature:', file=server )
             
             if self.output[ self.lsindex ] != None:
+                # Channels added by a reload of --config have no reading until the next scan.
                 for c in self.lschannels:
-                    print( '\tChannel %s:\t%.3e K / %.3e Ohm' % (c, self.Temperature[c], self.Resistance[c]), file=server)
+                    if c in self.Temperature:
+                        print( '\tChannel %s:\t%.3e K / %.3e Ohm' % (c, self.Temperature[c], self.Resistance.get( c, float('nan') )), file=server)
                       
+            # The pressures and levels exist only after the first successful reading (the device may have failed before).
             if self.output[ self.pfindex ] != None:
                 print('\nPressure:', file=server)
-                for n,p in enumerate(self.Pressure0):
+                for n,p in enumerate( getattr( self, 'Pressure0', [] ) ):
                     print( '\t%s:\t%.3e mbar' % (self.PFHeader[n], p), file=server)
 
             if self.output[ self.cmindex ] != None:
                 print('\nCryogen level:', file=server)
-                print( '\tLHe: %.2f cm' % self.LiquidLevel[0], file=server)
+                level = getattr( self, 'LiquidLevel', [None] )[0]
+                if level!=None:
+                    print( '\tLHe: %.2f cm' % level, file=server)
+                
+                forecast = self.LHeStatus
+                if forecast and forecast['time_to_empty']!=None:
+                    print( '\tBoil-off: %.2f cm/h, empty in %.1f h' % ( -forecast['rate'], forecast['time_to_empty']/3600 ), end='', file=server)
+                    if forecast['time_to_threshold']!=None:
+                        print( ', %.0f cm in %.1f h' % ( forecast['threshold'], forecast['time_to_threshold']/3600 ), end='', file=server)
+                    print( '', file=server)
+    
+    
+    # Snapshot of the in-memory state: latest readings and acquisition health.
+    # This function is called from the HTTP server thread and therefore only copies existing values.
+    def Snapshot( self ):
+        start = getattr( self, 'starttime', None )
+        snap = { 'time' : TimeStamp(),
+                 'uptime' : TimeStamp()-start if start else 0,
+                 'temperature' : {},
+                 'pressure' : {},
+                 'liquid_level' : {},
+                 'updated' : dict( self.Updated ),
+                 'serial' : {} }
+        
+        if self.LakeShoreActive() and start:
+            Temperature, Resistance, TempTimeStamp = dict( self.Temperature ), dict( self.Resistance ), dict( self.TempTimeStamp )
+            for c in self.lschannels:
+                if c in Temperature:
+                    snap['temperature'][c] = { 'kelvin' : Temperature[c], 'ohm' : Resistance.get(c), 'time' : start+TempTimeStamp[c] }
+                    if c in self.TempStd:
+                        snap['temperature'][c].update( kelvin_std=self.TempStd[c], readings=self.TempCount[c] )
+        
+        if self.PfeifferActive() and hasattr( self, 'Pressure0' ):
+            snap['pressure'] = dict( zip( self.PFHeader, self.Pressure0 ) )
+        
+        if self.CryoMagActive() and hasattr( self, 'LiquidLevel' ):
+            snap['liquid_level'] = dict( zip( ['LHe','LN2'], self.LiquidLevel ) )
+            snap['lhe_forecast'] = self.LHeStatus
+        
+        if self.Alarms:
+            snap['alarms'] = { r.name : r.active for r in self.Alarms.rules }
+        
+        snap['devices'] = { w.name : w.Snapshot() for w in self.Watchdog }
+        
+        if self.ConfigFile:
+            snap['config'] = { 'file' : self.ConfigFile, 'error' : self.ConfigError }
+        
+        if self.Compressor:
+            snap['archive'] = self.Compressor.Snapshot()
+        
+        snap['health'] = { 'samples' : dict( self.Samples ),
+                           'scan_duration' : self.ScanDuration,
+                           'loop_lag' : self.LoopLag,
+                           'loop_lag_max' : self.LoopLagMax,
+                           'autoscan' : self.autoscan }
+        
+        for dev in [ self.lscontroller, self.pfcontroller, self.cmcontroller ]:
+            if dev:
+                snap['serial'][ type(dev).__name__ ] = dev.stats.Snapshot()
+        
+        return snap
+    
+    
+    # Modification times of the configuration file and of the alarm rules it refers to.
+    def ConfigFileVersion( self ):
+        files = [ self.ConfigFile ] + ( [ self.AlarmFile ] if self.AlarmFile else [] )
+        return [ ( f, os.stat( f ).st_mtime_ns ) for f in files ]
+    
+    
+    # Read the configuration file. Returns the settings as a dictionary, or raises an exception if the file is not valid.
+    def ReadConfig( self ):
+        import ConfigFile
+        config = ConfigFile.LoadStructured( self.ConfigFile )
+        if config==None:
+            config = {}
+        if not isinstance( config, dict ):
+            raise ValueError( 'expected settings as name: value' )
+        
+        unknown = [ k for k in config if k not in ConfigSettings ]
+        if unknown:
+            raise ValueError( 'unknown setting %s (the file can set %s)' % ( ', '.join(unknown), ', '.join(ConfigSettings) ) )
+        
+        settings = {}
+        for key, value in config.items():
+            try:
+                settings[key] = ConfigSettings[key]( value )
+            except ( ValueError, TypeError ) as e:
+                raise ValueError( '%s: %s' % ( key, e ) )
+        return settings
+    
+    
+    # Reload the configuration file every ConfigInterval seconds if it or the alarm rules have been modified.
+    # The settings are applied between two iterations of the event loop, so the acquisition is not interrupted.
+    # If the file is not valid, the error is reported and all settings are kept.
+    def UpdateConfig( self ):
+        
+        if self.ConfigFile==None or TimeStamp()-self.ConfigChecked < self.ConfigInterval:
+            return
+        self.ConfigChecked = TimeStamp()
+        
+        try:
+            version = self.ConfigFileVersion()
+        except OSError:
+            # The file may be in the middle of being replaced by an editor.
+            return
+        if version==self.ConfigVersion:
+            return
+        self.ConfigVersion = version
+        
+        try:
+            self.ApplyConfig( self.ReadConfig() )
+        except ( OSError, ImportError, ValueError, TypeError ) as e:
+            self.ConfigError = str( e )
+            print( '# LeidenLogger: the settings in %s were not applied:' % self.ConfigFile, e )
+        else:
+            self.ConfigError = None
+            # The alarm rules may now be read from another file.
+            self.ConfigVersion = self.ConfigFileVersion()
+    
+    
+    # Apply the settings of the configuration file. Changes made while running are recorded in the output files concerned.
+    # The alarm rules are reloaded if another file is given or the file has been modified. They are loaded before
+    # anything is changed, so that invalid rules leave all settings unchanged. Active alarms start again after a reload.
+    def ApplyConfig( self, settings, startup=False ):
+        
+        alarmfile = settings.get( 'alarms', self.AlarmFile )
+        reload = not startup and ( alarmfile!=self.AlarmFile or ( alarmfile!=None and os.stat( alarmfile ).st_mtime_ns!=self.AlarmVersion ) )
+        alarms = None
+        if reload and alarmfile!=None:
+            import AlarmEngine
+            alarms = AlarmEngine.Load( alarmfile )
+        
+        changes = []
+        def Change( name, old, new, indices ):
+            if old!=new:
+                changes.append( ( '%s changed from %s to %s' % ( name, old, new ), indices ) )
+            return new
+        
+        if 'freq' in settings:
+            freq = [ old if new==None else new for old, new in zip( self.freq, settings['freq']+[None]*3 ) ]
+            for n, name in enumerate( [ 'LakeShore', 'Pfeiffer', 'CryoMagnetics' ] ):
+                Change( 'interval of %s' % name, '%g s' % self.freq[n], '%g s' % freq[n], [n] )
+            self.freq = freq
+        
+        if 'channel' in settings:
+            old = self.lschannels
+            self.lschannels = Change( 'LakeShore channels', ':'.join( old ), ':'.join( settings['channel'] ), [self.lsindex] ).split(':')
+            if self.lschannels!=old and not startup:
+                self.NewTemperatureFile()
+        
+        if 'timeout' in settings:
+            self.timeout = 60*Change( 'autoscan timeout (min)', self.timeout/60, settings['timeout'], [self.lsindex] )
+        
+        if 'delta' in settings:
+            self.delta = Change( 'pressure delta', self.delta, settings['delta'], [self.pfindex] )
+        
+        if 'sem' in settings:
+            self.SEM = Change( 'temperature SEM', self.SEM, settings['sem'], [self.lsindex] )
+        
+        if 'budget' in settings:
+            self.Budget = Change( 'averaging budget', self.Budget, settings['budget'], [self.lsindex] )
+        
+        if 'lhe-threshold' in settings:
+            self.LHeThreshold = Change( 'LHe threshold', self.LHeThreshold, settings['lhe-threshold'], [self.cmindex] )
+            if self.LHeForecast:
+                self.LHeForecast.threshold = self.LHeThreshold
+        
+        if reload:
+            changes.append( ( 'alarm rules reloaded from %s' % alarmfile if alarmfile else 'alarm rules removed', [] ) )
+            if self.Alarms:
+                self.Alarms.Close()
+            self.Alarms = alarms
+            self.AlarmVersion = os.stat( alarmfile ).st_mtime_ns if alarmfile else None
+        self.AlarmFile = alarmfile
+        
+        if startup:
+            return
+        
+        now = TimeStamp()
+        for text, indices in changes:
+            print( '# LeidenLogger: %s: %s' % ( self.ConfigFile, text ) )
+            for index in indices:
+                self.RecordEvent( index, now, 'config: '+text )
+    
+    
+    # Continue the temperature readings in a new file after the enabled channels have changed, since the columns change.
+    def NewTemperatureFile( self ):
+        
+        file = self.output[ self.lsindex ]
+        if file==None:
+            return
+        
+        if not ( self.prefix!="" and self.TextOutput and self.ContinueFile( self.lsindex ) ):
+            self.WriteTemperatureHeader( file )
+    
+    
+    # Continue the output file of a device in a new file named after the present date and time, with the header
+    # of the run. The closed file is compressed if the files are rotated. Returns False if the name is still that
+    # of the present file, since files can only be continued once per second.
+    def ContinueFile( self, index ):
+        
+        file = self.output[ index ]
+        name = self.PrefixBase+"_"+time.strftime('%Y%m%d')+"_"+time.strftime('%H%M%S')+self.suffix[index]
+        if name==file.name:
+            return False
+        
+        print( '# LeidenLogger: continuing %s in %s' % ( file.name, name ) )
+        self.RecordEvent( index, TimeStamp(), 'continued in %s' % name )
+        file.close()
+        if self.Compressor:
+            self.Compressor.Add( file.name )
+        
+        self.output[ index ] = open( name, "w", buffering=1 )
+        self.Segments[ index ].append( name )
+        self.SegmentStart[ index ] = TimeStamp()
+        
+        header = { self.lsindex : self.WriteTemperatureHeader, self.pfindex : self.WritePressureHeader, self.cmindex : self.WriteLevelHeader }
+        header[ index ]( self.output[ index ] )
+        return True
+    
+    
+    # Continue the output files that have reached the size or age of a segment (see --segment-size and --segment-hours).
+    def UpdateSegments( self ):
+        if self.Compressor==None:
+            return
+        
+        now = TimeStamp()
+        for index, file in enumerate( self.output ):
+            if file==None:
+                continue
+            if self.SegmentSize!=None and os.fstat( file.fileno() ).st_size >= self.SegmentSize:
+                self.ContinueFile( index )
+            elif self.SegmentTime!=None and now-self.SegmentStart[ index ] >= self.SegmentTime:
+                self.ContinueFile( index )
+    
+    
+    # Check the staleness and delays of the alarm rules.
+    def UpdateAlarms( self ):
+        if self.Alarms:
+            self.Alarms.Tick( TimeStamp() )
+    
+    
+    # Append the serial transaction statistics to the statistics file every StatsInterval seconds.
+    def UpdateStats( self ):
+        
+        if self.StatsOutput==None or TimeStamp()-self.StatsPrevDump < self.StatsInterval:
+            return
+        
+        self.StatsPrevDump = TimeStamp()
+        with open( self.StatsOutput, 'a' ) as f:
+            DeviceStats.Report( f )
+    
+    
+    # Insert the readings buffered for the database, so that they do not wait for the next reading.
+    def UpdateDatabase( self ):
+        if self.Database:
+            self.Database.Update()
+    
+    
+    # Print the serial transaction statistics on request (SIGUSR1).
+    def DumpStats( self, signum, frame ):
+        DeviceStats.Report( sys.stdout )
     
     
     # Read pressure from Pfeiffer
@@ -260,6 +800,11 @@ class LeidenLogger( object ):
         
         self.Pressure1 = self.pfcontroller.ReadPressure()
             # pressure is given as an list with 6 elements
+        self.Samples['pressure'] += 1
+        self.Updated['pressure'] = curr
+        if self.Alarms:
+            for gauge, p in zip( self.PFHeader, self.Pressure1 ):
+                self.Alarms.Add( 'pressure', gauge, p, curr )
         #print( '# Pressure read at', TimeStamp(),self.Pressure1)
         
         # If enough time has elapsed, then always update.
@@ -279,6 +824,8 @@ class LeidenLogger( object ):
                 for i in self.Pressure1:
                     print( ', %e' % i, end='', file = self.output[self.pfindex])
                 print( '', file = self.output[self.pfindex])
+            if self.Database:
+                self.Database.Pressure( curr, self.PFHeader, self.Pressure1 )
             self.PFPrevReading = curr
         
         # Update pressure reading in all cases (to constantly monitor amount of change)
@@ -303,6 +850,8 @@ class LeidenLogger( object ):
 
         # If autoscan is true, then read and update all enabled channels
         if self.autoscan==True:
+            
+            ScanStart = TimeStamp()
                         
             # If code reaches this line, it means enough time has elapsed since last reading.
             for ch in self.lschannels:
@@ -320,12 +869,17 @@ class LeidenLogger( object ):
                 # After the wait time, if there was no manual activity, then update temperature reading
                 if self.UpdateAutoScan()==True:
                     self.TempTimeStamp[ch] = int( self.TimeSinceStart( ) )
-                    self.Temperature[ch] = self.lscontroller.ReadKelvin( ch )
-                    self.Resistance[ch] = self.lscontroller.ReadOhm( ch )
+                    self.ReadChannel( ch )
                     self.NeedUpdateTemp = True
+                    self.Samples['temperature'] += 1
+                    self.Updated['temperature'] = TimeStamp()
                     
                 else:
                     break
+            
+            # Duration of a scan is only meaningful when all channels have been read.
+            else:
+                self.ScanDuration = TimeStamp()-ScanStart
         
         # If manual operation is in progress, update only the channel of attention.
         else:
@@ -338,9 +892,10 @@ class LeidenLogger( object ):
             # If the scanner channel being viewed is enabled, update the temperature
             if ch in self.lschannels:
                 self.TempTimeStamp[ch] = int( self.TimeSinceStart( ) )
-                self.Temperature[ch] = self.lscontroller.ReadKelvin( ch )
-                self.Resistance[ch] = self.lscontroller.ReadOhm( ch )
+                self.ReadChannel( ch )
                 self.NeedUpdateTemp = True
+                self.Samples['temperature'] += 1
+                self.Updated['temperature'] = TimeStamp()
                 
             else:
                 self.NeedUpdateTemp = False                
@@ -353,6 +908,72 @@ class LeidenLogger( object ):
             self.LSPrevReading = TimeStamp()
 
                         
+    # Read temperature and resistance of the channel the scanner is on.
+    # If SEM or Budget is set, the temperature is averaged until the standard error of the mean is below SEM or the budget is used up.
+    def ReadChannel( self, ch ):
+        if self.SEM!=None or self.Budget!=None:
+            self.Temperature[ch], self.TempStd[ch], self.TempCount[ch] = self.lscontroller.ReadKelvinAverage( ch, self.SEM, self.Budget )
+            self.Resistance[ch] = self.lscontroller.ReadOhm( ch )
+        else:
+            self.Temperature[ch], self.Resistance[ch] = self.lscontroller.ReadKelvinOhm( ch )
+        
+        if self.Database:
+            self.Database.Temperature( TimeStamp(), ch, self.Temperature[ch], self.Resistance[ch] )
+        if self.Alarms:
+            self.Alarms.Add( 'temperature', ch, self.Temperature[ch] )
+
+                        
+    # Record the LakeShore readings made by other programs sharing the controller through the broker.
+    # A RDGK? reply updates the temperature of the channel (the resistance is unknown until a RDGR? reply follows).
+    # All readings received since the last call are written as one row.
+    def UpdateFromBroker( self ):
+        
+        if self.BrokerEvents==None or self.LakeShoreActive()==False:
+            return
+        
+        connection = self.lscontroller.connection
+        updated = False
+        
+        for e in self.BrokerEvents.Events():
+            
+            # Skip own transactions and other ports.
+            if e['client']==connection.client or e['port']!=connection.port:
+                continue
+            
+            cmd = e['cmd'].strip()
+            if cmd[:5] not in ('RDGK?','RDGR?'):
+                continue
+            
+            try:
+                ch = '%d' % int( cmd[5:] )
+                value = float( e['reply'].strip() )
+            except ValueError:
+                continue
+            
+            if ch not in self.lschannels:
+                continue
+            
+            if cmd.startswith('RDGK?'):
+                self.Temperature[ch] = value
+                self.Resistance[ch] = float('nan')
+                self.Samples['temperature'] += 1
+                if self.Database:
+                    self.Database.Temperature( e['time'], ch, value, None )
+                if self.Alarms:
+                    self.Alarms.Add( 'temperature', ch, value, e['time'] )
+            else:
+                self.Resistance[ch] = value
+            
+            self.TempTimeStamp[ch] = int( e['time']-self.starttime )
+            self.Updated['temperature'] = e['time']
+            updated = True
+        
+        # Rows can only be written once every channel has a value.
+        if updated and self.output[ self.lsindex ]:
+            if all( c in self.Temperature and c in self.Resistance for c in self.lschannels ):
+                self.WriteTemperature( file = self.output[self.lsindex] )
+    
+    
     # Read and update liquid level from CryoMagnetics
     def UpdateLiquidLevel( self ):
         
@@ -367,7 +988,17 @@ class LeidenLogger( object ):
 
         # Perform a liquid level reading
         self.CMPrevReading = TimeStamp()
-        self.LiquidLevel = [ self.cmcontroller.GetLiquidLevel(n) for n in range(1,3) ]
+        self.LiquidLevel = self.cmcontroller.GetLiquidLevels( (1,2) )
+        self.Samples['liquid_level'] += 1
+        self.Updated['liquid_level'] = self.CMPrevReading
+        if self.Alarms:
+            for name, level in zip( ['LHe','LN2'], self.LiquidLevel ):
+                self.Alarms.Add( 'level', name, level, self.CMPrevReading )
+        
+        self.LHeForecast.Add( self.CMPrevReading, self.LiquidLevel[0] )
+        self.LHeStatus = self.LHeForecast.Forecast( self.CMPrevReading )
+        if self.LHeStatus:
+            self.LHeStatus['time'] = self.CMPrevReading
         
         if None in self.LiquidLevel:    
             print('# LeidenLogger: liquid level not updated due to invalid reading present in', self.LiquidLevel )
@@ -377,6 +1008,8 @@ class LeidenLogger( object ):
             for i in self.LiquidLevel:
                 print( ', %f' % i, end='', file = self.output[self.cmindex])
             print( '', file = self.output[self.cmindex])
+            if self.Database:
+                self.Database.Level( self.CMPrevReading, ['LHe','LN2'], self.LiquidLevel )
                 
 
     # Function to update the status of autoscan
@@ -421,12 +1054,16 @@ class LeidenLogger( object ):
 
                 
     # Write temperature to file
+    # Channels that have not been read yet (e.g. just enabled in the configuration file) are written as nan.
     def WriteTemperature( self, file):
         endchar = ', '
         for key in self.lschannels:
             if key==self.lschannels[-1]:
                 endchar = '\n'
-            print( '%d, %e, %e' % (self.TempTimeStamp[key],self.Temperature[key],self.Resistance[key]), end=endchar, file=file )
+            if key in self.TempTimeStamp:
+                print( '%d, %e, %e' % (self.TempTimeStamp[key],self.Temperature[key],self.Resistance[key]), end=endchar, file=file )
+            else:
+                print( 'nan, nan, nan', end=endchar, file=file )
 
     
     # Initialize and configure LakeShore controller
@@ -442,6 +1079,8 @@ class LeidenLogger( object ):
                 self.LSCurChannel = ""
                 print( "# Current LakeShore scanner channel is", self.LSPrevChannel)
                     # Scanner channel when the object is created.
+                
+                self.LoadCurves()
                     
                 self.LSLastActivity = TimeStamp()
                     # Set time of last activity.
@@ -458,6 +1097,11 @@ class LeidenLogger( object ):
                     
                 self.NeedUpdateTemp = True
                     # Variable used to check if changes have ocurred that requires updating the output file.
+                
+                if self.Broker!=None:
+                    import SerialBroker
+                    self.BrokerEvents = SerialBroker.BrokerSubscription()
+                    print( "# LeidenLogger: recording LakeShore readings of other broker clients" )
 
             except:
                 print("# LeidenLogger: failed to configure LakeShore. LakeShore will not be enabled." )
@@ -467,6 +1111,20 @@ class LeidenLogger( object ):
             print("# LeidenLogger: port not specified. LakeShore will not be enabled." )
 
 
+    # Load the calibration curves given with --curve, so that only the resistance of these channels is read.
+    def LoadCurves( self ):
+        for ch, filename in self.CurveSpecs:
+            if filename!=None:
+                import CalibrationCurve
+                curve = CalibrationCurve.Read340( filename )
+            else:
+                curve = self.lscontroller.GetCurve( ch )
+                if curve==None:
+                    print( "# LeidenLogger: no calibration curve is assigned to channel %s on the controller." % ch )
+                    continue
+            self.lscontroller.LoadCurve( ch, curve )
+    
+    
     # Initialize connection to Pfeiffer gauge controller.
     def ConfigurePfeiffer( self ):
         
@@ -497,6 +1155,7 @@ class LeidenLogger( object ):
             try:
                 print( "# LeidenLogger: configuring CryoMagnetics LM-510 at %s" % self.port[self.cmindex] )
                 self.cmcontroller = CryoMagLevelMeter( self.port[self.cmindex] )
+                self.LHeForecast = LevelForecast( threshold=self.LHeThreshold )
                 self.CMPrevReading = TimeStamp()-2*self.freq[self.cmindex]
                     # Initialize the time of previous reading to be past to ensure guaranteed first read.
                 
@@ -510,6 +1169,15 @@ class LeidenLogger( object ):
     
     # Close connections to the devices and output files.
     def Close( self ):
+        if self.BrokerEvents:
+            self.BrokerEvents.close()
+            self.BrokerEvents = None
+            
+        if self.HTTPServer:
+            self.HTTPServer.shutdown()
+            self.HTTPServer.server_close()
+            self.HTTPServer = None
+            
         if self.lscontroller:
             print('# LeidenLogger: closing LakeShore...')
             self.lscontroller.close()
@@ -529,6 +1197,21 @@ class LeidenLogger( object ):
             if f:
                 f.close()
         
+        # The last segments are left uncompressed, but those already closed are compressed before exiting.
+        if self.Compressor:
+            if self.Compressor.queue.qsize()>0:
+                print('# LeidenLogger: compressing the last closed segments...')
+            self.Compressor.Close()
+            self.Compressor = None
+        
+        if self.Database:
+            self.Database.Close()
+            self.Database = None
+            
+        if self.Alarms:
+            self.Alarms.Close()
+            self.Alarms = None
+        
     
     # Read the configuration from commandline
     def ConfigureOpt( self, argv ):
@@ -537,13 +1220,14 @@ class LeidenLogger( object ):
     
         # Obtain the commandline options and arguments.
         # Setpoints will be the arguments which are specified in the end
-        opts, _ = getopt.getopt( argv[1:], "h", ["channel=","timeout=","delta=","port=","prefix=","freq=","no-server", "server-port","help"] )
+        opts, _ = getopt.getopt( argv[1:], "h", ["channel=","timeout=","delta=","port=","prefix=","freq=","no-server", "server-port", "server-file=","stats-file=","stats-interval=","http-port=","broker=","sem=","budget=","curve=","sqlite=","no-text","alarms=","lhe-threshold=","config=","segment-size=","segment-hours=","help"] )
 
         # Iterate through the commandline options to set the parameters.
         for opt, arg in opts:
 
             # If prefix is used instead, then append formated date and time to the prefix.    
             if opt in ("--prefix"):
+                self.PrefixBase = arg
                 self.prefix = arg+"_"+time.strftime('%Y%m%d')+"_"+time.strftime('%H%M%S')
 
             # maximum change of temperature in mK per min at equilibrium
@@ -576,7 +1260,62 @@ class LeidenLogger( object ):
                 self.ServerOutput = None
                 
             if opt in ("--server-file"):
-                self.ServerOutput = argv
+                self.ServerOutput = arg
+                
+            if opt in ("--stats-file"):
+                self.StatsOutput = arg
+                
+            if opt in ("--stats-interval"):
+                self.StatsInterval = float(arg)
+                
+            if opt in ("--http-port"):
+                self.HTTPPort = int(arg)
+                
+            # Share the serial ports with other programs through the serial broker at host:port
+            if opt in ("--broker"):
+                host, port = arg.split(':')
+                self.Broker = ( host, int(port) )
+                
+            # Adaptive averaging of the LakeShore temperature
+            if opt=="--sem":
+                self.SEM = float(arg)
+                
+            if opt=="--budget":
+                self.Budget = float(arg)
+                
+            # Calibration curves: ch=file.340 for a curve file, or channels ch1:ch2:... to use the curves of the controller
+            if opt=="--curve":
+                if '=' in arg:
+                    ch, filename = arg.split('=',1)
+                    self.CurveSpecs.append( (ch, filename) )
+                else:
+                    self.CurveSpecs += [ (ch, None) for ch in arg.split(':') ]
+                
+            # Write the readings to an SQLite database, in addition to or instead of the text files.
+            if opt=="--sqlite":
+                self.DatabaseFile = arg
+                
+            if opt=="--no-text":
+                self.TextOutput = False
+                
+            # Alarm rules
+            if opt=="--alarms":
+                self.AlarmFile = arg
+                
+            # Liquid helium level for the forecast of the next transfer
+            if opt=="--lhe-threshold":
+                self.LHeThreshold = float(arg)
+                
+            # Settings that can be changed while running
+            if opt=="--config":
+                self.ConfigFile = arg
+                
+            # Rotation of the output files, with the size in MB or the age in hours of a segment
+            if opt=="--segment-size":
+                self.SegmentSize = float(arg)*1e6
+                
+            if opt=="--segment-hours":
+                self.SegmentTime = float(arg)*3600
                 
             if opt in ("-h","--help"):
                 print("usage: "+argv[0]+" [options optional_parameter]\n")
@@ -587,16 +1326,48 @@ class LeidenLogger( object ):
                 print("\t--freq t1:t2:t3\t max interval in seconds between successive readings for LS:PF:CM.\n")
 
                 print("\t--channel L1:L2:L3\t (LakeShore) enable channel L1, L2, L3, ... for data taking. Note the colon as delimiter.")
-                print("\t--timeout T\t\t (LakeShore) after T min of inactivity, autoscan will be turned on.\n")
+                print("\t--timeout T\t\t (LakeShore) after T min of inactivity, autoscan will be turned on.")
+                print("\t--sem foo\t\t (LakeShore) average the temperature of each channel until the standard error of the mean is below foo K.")
+                print("\t--budget T\t\t (LakeShore) spend at most T seconds averaging one channel.")
+                print("\t--curve ch=foo.340\t (LakeShore) compute the temperature of channel ch from its resistance with the curve in foo.340.")
+                print("\t--curve L1:L2\t\t (LakeShore) the same with the curves read from the controller. Only the resistance is then queried.\n")
 
+                print("\t--lhe-threshold foo\t (CryoMagnetics) forecast the time until the helium level reaches foo cm.\n")
+                
                 print("\t--delta  foo\t (Pfeiffer) record data when reading differs by more than foo (fraction) from previous reading.\n")
 
                 print("\t-h/--no-server\t start program without running the server.\n")
                 
                 print("\t-h/--server-file foo\t use foo as status file for server output.\n")
                 
+                print("\t--stats-file foo\t append serial transaction statistics (counts, timeouts, retries, latency) to foo.")
+                print("\t--stats-interval T\t write the statistics every T seconds (default 600). SIGUSR1 prints them at any time.\n")
+                
+                print("\t--http-port N\t serve /metrics (Prometheus) and /status.json on port N.\n")
+                
+                print("\t--sqlite foo.db\t also write all readings to the SQLite database foo.db.")
+                print("\t--no-text\t do not write the text files (only with --sqlite).\n")
+                
+                print("\t--alarms foo.yaml\t evaluate the alarm rules in foo.yaml (or .json, .toml) on every reading.\n")
+                
+                print("\t--config foo.yaml\t read freq, channel, timeout, delta, sem, budget, lhe-threshold and alarms from foo.yaml")
+                print("\t                 \t (or .json, .toml), and apply changes of the file while running.\n")
+                
+                print("\t--segment-size N\t continue the output files in a new file (segment) when they exceed N MB,")
+                print("\t--segment-hours H\t or when they are H hours old. Closed segments are compressed in the background.\n")
+                
+                print("\t--broker host:port\t access the devices through the serial broker (SerialBroker.py) at host:port, e.g. localhost:50372.\n")
+                
                 print("\t-h/--help \t display help message.\n")
                 sys.exit()
+        
+        if self.TextOutput==False and self.DatabaseFile==None:
+            print('# LeidenLogger: --no-text requires --sqlite, otherwise nothing would be recorded.')
+            sys.exit(1)
+        
+        if ( self.SegmentSize!=None or self.SegmentTime!=None ) and ( self.prefix=="" or self.TextOutput==False ):
+            print('# LeidenLogger: --segment-size and --segment-hours require text files (--prefix).')
+            sys.exit(1)
 
                 
     # If LakeShore is enabled and active or not
@@ -626,7 +1397,12 @@ class LeidenLogger( object ):
     # Assign signal handler
     def SetupSignalHandler( self ):
         signal.signal( signal.SIGINT, self.Terminate )
-        signal.signal( signal.SIGBREAK, self.Terminate )
+        # SIGBREAK (Ctrl+Break) only exists on Windows.
+        if hasattr( signal, 'SIGBREAK' ):
+            signal.signal( signal.SIGBREAK, self.Terminate )
+        # SIGUSR1 prints the serial transaction statistics (not available on Windows).
+        if hasattr( signal, 'SIGUSR1' ):
+            signal.signal( signal.SIGUSR1, self.DumpStats )
 
         
     # Actual function called in case of interruption
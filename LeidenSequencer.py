@@ -7,11 +7,15 @@
 #!/usr/bin/python3
 
 import sys
+import os
+import json
 import getopt
 import time
 import datetime
-from LakeShoreController import LakeShoreController
+from LakeShoreController import LakeShoreController, PlanHeaterRanges
 import signal
+import DeviceStats
+import Equilibrium
 
 
 # Get the current python date
@@ -65,6 +69,9 @@ class LeidenSequencer( object ):
 
         # Resistance of the sample heater in ohm
         self.Resistance = 10
+        
+        # Heater range codes of the steps, computed when the plan is validated.
+        self.Ranges = []
 
         # Default timeout parameter in minutes
         self.Timeout = 60
@@ -78,6 +85,40 @@ class LeidenSequencer( object ):
         # Maximum change required in mK/min for a stable datapoint
         self.dTdt = 1
 
+        # Equilibrium criterion: 'snapshot' compares two readings one interval apart against dTdt,
+        # 'fit' fits an exponential approach to the sample channel and advances when the predicted asymptote has converged,
+        # 'regression' fits a straight line to the readings of the sample channel within the last Window seconds.
+        self.Criterion = 'snapshot'
+
+        # Time window in seconds of the regression criterion, and the number of standard errors
+        # by which the fitted slope must be below dTdt.
+        self.Window = 600
+        self.Significance = 2
+
+        # Number of readings averaged per channel.
+        self.Navg = 10
+
+        # Adaptive averaging: if SEM (K) or Budget (s) is set, each channel is read until the standard error
+        # of the mean is below SEM or Budget seconds have been spent, instead of a fixed Navg readings.
+        self.SEM = None
+        self.Budget = None
+
+        # Monitoring during the dwell: 'scan' reads all channels every interval,
+        # 'sample' reads the sample channel continuously and visits one other channel per interval.
+        self.Monitor = 'scan'
+        self.NextChannel = 0
+
+        # Optional plan file with per-step settings (see LoadPlan), and the resolved list of steps.
+        # Each step is a dictionary with the keys of StepKeys. Settings not given for a step default to the command line options.
+        # Settings of the steps that are not numbers are collected in StepErrors and reported by ValidatePlan.
+        self.Plan = None
+        self.PlanConfig = None
+        self.Steps = []
+        self.StepErrors = []
+
+        # Required uncertainty and stability in K of the predicted equilibrium temperature for the fit criterion.
+        self.Tolerance = 1e-4
+
         # Output file and prefix.
         # Output will be the direct and exact output filename without the .txt suffix.
         # Prefix will also have the date and time information appended.
@@ -86,9 +127,30 @@ class LeidenSequencer( object ):
         self.Log = temp+'.log'
         self.Output = temp+'.txt'
 
+        # Checkpoint file recording the progress of the sweep, rewritten after every reading.
+        # If Resume is set, the sweep continues from the specified checkpoint.
+        self.Checkpoint = temp+'.json'
+        self.Resume = None
+
+        # Number of completed setpoints, time origin of the sweep, and start of the current setpoint in s since the origin.
+        # Restored holds the history of the unfinished setpoint read from the checkpoint.
+        # HeaterOff is the time since the origin at which Close switched the heater off.
+        self.Completed = 0
+        self.StartTimeOffset = None
+        self.SetpointStart = None
+        self.Restored = None
+        self.HeaterOff = None
+
+        # The readings of the sample channel at the current setpoint are appended to a file next to the checkpoint,
+        # so that the checkpoint does not grow with the number of readings.
+        self.HistoryFile = None
+
         # system output for printing progress and error messages.
         self.Sysout = [sys.stdout]
         
+        # If True, the LakeShore is accessed through the serial broker so that LeidenLogger can run at the same time.
+        self.UseBroker = False
+        
         # Read the configuration from commandline and setup the interruption handler.
         self.ConfigOpt( argv )
         self.SetupSignalHandler()
@@ -98,6 +160,16 @@ class LeidenSequencer( object ):
         # After each reading of temperature (Dict 2), Dict 1 is updated with Dict 2.
         self.T1 = {}
         self.T2 = {}
+
+        # Time series (time since start in s, K) of all readings of the sample channel at the current setpoint,
+        # and the latest exponential fit to it.
+        self.History = []
+        self.Fitter = Equilibrium.ExponentialFit()
+        self.Prediction = None
+        self.Regression = Equilibrium.SlidingRegression( self.Window )
+
+        # Channels read in the current step.
+        self.StepChannels = self.Channels
         
         
     def Execute( self ):
@@ -109,8 +181,9 @@ class LeidenSequencer( object ):
         # Establish connection to the LakeShore program.
         self.ConfigLakeShore()
         
-        # Record starting time as origin of time
-        self.StartTimeOffset = TimeStamp();
+        # Record starting time as origin of time. A resumed sweep keeps its original origin.
+        if self.StartTimeOffset==None:
+            self.StartTimeOffset = TimeStamp();
         for f in self.Sysout:
             print('# [', self.StartTimeOffset,']', file = f )
         
@@ -123,7 +196,7 @@ class LeidenSequencer( object ):
         
         # Obtain the commandline options and arguments.
         # Setpoints will be the arguments which are specified in the end
-        opts, self.Setpoints = getopt.getopt( argv[1:], "c:t:d:R:p:o:hs:",[ "timeout=", "dTdt=", "port=", "channels=","prefix=", "output=", "freq=", "sample=", "wait=", "help" ] )
+        opts, self.Setpoints = getopt.getopt( argv[1:], "c:t:d:R:p:o:hs:",[ "timeout=", "dTdt=", "port=", "channels=","prefix=", "output=", "freq=", "sample=", "wait=", "broker=", "criterion=", "tolerance=", "window=", "resume=", "plan=", "monitor=", "sem=", "budget=", "help" ] )
 
         # Iterate through the commandline options to set the parameters.
         for opt, arg in opts:
@@ -139,12 +212,14 @@ class LeidenSequencer( object ):
             if opt in ("-o","--output"):
                 self.Output = arg+".txt"
                 self.Log = arg+".log"
+                self.Checkpoint = arg+".json"
                 # If output is specified, then set the filenames directly.
 
             if opt == "--prefix":
                 foo = arg+"_"+time.strftime('%Y%m%d')+"_"+time.strftime('%H%M%S')
                 self.Output = foo+".txt"
                 self.Log = foo+".log"
+                self.Checkpoint = foo+".json"
                 # If prefix is used instead, then append formated date and time to the prefix.
 
             if opt in ("-p","--port"):
@@ -171,6 +246,51 @@ class LeidenSequencer( object ):
                 self.WaitTime = int(arg)
                 # Maximum dwell time at a setpoint in minutes.
 
+            if opt in ("--broker"):
+                import SerialBroker
+                host, port = arg.split(':')
+                SerialBroker.address = ( host, int(port) )
+                SerialBroker.priority = 0
+                self.UseBroker = True
+                # Share the LakeShore with LeidenLogger through the serial broker. The sequencer has priority.
+
+            if opt == "--criterion":
+                if arg not in ('snapshot','fit','regression'):
+                    print('# Error: unknown equilibrium criterion', arg)
+                    sys.exit()
+                self.Criterion = arg
+                # How equilibrium is judged at each setpoint.
+
+            if opt == "--tolerance":
+                self.Tolerance = float(arg)
+                # Tolerance in K of the predicted equilibrium temperature.
+
+            if opt == "--plan":
+                self.Plan = arg
+                # Sweep plan file with per-step settings. Replaces the setpoints on the command line.
+
+            if opt == "--monitor":
+                if arg not in ('scan','sample'):
+                    print('# Error: unknown monitoring mode', arg)
+                    sys.exit()
+                self.Monitor = arg
+                # How channels are read while waiting for equilibrium.
+
+            if opt == "--sem":
+                self.SEM = float(arg)
+                # Target standard error of the mean of each channel in K.
+
+            if opt == "--budget":
+                self.Budget = float(arg)
+                # Maximum time in seconds spent averaging one channel.
+
+            if opt == "--resume":
+                self.Resume = arg
+                # Continue an interrupted sweep from its checkpoint file.
+
+            if opt == "--window":
+                self.Window = float(arg)
+                # Time window in seconds of the regression criterion.
 
             if opt in ("-h","--help"):
                 print("usage: " + argv[0] + " [options optional_parameter] X1 [X2, X3, ...]\n")
@@ -187,12 +307,293 @@ class LeidenSequencer( object ):
                 print("\t-s foo\t set the sample channel to foo (default is last enabled channel). Its temperature is used as stabilization criteria.\n")
                 print("\t-t/--timeout T\t set the maximum wait time for temperature to stablize to be T min.\n")
                 print("\t-t/--wait T\t set the minimum time at each setpoint.\n")
+                print("\t--criterion foo\t equilibrium criterion: snapshot (default, uses dTdt), fit (exponential fit of the sample channel) or regression (dT/dt from a linear fit, uses dTdt).\n")
+                print("\t--tolerance foo\t for the fit criterion, advance when the predicted equilibrium temperature is known to foo K (default 1e-4).\n")
+                print("\t--window T\t for the regression criterion, fit the readings of the last T seconds (default 600).\n")
+                print("\t--monitor foo\t scan (default) reads all channels every interval, sample reads the sample channel continuously and one other channel per interval.\n")
+                print("\t--sem foo\t average each channel until the standard error of the mean is below foo K (instead of 10 readings).\n")
+                print("\t--budget T\t spend at most T seconds averaging one channel.\n")
+                print("\t--plan foo\t read the steps of the sweep with their own settings from the plan file foo (.json, .toml or .yaml) instead of the command line.\n")
+                print("\t--resume foo.json\t continue the interrupted sweep recorded in the checkpoint file foo.json, appending to its output files.\n")
+                print("\t--broker host:port\t access the LakeShore through the serial broker (SerialBroker.py) at host:port, e.g. localhost:50372.\n")
+                sys.exit()
+
+        if self.Resume:
+            self.LoadCheckpoint( self.Resume )
+        else:
+            if self.Plan:
+                self.LoadPlan( self.Plan )
+            self.Steps = self.MakeSteps()
+            self.Setpoints = [ step['power'] for step in self.Steps ]
+
+
+    # Settings of a step and the attribute holding the command line default of each.
+    StepKeys = { 'power' : None, 'timeout' : 'Timeout', 'wait' : 'WaitTime', 'interval' : 'Interval', 'dTdt' : 'dTdt',
+                 'criterion' : 'Criterion', 'tolerance' : 'Tolerance', 'window' : 'Window', 'channels' : 'Channels',
+                 'navg' : 'Navg', 'sem' : 'SEM', 'budget' : 'Budget', 'monitor' : 'Monitor', 'ramp' : None }
+
+    # Numeric settings of a step and their type. YAML reads e.g. 1e-3 as a string, so all of them are converted.
+    # sem and budget may be None, which disables adaptive averaging.
+    StepNumbers = { 'power' : float, 'timeout' : float, 'wait' : float, 'interval' : float, 'dTdt' : float,
+                    'tolerance' : float, 'window' : float, 'navg' : int, 'sem' : float, 'budget' : float }
+
+
+    # Read a plan file. The plan is either a list of steps or a dictionary with
+    #     steps       list of steps, each a dictionary with at least the power in W
+    #     defaults    settings applied to all steps unless given in the step
+    #     sample      sample channel
+    #     resistance  heater resistance in Ohm
+    # A ramp is a dictionary {steps: n, duration: seconds}: the power is changed from the previous setpoint in n equal steps.
+    def LoadPlan( self, filename ):
+        try:
+            import ConfigFile
+            plan = ConfigFile.LoadStructured( filename )
+        except Exception as e:
+            print( '# Error: cannot read plan file %s: %s' % ( filename, e ) )
+            sys.exit()
+
+        if isinstance( plan, list ):
+            plan = { 'steps' : plan }
+
+        for key in plan:
+            if key not in ('steps','defaults','sample','resistance'):
+                print( '# Error: unknown entry %s in plan file %s' % ( key, filename ) )
+                sys.exit()
+
+        if 'sample' in plan:
+            self.SampleChannel = str( plan['sample'] )
+        if 'resistance' in plan:
+            self.Resistance = float( plan['resistance'] )
+        self.PlanConfig = plan
+
+
+    # Resolve the settings of every step. Settings missing in the plan are taken from the command line options.
+    def MakeSteps( self ):
+        if self.PlanConfig:
+            defaults = self.PlanConfig.get( 'defaults', {} )
+            planned = self.PlanConfig.get( 'steps', [] )
+            if not isinstance( defaults, dict ) or not isinstance( planned, list ):
+                print( '# Error: the defaults of the plan must be a dictionary and the steps a list' )
                 sys.exit()
+            for n, step in enumerate( planned ):
+                if not isinstance( step, dict ):
+                    print( '# Error: step %d must be a dictionary of settings, not %r' % ( n+1, step ) )
+                    sys.exit()
+            raw = [ dict( defaults, **step ) for step in planned ]
+        else:
+            raw = [ { 'power' : p } for p in self.Setpoints ]
+
+        steps = []
+        for n, r in enumerate( raw ):
+            step = { key : getattr( self, attr ) if attr else None for key, attr in self.StepKeys.items() }
+            for key, value in r.items():
+                if key not in self.StepKeys:
+                    print( '# Error: unknown setting %s in step %d' % ( key, n+1 ) )
+                    sys.exit()
+                step[key] = value
+            if step['power']==None:
+                print( '# Error: no power specified in step %d' % (n+1) )
+                sys.exit()
+
+            for key, kind in self.StepNumbers.items():
+                if step[key]==None and key in ('sem','budget'):
+                    continue
+                try:
+                    value = float( step[key] )
+                    if kind==int and value!=int( value ):
+                        raise ValueError
+                    step[key] = kind( value )
+                except ( ValueError, TypeError ):
+                    self.StepErrors.append( 'step %d: %s must be %s, not %r' % ( n+1, key, 'an integer' if kind==int else 'a number', step[key] ) )
+                    step[key] = float('nan')
+            # A single channel may be given as a number.
+            if isinstance( step['channels'], str ):
+                step['channels'] = step['channels'].split(':')
+            elif isinstance( step['channels'], int ):
+                step['channels'] = [ step['channels'] ]
+            elif not isinstance( step['channels'], list ):
+                self.StepErrors.append( 'step %d: channels must be a list, not %r' % ( n+1, step['channels'] ) )
+                step['channels'] = []
+            step['channels'] = [ str(ch) for ch in step['channels'] ]
+
+            if step['ramp']!=None:
+                step['ramp'] = self.MakeRamp( n, step['ramp'] )
+            steps.append( step )
+
+        # All channels read in any step are columns of the output.
+        for step in steps:
+            for ch in step['channels']:
+                if ch not in self.Channels:
+                    self.Channels.append( ch )
+            if len( step['channels'] )==0:
+                step['channels'] = self.Channels
+
+        return steps
+
+
+    # Convert the ramp of step n to {steps: n, duration: seconds}. An invalid ramp is reported and removed.
+    def MakeRamp( self, n, ramp ):
+        if not isinstance( ramp, dict ) or any( key not in ('steps','duration') for key in ramp ):
+            self.StepErrors.append( 'step %d: ramp must be {steps: n, duration: seconds}, not %r' % ( n+1, ramp ) )
+            return None
+        try:
+            steps = float( ramp.get('steps',10) )
+            duration = float( ramp.get('duration',0) )
+            if steps!=int( steps ):
+                raise ValueError
+        except ( ValueError, TypeError ):
+            self.StepErrors.append( 'step %d: invalid ramp %r' % ( n+1, ramp ) )
+            return None
+        return { 'steps' : int( steps ), 'duration' : duration }
+
+
+    # Check every step before the sweep starts: channel numbers, sample channel, criterion, heater range and ramps.
+    # Returns a list of error messages.
+    def ValidatePlan( self ):
+        errors = list( self.StepErrors )
+        if len( self.Steps )==0:
+            errors.append( 'no power setpoints specified' )
+
+        for n, step in enumerate( self.Steps ):
+            where = 'step %d (%g W)' % ( n+1, step['power'] )
+            for key in ('timeout','interval','dTdt','tolerance','window','sem','budget'):
+                if step[key]!=None and step[key]<=0:
+                    errors.append( '%s: %s must be positive' % ( where, key ) )
+            if step['wait']<0:
+                errors.append( '%s: wait must not be negative' % where )
+            if step['navg']<1:
+                errors.append( '%s: navg must be at least 1' % where )
+            for ch in step['channels']:
+                if not ch.isdigit() or not 1<=int(ch)<=16:
+                    errors.append( '%s: invalid channel %s' % ( where, ch ) )
+            if self.SampleChannel not in step['channels']:
+                errors.append( '%s: sample channel %s is not read' % ( where, self.SampleChannel ) )
+            if step['criterion'] not in ('snapshot','fit','regression'):
+                errors.append( '%s: unknown criterion %s' % ( where, step['criterion'] ) )
+            if step['monitor'] not in ('scan','sample'):
+                errors.append( '%s: unknown monitoring mode %s' % ( where, step['monitor'] ) )
+            if step['ramp']!=None and ( step['ramp']['steps']<1 or step['ramp']['duration']<0 ):
+                errors.append( '%s: invalid ramp %s' % ( where, step['ramp'] ) )
+        
+        # The heater ranges of all steps are computed once, so that a sweep never stops at a setpoint it cannot set.
+        if errors:
+            return errors
+        try:
+            self.Ranges = PlanHeaterRanges( [ step['power'] for step in self.Steps ], self.Resistance )
+        except ValueError as e:
+            errors.append( str(e) )
+        return errors
+
+
+    # Shortest and longest duration of the sweep in seconds.
+    # The shortest assumes that every step stabilizes at the first check, the longest that every step runs into its timeout.
+    def EstimateDuration( self ):
+        lo, hi = 0., 0.
+        for step in self.Steps[ self.Completed: ]:
+            # Switching the scanner takes 5 s, a reading about 0.1 s. With a time budget, averaging takes up to the budget.
+            average = step['budget'] if step['budget']!=None else 0.1*step['navg']
+            read = len( step['channels'] ) * ( 5 + average )
+            ramp = float( step['ramp'].get('duration',0) ) if step['ramp'] else 0.
+            lo += ramp + max( step['wait'], step['interval'] ) + 3*read
+            hi += ramp + max( step['timeout']*60, step['wait'] ) + step['interval'] + 3*read
+        return lo, hi
                 
 
+    # Restore the state of an interrupted sweep from a checkpoint file.
+    # The steps, channels, heater resistance and output files of the sweep are taken from the checkpoint.
+    def LoadCheckpoint( self, filename ):
+        with open( filename ) as f:
+            state = json.load( f )
+
+        self.Steps = state['steps']
+        self.Setpoints = [ step['power'] for step in self.Steps ]
+        self.Completed = state['completed']
+        self.Channels = state['channels']
+        self.SampleChannel = state['sample']
+        self.Resistance = state['resistance']
+        self.Output = state['output']
+        self.Log = state['log']
+        self.Checkpoint = filename
+        self.StartTimeOffset = state['start_time_offset']
+
+        if state['setpoint_start']==None or self.Completed>=len(self.Setpoints):
+            return
+
+        # The transient after the heater was switched off is not the approach to the setpoint, so the readings
+        # taken before are discarded and the setpoint is started again.
+        heateroff = state.get('heater_off')
+        if heateroff!=None:
+            print( '# Heater was switched off %d s after the start of the setpoint. The setpoint is started again.' % ( heateroff-state['setpoint_start'] ) )
+            history = []
+        else:
+            history = self.ReadHistory()
+        self.Restored = { 'history' : history, 'heater_off' : heateroff!=None }
+
+
+    # Name of the file with the readings of the sample channel at the current setpoint.
+    def HistoryName( self ):
+        return os.path.splitext( self.Checkpoint )[0]+'_history.txt'
+
+
+    # Read the readings of the sample channel at the unfinished setpoint.
+    # The last line may be incomplete if the sequencer was killed while writing it.
+    def ReadHistory( self ):
+        history = []
+        try:
+            with open( self.HistoryName() ) as f:
+                for line in f:
+                    try:
+                        t, T = line.split(',')
+                        history.append( ( float(t), float(T) ) )
+                    except ValueError:
+                        pass
+        except FileNotFoundError:
+            pass
+        return history
+
+
+    # Start the history of a new setpoint with the given readings.
+    def StartHistory( self, history ):
+        if self.HistoryFile:
+            self.HistoryFile.close()
+        self.History = list( history )
+        self.HistoryFile = open( self.HistoryName(), 'w' )
+        for t, T in self.History:
+            print( '%f, %e' % ( t, T ), file=self.HistoryFile )
+        self.HistoryFile.flush()
+
+
+    # Write the progress of the sweep to the checkpoint file.
+    # The file is replaced atomically, so that an interruption never leaves a partial checkpoint.
+    def SaveCheckpoint( self ):
+        if self.StartTimeOffset==None:
+            return
+        state = { 'steps' : self.Steps,
+                  'completed' : self.Completed,
+                  'channels' : self.Channels,
+                  'sample' : self.SampleChannel,
+                  'resistance' : self.Resistance,
+                  'output' : self.Output,
+                  'log' : self.Log,
+                  'start_time_offset' : self.StartTimeOffset,
+                  'setpoint_start' : self.SetpointStart,
+                  'heater_off' : self.HeaterOff,
+                  'saved' : TimeStamp() }
+        temp = self.Checkpoint+'.tmp'
+        with open( temp, 'w' ) as f:
+            json.dump( state, f )
+        os.replace( temp, self.Checkpoint )
+
+
     # Create the output data and log files.
     def Book( self ):
         
+        if len( self.Channels )==0:
+            for e in self.StepErrors:
+                print( '# Error:', e )
+            print( '# Error: no channels enabled. Use -c/--channels or the channels of the plan.' )
+            sys.exit()
+        
         # If sample channel is not specified, then use the last enabled channel as sample channel.
         if self.SampleChannel==-1:
             self.SampleChannel = self.Channels[-1]
@@ -202,21 +603,37 @@ class LeidenSequencer( object ):
                 print( '# Error: sample channel',self.SampleChannel,'is not in enabled channel', file=f )
                 print( '# Using the last channel.', file=f )
             self.SampleChannel = self.Channels[-1]
+
+        # Check the plan before any file is created or the heater is touched.
+        errors = self.ValidatePlan()
+        if errors:
+            for e in errors:
+                print( '# Error:', e )
+            sys.exit()
             
+        # A resumed sweep appends to the files of the interrupted one.
+        mode = "a" if self.Resume else "w"
+        self.LogFile = open( self.Log, mode, buffering = 1)
+        self.Sysout.append( self.LogFile )
+
+        if self.Resume:
+            self.OutputFile = open( self.Output, "a", buffering = 1)
+            for f in [ self.OutputFile ] + self.Sysout:
+                print( '# Resumed from %s at %s after %d of %d setpoints.' % ( self.Resume, Now(), self.Completed, len(self.Setpoints) ), file=f )
+            return
+
         # Configure output files
         self.OutputFile = open( self.Output, "w", buffering = 1)
         print( "#", TimeStamp(), file = self.OutputFile )
         print( "# Time since start (s), Power (W)", end='', file = self.OutputFile)
         for i in self.Channels:
               print(', T%s (K)' % i, end='', file = self.OutputFile)
+        if self.FitColumns():
+            print(', T%s asymptote (K), asymptote error (K), tau (s)' % self.SampleChannel, end='', file = self.OutputFile)
         print( file = self.OutputFile)
         print( '# Using channel %s as the sample channel.\n' % self.SampleChannel, file = self.OutputFile)
 
         
-        self.LogFile = open( self.Log, "w", buffering = 1)
-        self.Sysout.append( self.LogFile )
-
-        
     def PrintConfig( self ):
         # Print configuration information.
         for f in self.Sysout:
@@ -225,10 +642,24 @@ class LeidenSequencer( object ):
             print( "# Channels enabled: ", end="" , file=f )
             print( self.Channels , file=f )
             print( "# Sample channel is %s" % self.SampleChannel , file=f )
-            print( "# Temperature is recorded either after %d minutes or when the rate of change is less than %.2f K/min" % (self.Timeout, self.dTdt) , file=f )
+            if self.Criterion=='fit':
+                criterion = "the predicted equilibrium temperature is known to %g K" % self.Tolerance
+            elif self.Criterion=='regression':
+                criterion = "the fitted rate of change over %d s is significantly less than %g K/min" % (self.Window, self.dTdt)
+            else:
+                criterion = "the rate of change is less than %.2f K/min" % self.dTdt
+            # With a plan, the criteria of each step are listed below.
+            if not self.Plan:
+                print( "# Temperature is recorded either after %d minutes or when %s" % (self.Timeout, criterion) , file=f )
             print( "# The resistance of the sample heater is set to be %.2f ohm." % self.Resistance , file=f )
             print( "# Power setpoints (in W):", end=" " , file=f )
             print( self.Setpoints , file=f )
+            if self.Plan:
+                print( "# Steps of plan %s:" % self.Plan, file=f )
+                for n, step in enumerate( self.Steps ):
+                    print( '#   %d: %s' % ( n+1, ', '.join( '%s=%s' % ( k, step[k] ) for k in self.StepKeys ) ), file=f )
+            lo, hi = self.EstimateDuration()
+            print( "# Estimated duration: %.1f to %.1f hours" % ( lo/3600, hi/3600 ), file=f )
             print( '', file=f )
 
 
@@ -237,7 +668,7 @@ class LeidenSequencer( object ):
         for f in self.Sysout:
             print( "# Configuring LakeShore Controller...", file=f )
         try:
-            self.controller = LakeShoreController( self.Port )
+            self.controller = LakeShoreController( 'broker/'+self.Port if self.UseBroker else self.Port )
         except:
             for f in self.Sysout:
                 print( "# Unable to configuring LakeShore Controller...", file=f )
@@ -249,7 +680,16 @@ class LeidenSequencer( object ):
         self.controller.AddLogFile( self.LogFile )
 
         # Configure the resistance of the controller
-        self.controller.SetHeaterResistance( self.Resistance )
+        # If the controller does not accept the resistance exactly, the heater ranges are planned again with its value.
+        R = self.controller.SetHeaterResistance( self.Resistance )
+        if R!=self.Resistance:
+            try:
+                self.Ranges = PlanHeaterRanges( [ step['power'] for step in self.Steps ], R )
+            except ( ValueError, TypeError ) as e:
+                for f in self.Sysout:
+                    print( "# Error: heater resistance is %s Ohm instead of %g Ohm: %s" % ( R, self.Resistance, e ), file=f )
+                self.Close()
+                sys.exit()
 
 
     # Iterate through the specified power setpoints
@@ -258,9 +698,16 @@ class LeidenSequencer( object ):
     # Record the temperature.
     def Sequence( self ):
 
-        for setpoint in self.Setpoints:
-            power = float(setpoint)
-            self.controller.SetHeaterPower( power )
+        for index in range( self.Completed, len(self.Steps) ):
+            step = self.Steps[index]
+            self.ApplyStep( step )
+            power = step['power']
+
+            # Ramp from the previous setpoint. A resumed setpoint has been ramped already, unless the heater was switched off.
+            resumed, self.Restored = self.Restored, None
+            if step['ramp'] and ( not resumed or resumed['heater_off'] ):
+                self.Ramp( self.Steps[index-1]['power'] if index>0 and not resumed else 0., power, step['ramp'] )
+            self.controller.SetHeaterPower( power, self.Ranges[index] )
 
             #for f in Sysout:
                 # PrintTimeStamp( file=f )
@@ -268,20 +715,30 @@ class LeidenSequencer( object ):
 
             self.T1['ts'] = TimeSince( self.StartTimeOffset )
             self.T1['pw'] = power
+
+            # Start a new transient for the fit and regression criteria,
+            # or continue the transient of a resumed setpoint with the readings taken before the interruption.
+            # The timeout is counted from the resumption, since the time of the interruption was not spent waiting.
+            self.SetpointStart = self.T1['ts']
+            self.StartHistory( resumed['history'] if resumed else [] )
+            self.Prediction = None
+            self.Regression.Reset()
+            for t, T in self.History:
+                self.Regression.Add( t, T )
             
             # Read temperature into T1, print and pause for one sampling interval and enter a loop.
             self.ReadTemperature( self.T1 )
 
             for f in self.Sysout:
                 PrintT( self.T1, file=f )
-            time.sleep( self.Interval )
+            self.Pause()
 
             while True:
                 self.T2['ts'] = TimeSince( self.StartTimeOffset)
                 self.T2['pw'] = power
 
                 # Iterate through the enabled channels to record temperature
-                self.ReadTemperature( self.T2 )
+                self.UpdateReading( self.T2 )
                 for f in self.Sysout:
                     PrintT( self.T2, file=f )
 
@@ -289,35 +746,126 @@ class LeidenSequencer( object ):
                 if self.T2['ts'] - self.T1['ts'] < self.WaitTime:
                     continue
                     
-                rate = self.GetRate( self.SampleChannel, self.T2, self.T1 )
-                
-                if rate < self.dTdt:
-                    
-                    for f in self.Sysout:
-                        print('# Stabilized: dT/dt = %f K/min, rate of change is smaller than %f' % ( rate, self.dTdt ), file=f )
+                if self.Stabilized():
                     break
                     
                 # Check for timeout
                 elif self.SequencerTimeout()==True:
                     
                     for f in self.Sysout:
-                        print('#', Now(), 'Timeout: %d s - %d s > %d min' % (self.T2['ts'],self.T1['ts'], self.Timeout), file=f );
+                        print('#', Now(), 'Timeout: %d s - %d s > %d min' % (self.T2['ts'],self.SetpointStart, self.Timeout), file=f );
                     break
 
                 # If not stabilized yet, wait for the specified interval and then update T1
                 else:
-                    time.sleep( self.Interval )
+                    self.Pause()
                     self.UpdateTemperature( self.T1, self.T2 )
 
             self.T1['ts'] = TimeSince( self.StartTimeOffset )
             self.ReadTemperature( self.T1 )
             # need to write temperature output here!!!
-            PrintT( self.T1, file = self.OutputFile)
+            row = dict( self.T1 )
+            if self.FitColumns():
+                fit = self.FitTransient() if self.Criterion=='fit' else None
+                row['tinf'], row['sigma'], row['tau'] = ( fit['tinf'], fit['sigma'], fit['tau'] ) if fit else ( float('nan'), )*3
+            PrintT( row, file = self.OutputFile)
+
+            self.Completed = index+1
+            self.SaveCheckpoint()
+    
+    
+    # Use the settings of a step.
+    def ApplyStep( self, step ):
+        self.Timeout = step['timeout']
+        self.WaitTime = step['wait']
+        self.Interval = step['interval']
+        self.dTdt = step['dTdt']
+        self.Criterion = step['criterion']
+        self.Tolerance = step['tolerance']
+        self.Window = step['window']
+        self.Regression.window = step['window']
+        self.StepChannels = step['channels']
+        self.Navg = step['navg']
+        self.SEM = step['sem']
+        self.Budget = step['budget']
+        self.Monitor = step['monitor']
+    
+    
+    # Change the heater power from p0 to p1 in equal steps spread over the duration of the ramp.
+    def Ramp( self, p0, p1, ramp ):
+        n = int( ramp.get('steps',10) )
+        duration = float( ramp.get('duration',0) )
+        for f in self.Sysout:
+            print( '# Ramping heater power from %e to %e W in %d steps over %d s' % ( p0, p1, n, duration ), file=f )
+        for i in range( 1, n ):
+            self.controller.SetHeaterPower( p0 + (p1-p0)*i/n )
+            time.sleep( duration/(n-1) )
+    
+    
+    # The output has the columns of the exponential fit if any step uses the fit criterion.
+    def FitColumns( self ):
+        return any( step['criterion']=='fit' for step in self.Steps )
+    
+    
+    # Check whether the sample channel has reached equilibrium according to the selected criterion.
+    def Stabilized( self ):
+        if self.Criterion=='fit':
+            return self.FitConverged()
+        if self.Criterion=='regression':
+            return self.RegressionStable()
+
+        rate = self.GetRate( self.SampleChannel, self.T2, self.T1 )
+        if rate < self.dTdt:
+            for f in self.Sysout:
+                print('# Stabilized: dT/dt = %f K/min, rate of change is smaller than %f' % ( rate, self.dTdt ), file=f )
+            return True
+        return False
+    
+    
+    # The slope of the readings within the window, in K/min, must be below dTdt by Significance standard errors.
+    def RegressionStable( self ):
+        result = self.Regression.Slope()
+        if result==None:
+            return False
+
+        rate, sigma = abs( result[0] )*60, result[1]*60
+        for f in self.Sysout:
+            print('# dT/dt = %e +- %e K/min from %d readings over %d s' % ( rate, sigma, self.Regression.n, self.Regression.Span() ), file=f )
+
+        if rate + self.Significance*sigma < self.dTdt:
+            for f in self.Sysout:
+                print('# Stabilized: dT/dt = %e +- %e K/min is significantly smaller than %f' % ( rate, sigma, self.dTdt ), file=f )
+            return True
+        return False
+    
+    
+    # Fit an exponential approach to the readings of the sample channel at the current setpoint.
+    def FitTransient( self ):
+        return self.Fitter.Fit( [ h[0] for h in self.History ], [ h[1] for h in self.History ] )
+    
+    
+    # The predicted equilibrium temperature has converged if its uncertainty is below the tolerance
+    # and it agrees within the tolerance with the prediction of the previous interval.
+    def FitConverged( self ):
+        fit = self.FitTransient()
+        previous, self.Prediction = self.Prediction, fit
+        if fit==None:
+            return False
+
+        for f in self.Sysout:
+            print('# Fit: T%s -> %e +- %e K, tau = %.0f s' % ( self.SampleChannel, fit['tinf'], fit['sigma'], fit['tau'] ), file=f )
+
+        if fit['sigma'] < self.Tolerance and previous and abs( fit['tinf']-previous['tinf'] ) < self.Tolerance:
+            for f in self.Sysout:
+                print('# Stabilized: predicted equilibrium temperature %e K is known to better than %g K' % ( fit['tinf'], self.Tolerance ), file=f )
+            return True
+        return False
     
     
     # Check if maximum time between setpoints have elapsed.
+    # T1 is updated every interval, so the dwell time is measured from the start of the setpoint.
     def SequencerTimeout( self ):
-        return self.T2['ts']-self.T1['ts'] > self.Timeout*60
+        return self.T2['ts']-self.SetpointStart > self.Timeout*60
     
     
     # Calculate rate of temperature change.
@@ -328,18 +876,105 @@ class LeidenSequencer( object ):
     
     
     # Function to update current temperature reading
-    def ReadTemperature( self, T, Navg=10 ):
+    # Channels not read in the current step are recorded as nan.
+    def ReadTemperature( self, T, Navg=None ):
         for ch in self.Channels:
+            if ch not in self.StepChannels:
+                T[ch] = float('nan')
+                continue
+            self.ReadChannel( T, ch, Navg )
+
+        self.SaveCheckpoint()
+
+
+    # Read one channel into T.
+    def ReadChannel( self, T, ch, Navg=None ):
+        if Navg==None:
+            Navg = self.Navg
+            
+        # Other programs sharing the controller must not switch the scanner in the meantime.
+        with self.controller.Exclusive( block=['SCAN '] ):
+            
             # switch scanner to the channel and wait for reading to stabilize
             self.controller.SetChannel( ch )
             self.controller.wait(5)
             
+            # With adaptive averaging, read until the target precision or the time budget is reached.
+            if self.SEM!=None or self.Budget!=None:
+                T[ch], std, n = self.controller.ReadKelvinAverage( ch, self.SEM, self.Budget, record=lambda x : self.Record( ch, x ) )
+                for f in self.Sysout:
+                    print( '# T%s: %d readings, std %e K' % ( ch, n, std ), file=f )
+                return
+            
             # perform successive Navg readings and return the average
             T[ch] = 0 
             for i in range( 1, Navg+1 ):
-                T[ch] += self.controller.ReadKelvin( ch )
+                T[ch] += self.ReadKelvin( ch )
             
             T[ch] /= Navg
+
+
+    # Single reading of a channel.
+    def ReadKelvin( self, ch ):
+        reading = self.controller.ReadKelvin( ch )
+        self.Record( ch, reading )
+        return reading
+
+
+    # Every reading of the sample channel is kept for the fit and regression criteria.
+    def Record( self, ch, reading ):
+        if ch==self.SampleChannel:
+            t = TimeStamp()-self.StartTimeOffset
+            self.History.append( ( t, reading ) )
+            self.Regression.Add( t, reading )
+            if self.HistoryFile:
+                print( '%f, %e' % ( t, reading ), file=self.HistoryFile )
+                self.HistoryFile.flush()
+
+
+    # Sample-priority monitoring. The LakeShore has a single scanner, so channels cannot be read in parallel.
+    # Instead, the scanner stays on the sample channel, which is read continuously for the specified duration,
+    # and afterwards one of the other channels is visited, in turn. The other channels in T keep their latest value.
+    def MonitorSample( self, T, duration ):
+        for ch in self.Channels:
+            T.setdefault( ch, self.T1.get( ch, float('nan') ) )
+
+        # The scanner is reserved for the whole duration, so the lock must outlive it.
+        with self.controller.Exclusive( block=['SCAN '], ttl=duration+30 ):
+
+            # Settle only if the scanner is not on the sample channel already.
+            if self.controller.GetCurrentChannel()!=self.controller.GetFormattedChannel( self.SampleChannel )+',0':
+                self.controller.SetChannel( self.SampleChannel )
+                self.controller.wait(5)
+
+            total, n = 0., 0
+            start = time.time()
+            while n==0 or time.time()-start < duration:
+                total += self.ReadKelvin( self.SampleChannel )
+                n += 1
+            T[self.SampleChannel] = total/n
+
+        others = [ ch for ch in self.StepChannels if ch!=self.SampleChannel ]
+        if others:
+            ch = others[ self.NextChannel % len(others) ]
+            self.NextChannel += 1
+            self.ReadChannel( T, ch )
+
+        self.SaveCheckpoint()
+
+
+    # Reading during the dwell at a setpoint: a full scan, or in sample-priority mode one interval of sample readings.
+    def UpdateReading( self, T ):
+        if self.Monitor=='sample':
+            self.MonitorSample( T, self.Interval )
+        else:
+            self.ReadTemperature( T )
+
+
+    # Pause between readings. In sample-priority mode the interval is spent reading, so there is no pause.
+    def Pause( self ):
+        if self.Monitor!='sample':
+            time.sleep( self.Interval )
     
     
     # Update temperature
@@ -351,11 +986,27 @@ class LeidenSequencer( object ):
     
     # Terminate the program.
     def Close( self ):
+        # Record the final progress, so that an interrupted sweep can be continued with --resume.
+        self.SaveCheckpoint()
+        if self.Completed < len(self.Setpoints) and self.StartTimeOffset!=None:
+            for f in self.Sysout:
+                print( '# Sweep interrupted after %d of %d setpoints. Continue with --resume %s' % ( self.Completed, len(self.Setpoints), self.Checkpoint ), file=f )
+
         if self.controller:
+            DeviceStats.Report( self.LogFile )
             self.controller.SetHeaterPower( 0.0 )
             self.controller.close()
             self.controller = None
 
+            # A resumed setpoint must then start a new transient (see LoadCheckpoint).
+            if self.StartTimeOffset!=None:
+                self.HeaterOff = TimeSince( self.StartTimeOffset )
+                self.SaveCheckpoint()
+
+        if self.HistoryFile:
+            self.HistoryFile.close()
+            self.HistoryFile = None
+
         self.OutputFile.close()
         self.LogFile.close()
 
@@ -363,7 +1014,18 @@ class LeidenSequencer( object ):
     # Set up the handler for proper handling of interruption signals.
     def SetupSignalHandler( self ):
         signal.signal( signal.SIGINT, self.Terminate )
-        signal.signal( signal.SIGBREAK, self.Terminate )
+        # SIGBREAK (Ctrl+Break) only exists on Windows.
+        if hasattr( signal, 'SIGBREAK' ):
+            signal.signal( signal.SIGBREAK, self.Terminate )
+        # SIGUSR1 prints the serial transaction statistics (not available on Windows).
+        if hasattr( signal, 'SIGUSR1' ):
+            signal.signal( signal.SIGUSR1, self.DumpStats )
+    
+    
+    # Print the serial transaction statistics on request.
+    def DumpStats( self, signum, frame ):
+        for f in self.Sysout:
+            DeviceStats.Report( f )
         
     
     # The actual function called by the handler.
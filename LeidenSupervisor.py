@@ -0,0 +1,340 @@
+# Supervisor of several LeidenLogger instances, e.g. one for each fridge of the lab.
+
+# Every instance is a separate LeidenLogger process, started with the options given in the configuration file,
+# its own HTTP port (see --http-port) and its own status file, so that the instances do not clash. The supervisor
+#     - restarts an instance that exits, after a delay that doubles after every failure (see DeviceWatchdog),
+#     - measures the CPU time and memory of every instance (Linux only, from /proc),
+#     - serves the state of all instances on a single HTTP port:
+#           /status.json   the process state and usage of every instance and the /status.json of its logger
+#           /metrics       the metrics of all loggers with an instance label, and the process metrics of the instances
+#           /status        the status files of all instances, as SimpleServer.py does for a single logger.
+# The loggers are only queried when a page is requested, so the supervisor itself costs next to nothing while idle.
+# The configuration is read from a JSON, TOML or YAML file (see ConfigFile.py):
+#
+#     http-port: 8080                   # port of the supervisor (default 8080)
+#     base-port: 9100                   # HTTP ports of the instances that do not specify one: 9100, 9101, ...
+#     instances:
+#       - name: fridge1
+#         args: [--port, /dev/ttyUSB0:/dev/ttyUSB1:/dev/ttyUSB2, --prefix, fridge1/run, --channel, '1:2:3']
+#       - name: fridge2
+#         args: [--port, /dev/ttyUSB3:/dev/ttyUSB4:, --prefix, fridge2/run]
+#         directory: /data/fridge2      # working directory of the instance (default: the present one)
+#         http-port: 9200
+#
+# The output of every instance is appended to <name>.log in its working directory.
+
+import os
+import sys
+import json
+import time
+import signal
+import getopt
+import threading
+import subprocess
+import urllib.request
+from http.server import ThreadingHTTPServer
+
+import ConfigFile
+import MetricsServer
+from DeviceWatchdog import DeviceWatchdog
+
+
+LoggerScript = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), 'LeidenLogger.py' )
+
+
+# CPU time in seconds and resident memory in bytes of a process, or None where /proc is not available.
+def ProcessUsage( pid ):
+    try:
+        with open( '/proc/%d/stat' % pid ) as f:
+            fields = f.read().rsplit( ')', 1 )[1].split()
+        with open( '/proc/%d/statm' % pid ) as f:
+            pages = int( f.read().split()[1] )
+    except ( OSError, IndexError, ValueError ):
+        return None, None
+    ticks = os.sysconf( 'SC_CLK_TCK' )
+    return ( int( fields[11] )+int( fields[12] ) )/ticks, pages*os.sysconf( 'SC_PAGE_SIZE' )
+
+
+# One LeidenLogger process.
+class Instance( object ):
+
+    # The process must run for stable seconds before a restart is considered successful.
+    def __init__( self, name, args, port, directory=None, stable=60. ):
+        self.name = name
+        self.port = port
+        self.directory = directory or os.getcwd()
+        self.stable = stable
+
+        self.args = [ str(a) for a in args ]
+        if '--http-port' not in self.args:
+            self.args += [ '--http-port', str(port) ]
+        if '--server-file' not in self.args and '--no-server' not in self.args:
+            self.args += [ '--server-file', name+'_status.txt' ]
+        self.statusfile = self.args[ self.args.index('--server-file')+1 ] if '--server-file' in self.args else None
+
+        self.watchdog = DeviceWatchdog( name, backoff=10., maxbackoff=600. )
+        self.process = None
+        self.started = None
+        self.starts = 0
+        self.exitcode = None
+
+        # Usage at the last measurement, and the CPU load since the measurement before.
+        self.cpu = None
+        self.memory = None
+        self.load = None
+        self.measured = None
+
+
+    def Start( self, now ):
+        log = open( os.path.join( self.directory, self.name+'.log' ), 'a' )
+        # The instance runs in its own process group, so that only the supervisor receives Ctrl-C and stops it cleanly.
+        if os.name=='nt':
+            options = { 'creationflags' : subprocess.CREATE_NEW_PROCESS_GROUP }
+        else:
+            options = { 'start_new_session' : True }
+        try:
+            self.process = subprocess.Popen( [ sys.executable, LoggerScript ]+self.args, cwd=self.directory,
+                                             stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT, **options )
+        finally:
+            log.close()
+        self.started = now
+        self.starts += 1
+        self.cpu = self.memory = self.load = self.measured = None
+        print( '# LeidenSupervisor: started %s (pid %d) on port %d' % ( self.name, self.process.pid, self.port ) )
+
+
+    # Check the process, restart it when due, and update the usage.
+    def Poll( self, now ):
+        if self.process!=None:
+            code = self.process.poll()
+            if code==None:
+                if not self.watchdog.up and now-self.started >= self.stable:
+                    self.watchdog.Recovered( now )
+                self.Measure( now )
+                return
+            self.process = None
+            self.exitcode = code
+            self.watchdog.Failed( RuntimeError( 'exited with code %d' % code ), now )
+            print( '# LeidenSupervisor: %s exited with code %d. Restarting in %g s...' % ( self.name, code, self.watchdog.delay ) )
+
+        if self.watchdog.Due( now ) or self.starts==0:
+            try:
+                self.Start( now )
+            except OSError as e:
+                self.watchdog.Failed( e, now )
+                print( '# LeidenSupervisor: failed to start %s (%s). Retrying in %g s...' % ( self.name, e, self.watchdog.delay ) )
+
+
+    def Measure( self, now ):
+        cpu, memory = ProcessUsage( self.process.pid )
+        if cpu!=None and self.cpu!=None and now>self.measured:
+            self.load = ( cpu-self.cpu )/( now-self.measured )
+        self.cpu, self.memory, self.measured = cpu, memory, now
+
+
+    # Stop the process as if Ctrl-C was pressed, so that the logger closes its files; kill it after timeout seconds.
+    def Stop( self, timeout=30 ):
+        if self.process==None or self.process.poll()!=None:
+            return
+        print( '# LeidenSupervisor: stopping %s...' % self.name )
+        try:
+            self.process.send_signal( signal.CTRL_BREAK_EVENT if os.name=='nt' else signal.SIGINT )
+            self.process.wait( timeout )
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+    # Page of the logger, or None if it does not answer.
+    def Fetch( self, page, timeout=2 ):
+        if self.process==None:
+            return None
+        try:
+            with urllib.request.urlopen( 'http://127.0.0.1:%d%s' % ( self.port, page ), timeout=timeout ) as r:
+                return r.read().decode('utf-8')
+        except OSError:
+            return None
+
+
+    # Process state and usage. Times are Unix times, cpu_seconds is the total CPU time of the running process,
+    # cpu_load the fraction of a CPU used over the last measurement interval.
+    def Snapshot( self ):
+        running = self.process!=None
+        return { 'running' : running,
+                 'pid' : self.process.pid if running else None,
+                 'port' : self.port,
+                 'started' : self.started if running else None,
+                 'starts' : self.starts,
+                 'exit_code' : self.exitcode,
+                 'last_error' : self.watchdog.last_error,
+                 'cpu_seconds' : self.cpu,
+                 'cpu_load' : self.load,
+                 'memory_bytes' : self.memory }
+
+
+
+# Merge the metrics pages of the instances, adding the label instance to every sample.
+# The samples of each family are grouped under one HELP and TYPE, as required by the exposition format.
+def MergeMetrics( pages ):
+    families = {}
+    order = []
+    for name, text in pages:
+        family = None
+        for line in text.splitlines():
+            if line.startswith('# HELP ') or line.startswith('# TYPE '):
+                family = line.split()[2]
+                if family not in families:
+                    families[ family ] = { 'header' : [], 'samples' : [] }
+                    order.append( family )
+                if len( families[ family ]['header'] )<2 and line not in families[ family ]['header']:
+                    families[ family ]['header'].append( line )
+                continue
+            if line.startswith('#') or not line.strip() or family==None:
+                continue
+            label = 'instance="%s"' % MetricsServer.Escape( name )
+            n = line.find('{')
+            if n>=0 and n<line.find(' '):
+                line = line[:n+1] + label + ( ',' if line[n+1]!='}' else '' ) + line[n+1:]
+            else:
+                n = line.find(' ')
+                line = line[:n] + '{' + label + '}' + line[n:]
+            families[ family ]['samples'].append( line )
+
+    lines = []
+    for family in order:
+        lines += families[ family ]['header'] + families[ family ]['samples']
+    return '\n'.join( lines ) + '\n' if lines else ''
+
+
+class LeidenSupervisor( object ):
+
+    def __init__( self, config ):
+        if not isinstance( config, dict ) or not isinstance( config.get('instances'), list ) or not config['instances']:
+            raise ValueError( 'expected a list of instances under the key instances' )
+
+        self.port = int( config.get( 'http-port', 8080 ) )
+        base = int( config.get( 'base-port', 9100 ) )
+
+        self.instances = []
+        for n, spec in enumerate( config['instances'] ):
+            if not isinstance( spec, dict ) or not spec.get('name'):
+                raise ValueError( 'every instance needs a name' )
+            args = spec.get( 'args', [] )
+            if not isinstance( args, list ):
+                raise ValueError( 'instance %s: args must be a list' % spec['name'] )
+            self.instances.append( Instance( str( spec['name'] ), args, int( spec.get( 'http-port', base+n ) ), spec.get('directory') ) )
+
+        names = [ i.name for i in self.instances ]
+        if len( set(names) )!=len( names ):
+            raise ValueError( 'instance names must be unique' )
+        ports = [ i.port for i in self.instances ]+[ self.port ]
+        if len( set(ports) )!=len( ports ):
+            raise ValueError( 'the HTTP ports of the instances and of the supervisor must be different' )
+
+        self.server = None
+        self.running = True
+
+
+    def Snapshot( self ):
+        snap = { 'time' : time.time(), 'instances' : {} }
+        for i in self.instances:
+            s = i.Snapshot()
+            status = i.Fetch( '/status.json' )
+            s['status'] = json.loads( status ) if status else None
+            snap['instances'][ i.name ] = s
+        return snap
+
+
+    def Metrics( self ):
+        m = MetricsServer.MetricWriter()
+        snaps = [ ( i.name, i.Snapshot() ) for i in self.instances ]
+        for name, key, kind, help in [ ( 'leiden_instance_up', 'running', 'gauge', '1 while the logger process is running.' ),
+                                       ( 'leiden_instance_starts_total', 'starts', 'counter', 'Number of times the logger process was started.' ),
+                                       ( 'leiden_instance_cpu_seconds_total', 'cpu_seconds', 'counter', 'CPU time used by the running logger process.' ),
+                                       ( 'leiden_instance_memory_bytes', 'memory_bytes', 'gauge', 'Resident memory of the logger process.' ) ]:
+            m.Family( name, kind, help )
+            for instance, s in snaps:
+                m.Sample( name, s[key] if key!='running' else int( s[key] ), instance=instance )
+
+        pages = [ ( i.name, i.Fetch( '/metrics' ) ) for i in self.instances ]
+        return m.Text() + MergeMetrics( [ ( n, p ) for n, p in pages if p ] )
+
+
+    # Status files of the instances, one after the other.
+    def StatusText( self ):
+        text = ''
+        for i in self.instances:
+            text += '=== %s ===\n' % i.name
+            try:
+                with open( os.path.join( i.directory, i.statusfile ) ) as f:
+                    text += f.read()
+            except ( OSError, TypeError ):
+                text += '(no status file)\n'
+            text += '\n'
+        return text
+
+
+    def StartServer( self ):
+        self.server = ThreadingHTTPServer( ( '', self.port ), MetricsServer.Handler )
+        self.server.daemon_threads = True
+        self.server.routes = {
+            '/metrics' : lambda q : ( 'text/plain; version=0.0.4; charset=utf-8', self.Metrics() ),
+            '/status.json' : lambda q : ( 'application/json', json.dumps( self.Snapshot() ) ),
+            '/status' : lambda q : ( 'text/plain; charset=utf-8', self.StatusText() ),
+        }
+        threading.Thread( target=self.server.serve_forever, name='SupervisorServer', daemon=True ).start()
+        print( '# LeidenSupervisor: serving /status.json, /metrics and /status on port %d' % self.port )
+
+
+    def Terminate( self, signum, frame ):
+        self.running = False
+
+
+    # Run until interrupted, then stop all instances.
+    def Execute( self, interval=5. ):
+        signal.signal( signal.SIGINT, self.Terminate )
+        signal.signal( signal.SIGTERM, self.Terminate )
+        if hasattr( signal, 'SIGBREAK' ):
+            signal.signal( signal.SIGBREAK, self.Terminate )
+
+        self.StartServer()
+        try:
+            while self.running:
+                now = time.time()
+                for i in self.instances:
+                    i.Poll( now )
+                time.sleep( interval )
+        finally:
+            for i in self.instances:
+                i.Stop()
+            self.server.shutdown()
+            self.server.server_close()
+            print( '# LeidenSupervisor: all instances stopped.' )
+
+
+def main():
+    opts, args = getopt.getopt( sys.argv[1:], "h", ["help"] )
+
+    for opt, arg in opts:
+        if opt in ("-h","--help"):
+            print("usage: "+sys.argv[0]+" config.yaml\n")
+            print("Start, monitor and restart the LeidenLogger instances listed in config.yaml (or .json, .toml),")
+            print("and serve their state on a single HTTP port. See the beginning of this file for the format.\n")
+            print("\t-h/--help \t\t display help message.\n")
+            sys.exit()
+
+    if len( args )!=1:
+        print('# LeidenSupervisor: specify one configuration file (see --help).')
+        sys.exit(1)
+
+    try:
+        supervisor = LeidenSupervisor( ConfigFile.LoadStructured( args[0] ) )
+    except ( OSError, ImportError, ValueError, TypeError ) as e:
+        print('# LeidenSupervisor: %s:' % args[0], e)
+        sys.exit(1)
+
+    supervisor.Execute()
+
+
+if __name__ == "__main__":
+    main()
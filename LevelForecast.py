@@ -0,0 +1,107 @@
+# Forecast of the liquid helium level from the readings of the CryoMagnetics level meter.
+
+# The boil-off rate is the slope of a straight line fitted to the readings of the last window seconds
+# (Equilibrium.SlidingRegression, O(1) per reading). The forecast is made robust as follows:
+#     - a reading more than fill cm above the fitted line is a transfer: the fit restarts from this reading,
+#       so the readings before and during the transfer do not bias the rate;
+#     - a reading further than outlier cm (or 5 standard deviations of the residuals, if larger) below the line
+#       is ignored, unless the next readings confirm it, in which case the fit restarts as well;
+#     - nothing is forecast before the readings span minspan seconds.
+# From the fitted level and rate follow the time until the level reaches the threshold (e.g. the level at which
+# a transfer is due) and until it reaches empty.
+
+from Equilibrium import SlidingRegression
+
+
+class LevelForecast( object ):
+
+    def __init__( self, threshold=None, empty=0., window=6*3600., minspan=1800., fill=2., outlier=1., confirm=3 ):
+        self.threshold = threshold
+        self.empty = empty
+        self.fill = fill
+        self.outlier = outlier
+        self.confirm = confirm
+        self.minspan = minspan
+
+        self.fit = SlidingRegression( window )
+        self.rejected = []
+        self.restarts = 0
+        self.outliers = 0
+
+
+    # Level of the fitted line at time t and the standard deviation of the residuals, or None if not fitted yet.
+    def Line( self, t ):
+        f = self.fit
+        if f.n<3:
+            return None
+        slope = f.Slope()
+        if slope==None:
+            return None
+        slope = slope[0]
+        intercept = ( f.sy - slope*f.st )/f.n
+        ssr = f.syy - intercept*f.sy - slope*f.sty
+        return intercept + slope*( t-f.t0 ), ( max( ssr, 0. )/( f.n-2 ) )**0.5
+
+
+    # Add the level (cm) read at time t (seconds).
+    def Add( self, t, level ):
+        if level==None or level!=level:
+            return
+
+        line = self.Line( t )
+        if line!=None:
+            predicted, sigma = line
+            if level-predicted > self.fill:
+                self.Restart( t, level )
+                return
+            if predicted-level > max( self.outlier, 5*sigma ):
+                self.rejected.append( ( t, level ) )
+                if len( self.rejected ) < self.confirm:
+                    self.outliers += 1
+                    return
+                # A lasting drop: start again from the confirming readings.
+                rejected = self.rejected
+                self.Restart( *rejected[0] )
+                for r in rejected[1:]:
+                    self.fit.Add( *r )
+                return
+
+        self.rejected = []
+        self.fit.Add( t, level )
+
+
+    def Restart( self, t, level ):
+        self.restarts += 1
+        self.fit.Reset()
+        self.rejected = []
+        self.fit.Add( t, level )
+
+
+    # Forecast at time t as a dictionary, or None if there are not enough readings.
+    # restarts counts the transfers and lasting drops after which the fit restarted, outliers the ignored readings.
+    # rate and rate_sigma are in cm per hour (negative while boiling off); the times are in seconds from t,
+    # and None if the level is not decreasing or the threshold is not set.
+    def Forecast( self, t ):
+        if self.fit.Span() < self.minspan:
+            return None
+        line = self.Line( t )
+        slope = self.fit.Slope()
+        if line==None or slope==None:
+            return None
+        level, sigma = line
+        rate, rate_sigma = slope
+
+        def TimeTo( target ):
+            if target==None or rate>=0:
+                return None
+            return max( 0., ( level-target )/( -rate ) )
+
+        return { 'level' : level,
+                 'rate' : rate*3600,
+                 'rate_sigma' : rate_sigma*3600,
+                 'threshold' : self.threshold,
+                 'time_to_threshold' : TimeTo( self.threshold ),
+                 'time_to_empty' : TimeTo( self.empty ),
+                 'span' : self.fit.Span(),
+                 'restarts' : self.restarts,
+                 'outliers' : self.outliers }
@@ -0,0 +1,328 @@
+# Reading time ranges of the output files of LeidenLogger (_temp.txt, _pres.txt, _liqlev.txt) without parsing the whole file.
+
+# The file is divided into blocks of about blocksize bytes ending at line boundaries. For every block the index
+# holds its byte range and the smallest and largest time (first column) of its rows. Read(t0,t1) then reads and
+# parses only the blocks whose time range overlaps the request. Since the time range of every block is kept,
+# the result is correct even if the times are not monotonic, e.g. in files merged by merge_log.py.
+# The index is cached next to the file (foo_pres.txt.idx) and extended when the file has grown. Only complete
+# lines are indexed, so a file that is still being written by LeidenLogger can be read at any time.
+# Compressed segments (foo_pres.txt.gz or .zst, see Archive.py) are read by streaming decompression: they are indexed
+# once, and reading skips forward to the blocks needed instead of seeking. SegmentReader reads all segments of
+# a rotated output file as one file.
+
+# The column names are taken from the header: time, condsr, still, ... for pressures, and time1, T1, R1,
+# time16, T16, R16, ... for temperatures. Rows with a different number of fields are skipped; if the channels
+# of a merged temperature file change, only the rows matching the first header are returned.
+# Columns are returned as numpy arrays if numpy is installed, and as lists otherwise.
+
+import os
+import json
+import itertools
+
+import Archive
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Read and discard n bytes of a file that cannot seek, such as a compressed segment.
+def Skip( f, n ):
+    while n>0:
+        data = f.read( min( n, 1<<20 ) )
+        if not data:
+            return
+        n -= len( data )
+
+
+# Version of the format of the index file. Index files of other versions are rebuilt.
+IndexVersion = 1
+
+
+# Names of the columns of a header line, or None if the line is not a header.
+def ColumnNames( line ):
+    fields = [ f.strip() for f in line.lstrip('#').split(',') ]
+    fields = [ f for f in fields if f!='' ]
+    if len( fields )<2:
+        return None
+
+    # Temperature files repeat time, Tn, Rn for every channel.
+    if len( fields )%3==0 and fields[0]=='time' and all( f=='time' for f in fields[0::3] ):
+        names = []
+        for T, R in zip( fields[1::3], fields[2::3] ):
+            names += [ 'time'+T[1:], T, R ]
+        return names
+
+    if fields[0].startswith('time'):
+        fields[0] = 'time'
+    return fields
+
+
+class LogReader( object ):
+
+    def __init__( self, filename, blocksize=1<<16, cache=True ):
+        self.filename = filename
+        self.blocksize = blocksize
+        self.indexfile = filename+'.idx' if cache else None
+
+        # Blocks as [ offset, end, tmin, tmax ], number of bytes indexed, and first line of the file
+        # (used to recognize that the file has been replaced). For a compressed file, stored is its size on disk.
+        self.blocks = []
+        self.size = 0
+        self.signature = None
+        self.stored = None
+
+        # Start of the run (timestamp on the first line) and column names from the header.
+        self.start = None
+        self.columns = None
+
+        self.Load()
+        self.Refresh()
+
+
+    # Load the cached index, if it belongs to this file.
+    def Load( self ):
+        if self.indexfile==None or not os.path.exists( self.indexfile ):
+            return
+        try:
+            with open( self.indexfile ) as f:
+                index = json.load( f )
+        except ( OSError, ValueError ):
+            return
+        if index.get('version')!=IndexVersion or index.get('blocksize')!=self.blocksize:
+            return
+
+        self.blocks = index['blocks']
+        self.size = index['size']
+        self.signature = index['signature']
+        self.stored = index.get('stored')
+        self.start = index['start']
+        self.columns = index['columns']
+
+
+    # Write the index next to the file. Failures (e.g. a read-only directory) are ignored.
+    def Save( self ):
+        if self.indexfile==None:
+            return
+        index = { 'version' : IndexVersion, 'blocksize' : self.blocksize, 'size' : self.size, 'signature' : self.signature,
+                  'stored' : self.stored, 'start' : self.start, 'columns' : self.columns, 'blocks' : self.blocks }
+        try:
+            with open( self.indexfile+'.tmp', 'w' ) as f:
+                json.dump( index, f )
+            os.replace( self.indexfile+'.tmp', self.indexfile )
+        except OSError:
+            pass
+
+
+    # Forget the index, e.g. because the file has been replaced.
+    def Reset( self ):
+        self.blocks = []
+        self.size = 0
+        self.signature = None
+        self.stored = None
+        self.start = None
+        self.columns = None
+
+
+    # Index the lines added to the file since the last call. Returns True if the index changed.
+    def Refresh( self ):
+        if Archive.Compressed( self.filename ):
+            return self.RefreshCompressed()
+
+        size = os.path.getsize( self.filename )
+
+        with open( self.filename, 'rb' ) as f:
+            first = f.readline().decode( errors='replace' )
+            if self.signature!=None and ( size<self.size or first!=self.signature ):
+                self.Reset()
+            if size==self.size:
+                return False
+
+            # The last block is extended rather than followed by a small one.
+            offset = self.size
+            if self.blocks and self.blocks[-1][1]-self.blocks[-1][0] < self.blocksize:
+                offset = self.blocks.pop()[0]
+
+            f.seek( offset )
+            pos = self.IndexLines( f, offset )
+
+        changed = pos!=self.size
+        self.size = pos
+        self.signature = first
+        if changed:
+            self.Save()
+        return changed
+
+
+    # A compressed segment does not change, so it is indexed once, from the beginning.
+    def RefreshCompressed( self ):
+        stored = os.path.getsize( self.filename )
+        if stored==self.stored:
+            return False
+
+        self.Reset()
+        with Archive.Open( self.filename ) as f:
+            first = f.readline()
+            self.size = self.IndexLines( itertools.chain( [ first ], f ), 0 )
+        self.signature = first.decode( errors='replace' )
+        self.stored = stored
+        self.Save()
+        return True
+
+
+    # Add the lines starting at byte offset to the index. Returns the end of the last complete line.
+    def IndexLines( self, lines, offset ):
+        block = None
+        pos = offset
+        for line in lines:
+            if not line.endswith( b'\n' ):
+                break
+            end = pos+len( line )
+
+            if line.startswith( b'#' ):
+                self.ParseComment( line.decode( errors='replace' ), pos )
+            else:
+                try:
+                    t = float( line.split( b',', 1 )[0] )
+                except ValueError:
+                    t = None
+                if t!=None:
+                    if block==None:
+                        block = [ pos, end, t, t ]
+                    block[1] = end
+                    block[2] = min( block[2], t )
+                    block[3] = max( block[3], t )
+
+            if block!=None and end-block[0] >= self.blocksize:
+                self.blocks.append( block )
+                block = None
+            pos = end
+
+        if block!=None:
+            self.blocks.append( block )
+        return pos
+
+
+    # The first line holds the start time of the run, the first line with commas the column names.
+    def ParseComment( self, line, pos ):
+        if pos==0:
+            try:
+                self.start = float( line.lstrip('#') )
+            except ValueError:
+                pass
+        elif self.columns==None and ',' in line:
+            self.columns = ColumnNames( line )
+
+
+    # Rows with t0 <= time <= t1 (seconds since the start of the run, first column), as a dictionary of columns.
+    # Either limit can be None. If columns is given, only these columns are returned.
+    def Read( self, t0=None, t1=None, columns=None ):
+        self.Refresh()
+        if self.columns==None:
+            raise ValueError( '%s: no header with column names' % self.filename )
+
+        names = columns if columns!=None else self.columns
+        for c in names:
+            if c not in self.columns:
+                raise KeyError( '%s: no column %s' % ( self.filename, c ) )
+        select = [ self.columns.index( c ) for c in names ]
+
+        lo = float('-inf') if t0==None else t0
+        hi = float('inf') if t1==None else t1
+
+        # Contiguous ranges of bytes covering the blocks that overlap the time range.
+        ranges = []
+        for offset, end, tmin, tmax in self.blocks:
+            if tmax<lo or tmin>hi:
+                continue
+            if ranges and ranges[-1][1]==offset:
+                ranges[-1][1] = end
+            else:
+                ranges.append( [ offset, end ] )
+
+        n = len( self.columns )
+        data = [ [] for c in names ]
+        compressed = Archive.Compressed( self.filename )
+        with Archive.Open( self.filename ) as f:
+            pos = 0
+            for offset, end in ranges:
+                if compressed:
+                    Skip( f, offset-pos )
+                else:
+                    f.seek( offset )
+                pos = end
+                for line in f.read( end-offset ).splitlines():
+                    if line.startswith( b'#' ):
+                        continue
+                    fields = line.split( b',' )
+                    if len( fields )!=n:
+                        continue
+                    try:
+                        t = float( fields[0] )
+                        if t<lo or t>hi:
+                            continue
+                        values = [ float( fields[i] ) for i in select ]
+                    except ValueError:
+                        continue
+                    for column, v in zip( data, values ):
+                        column.append( v )
+
+        if numpy is not None:
+            data = [ numpy.array( column ) for column in data ]
+        return dict( zip( names, data ) )
+
+
+# The segments of an output file (see --segment-size of LeidenLogger), read as one file. Since all segments of a run
+# have the timestamp of its start, their times can be joined as they are. The columns are those of the last segment;
+# segments with other columns (the temperatures before the channels were changed) are skipped.
+class SegmentReader( object ):
+
+    def __init__( self, filenames=(), **options ):
+        self.options = options
+        self.readers = {}
+        self.filenames = []
+        self.Update( filenames )
+
+
+    # Set the list of segments, in order. A segment may be given by its plain name after it has been compressed.
+    def Update( self, filenames ):
+        self.filenames = list( filenames )
+        for name in self.filenames:
+            actual = Archive.Find( name )
+            reader = self.readers.get( name )
+            if actual!=None and ( reader==None or reader.filename!=actual ):
+                self.readers[ name ] = LogReader( actual, **self.options )
+
+
+    def Readers( self ):
+        return [ self.readers[n] for n in self.filenames if n in self.readers ]
+
+
+    @property
+    def start( self ):
+        readers = self.Readers()
+        return readers[0].start if readers else None
+
+
+    @property
+    def columns( self ):
+        readers = self.Readers()
+        return readers[-1].columns if readers else None
+
+
+    # Rows of all segments, as LogReader.Read.
+    def Read( self, t0=None, t1=None, columns=None ):
+        readers = self.Readers()
+        if not readers:
+            raise ValueError( 'no segment found' )
+        readers[-1].Refresh()
+        last = readers[-1].columns
+        if last==None:
+            raise ValueError( '%s: no header with column names' % readers[-1].filename )
+
+        names = columns if columns!=None else last
+        parts = [ r.Read( t0, t1, names ) for r in readers if r.columns==last ]
+        if numpy is not None:
+            return { c : numpy.concatenate( [ p[c] for p in parts ] ) for c in names }
+        return { c : [ v for p in parts for v in p[c] ] for c in names }
@@ -0,0 +1,232 @@
+# HTTP server exporting the state of LeidenLogger for monitoring.
+
+# The server runs in a background thread of LeidenLogger and answers from the in-memory state of the logger,
+# so a request never causes any traffic on the serial ports. The following pages are available:
+#     /metrics       Prometheus text exposition format (version 0.0.4), for scraping by Prometheus and compatible systems
+#     /status.json   the same state as a JSON document
+#     /history       rows of an output file within a time range, read with LogReader (see RenderHistory)
+# Additional pages can be registered by adding a function to the routes dictionary of the server.
+# A route function receives the parsed query string and returns a tuple (content type, body).
+
+import json
+import time
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Escape a label value for the exposition format.
+def Escape( v ):
+    return str(v).replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')
+
+
+# Helper collecting the lines of the exposition format, one metric family at a time.
+class MetricWriter( object ):
+
+    def __init__( self ):
+        self.lines = []
+
+    # Start a metric family with its help text and type (gauge, counter or histogram).
+    def Family( self, name, kind, help ):
+        self.lines.append( '# HELP %s %s' % ( name, help ) )
+        self.lines.append( '# TYPE %s %s' % ( name, kind ) )
+
+    # One sample. Samples with value None are skipped.
+    def Sample( self, name, value, **labels ):
+        if value==None:
+            return
+        if labels:
+            name += '{' + ','.join( '%s="%s"' % ( k, Escape(v) ) for k,v in labels.items() ) + '}'
+        self.lines.append( '%s %s' % ( name, repr( float(value) ) ) )
+
+    def Text( self ):
+        return '\n'.join( self.lines ) + '\n'
+
+
+# Render the snapshot of LeidenLogger (see LeidenLogger.Snapshot) in the exposition format.
+def RenderMetrics( snap ):
+    m = MetricWriter()
+
+    m.Family( 'leiden_temperature_kelvin', 'gauge', 'Latest temperature read from the LakeShore controller.' )
+    for ch, r in snap['temperature'].items():
+        m.Sample( 'leiden_temperature_kelvin', r['kelvin'], channel=ch )
+
+    m.Family( 'leiden_resistance_ohms', 'gauge', 'Latest thermometer resistance read from the LakeShore controller.' )
+    for ch, r in snap['temperature'].items():
+        m.Sample( 'leiden_resistance_ohms', r['ohm'], channel=ch )
+
+    m.Family( 'leiden_temperature_std_kelvin', 'gauge', 'Standard deviation of the averaged temperature readings (with --sem or --budget).' )
+    for ch, r in snap['temperature'].items():
+        m.Sample( 'leiden_temperature_std_kelvin', r.get('kelvin_std'), channel=ch )
+
+    m.Family( 'leiden_temperature_timestamp_seconds', 'gauge', 'Unix time of the latest temperature reading.' )
+    for ch, r in snap['temperature'].items():
+        m.Sample( 'leiden_temperature_timestamp_seconds', r['time'], channel=ch )
+
+    m.Family( 'leiden_pressure_mbar', 'gauge', 'Latest pressure read from the Pfeiffer gauge controller.' )
+    for n, (gauge, p) in enumerate( snap['pressure'].items() ):
+        m.Sample( 'leiden_pressure_mbar', p, channel=n+1, gauge=gauge )
+
+    m.Family( 'leiden_liquid_level_cm', 'gauge', 'Latest cryogen level read from the CryoMagnetics level meter.' )
+    for name, lev in snap['liquid_level'].items():
+        m.Sample( 'leiden_liquid_level_cm', lev, cryogen=name )
+
+    forecast = snap.get( 'lhe_forecast' ) or {}
+    m.Family( 'leiden_lhe_rate_cm_per_hour', 'gauge', 'Fitted rate of change of the liquid helium level (negative while boiling off).' )
+    m.Sample( 'leiden_lhe_rate_cm_per_hour', forecast.get('rate') )
+
+    m.Family( 'leiden_lhe_time_to_threshold_seconds', 'gauge', 'Forecast time until the liquid helium level reaches --lhe-threshold.' )
+    m.Sample( 'leiden_lhe_time_to_threshold_seconds', forecast.get('time_to_threshold') )
+
+    m.Family( 'leiden_lhe_time_to_empty_seconds', 'gauge', 'Forecast time until the liquid helium level reaches zero.' )
+    m.Sample( 'leiden_lhe_time_to_empty_seconds', forecast.get('time_to_empty') )
+
+    m.Family( 'leiden_alarm_active', 'gauge', '1 while the alarm rule is active (with --alarms).' )
+    for name, active in snap.get( 'alarms', {} ).items():
+        m.Sample( 'leiden_alarm_active', int( active ), alarm=name )
+
+    m.Family( 'leiden_last_update_timestamp_seconds', 'gauge', 'Unix time of the latest reading of each stream.' )
+    for stream, t in snap['updated'].items():
+        m.Sample( 'leiden_last_update_timestamp_seconds', t, stream=stream )
+
+    m.Family( 'leiden_device_up', 'gauge', '1 while the device is connected, 0 while it is being reconnected.' )
+    for name, d in snap.get( 'devices', {} ).items():
+        m.Sample( 'leiden_device_up', int( d['up'] ), device=name )
+
+    m.Family( 'leiden_device_failures_total', 'counter', 'Failures of the device and of the attempts to reopen it.' )
+    for name, d in snap.get( 'devices', {} ).items():
+        m.Sample( 'leiden_device_failures_total', d['failures'], device=name )
+
+    health = snap['health']
+
+    m.Family( 'leiden_samples_total', 'counter', 'Number of readings taken from each device.' )
+    for stream, n in health['samples'].items():
+        m.Sample( 'leiden_samples_total', n, stream=stream )
+
+    m.Family( 'leiden_scan_duration_seconds', 'gauge', 'Duration of the last complete LakeShore scan over all enabled channels.' )
+    m.Sample( 'leiden_scan_duration_seconds', health['scan_duration'] )
+
+    m.Family( 'leiden_loop_lag_seconds', 'gauge', 'Delay of the last iteration of the acquisition loop beyond its nominal period.' )
+    m.Sample( 'leiden_loop_lag_seconds', health['loop_lag'] )
+
+    m.Family( 'leiden_loop_lag_max_seconds', 'gauge', 'Largest delay of the acquisition loop since start.' )
+    m.Sample( 'leiden_loop_lag_max_seconds', health['loop_lag_max'] )
+
+    m.Family( 'leiden_autoscan', 'gauge', '1 if the LakeShore is scanned automatically, 0 during manual operation.' )
+    m.Sample( 'leiden_autoscan', int( health['autoscan'] ) )
+
+    m.Family( 'leiden_uptime_seconds', 'gauge', 'Time since the logger started acquisition.' )
+    m.Sample( 'leiden_uptime_seconds', snap['uptime'] )
+
+    # Serial transaction statistics by device and command.
+    serial = snap['serial']
+    for name, kind, key, help in [ ( 'leiden_serial_transactions_total', 'counter', 'count', 'Commands sent to the device.' ),
+                                   ( 'leiden_serial_retries_total', 'counter', 'retries', 'Commands retried by the driver.' ),
+                                   ( 'leiden_serial_timeouts_total', 'counter', 'timeouts', 'Reads that ended on timeout instead of the terminator.' ),
+                                   ( 'leiden_serial_partial_frames_total', 'counter', 'partial', 'Reads that timed out after receiving an incomplete frame.' ) ]:
+        m.Family( name, kind, help )
+        for dev, s in serial.items():
+            for cmd, c in s['commands'].items():
+                m.Sample( name, c[key], device=dev, command=cmd )
+
+    m.Family( 'leiden_serial_sleep_seconds_total', 'counter', 'Time spent in fixed waits of the drivers.' )
+    for dev, s in serial.items():
+        m.Sample( 'leiden_serial_sleep_seconds_total', s['sleep'], device=dev )
+
+    m.Family( 'leiden_serial_read_seconds', 'histogram', 'Latency of serial reads.' )
+    for dev, s in serial.items():
+        for cmd, c in s['commands'].items():
+            for bound, n in c['buckets']:
+                m.Sample( 'leiden_serial_read_seconds_bucket', n, device=dev, command=cmd, le=repr(bound) )
+            m.Sample( 'leiden_serial_read_seconds_bucket', c['reads'], device=dev, command=cmd, le='+Inf' )
+            m.Sample( 'leiden_serial_read_seconds_sum', c['latency_sum'], device=dev, command=cmd )
+            m.Sample( 'leiden_serial_read_seconds_count', c['reads'], device=dev, command=cmd )
+
+    return m.Text()
+
+
+# Index of the output file of LeidenLogger for each stream of /history.
+HistoryStreams = { 'temperature' : 0, 'pressure' : 1, 'level' : 2 }
+
+
+# Rows of an output file of the logger as a JSON document with the start time of the run and the columns.
+# Query parameters: stream (temperature, pressure or level), t0 and t1 in seconds since the start of the run
+# (by default the last hour), and columns as a comma-separated list of names (by default all).
+# If the files are rotated, the rows are read from all segments of the run, including the compressed ones.
+# readers holds the SegmentReader of each stream between requests.
+def RenderHistory( logger, readers, query ):
+    stream = query.get( 'stream', ['temperature'] )[0]
+    if stream not in HistoryStreams:
+        raise ValueError( 'unknown stream %s' % stream )
+
+    segments = list( logger.Segments[ HistoryStreams[stream] ] )
+    if not segments:
+        raise ValueError( 'stream %s is not recorded to a file' % stream )
+    if stream not in readers:
+        import LogReader
+        readers[ stream ] = LogReader.SegmentReader()
+    reader = readers[ stream ]
+    reader.Update( segments )
+
+    t0 = float( query['t0'][0] ) if 't0' in query else None
+    t1 = float( query['t1'][0] ) if 't1' in query else None
+    if t0==None and t1==None and reader.start!=None:
+        t0 = time.time()-reader.start-3600
+    columns = query['columns'][0].split(',') if 'columns' in query else None
+
+    data = reader.Read( t0, t1, columns )
+    data = { name : ( c.tolist() if hasattr( c, 'tolist' ) else c ) for name, c in data.items() }
+    return json.dumps( { 'stream' : stream, 'file' : segments[-1], 'segments' : len( segments ), 'start' : reader.start, 'columns' : data } )
+
+
+# Request handler dispatching to the routes of the server.
+class Handler( BaseHTTPRequestHandler ):
+
+    def do_GET( self ):
+        url = urllib.parse.urlparse( self.path )
+        route = self.server.routes.get( url.path )
+
+        if route==None:
+            self.send_error( 404 )
+            return
+
+        try:
+            ctype, body = route( urllib.parse.parse_qs( url.query ) )
+        except Exception as e:
+            self.send_error( 500, explain=str(e) )
+            return
+
+        body = body.encode('utf-8')
+        self.send_response( 200 )
+        self.send_header( 'Content-Type', ctype )
+        self.send_header( 'Content-Length', str(len(body)) )
+        self.end_headers()
+        self.wfile.write( body )
+
+    # Do not print a line for every request.
+    def log_message( self, format, *args ):
+        pass
+
+
+# Start the server on the specified port in a daemon thread and return it.
+# The logger object must provide Snapshot() and the list of output files. Call shutdown() on the returned server to stop it.
+def StartServer( logger, port, host='' ):
+    server = ThreadingHTTPServer( (host, port), Handler )
+    server.daemon_threads = True
+
+    # Requests are handled in parallel, but the readers of /history are shared.
+    readers = {}
+    lock = threading.Lock()
+    def History( q ):
+        with lock:
+            return ( 'application/json', RenderHistory( logger, readers, q ) )
+
+    server.routes = {
+        '/metrics' : lambda q : ( 'text/plain; version=0.0.4; charset=utf-8', RenderMetrics( logger.Snapshot() ) ),
+        '/status.json' : lambda q : ( 'application/json', json.dumps( logger.Snapshot() ) ),
+        '/history' : History,
+    }
+
+    thread = threading.Thread( target=server.serve_forever, name='MetricsServer', daemon=True )
+    thread.start()
+    return server
@@ -40,11 +40,16 @@ class PfeifferGauge( SerialDevice ):
         self.log("# Created Pfeiffer TPG366 gauge controller.", "Max. number of channel:", self.MaxChannel )
 
         
+    # Keep the warning flag of the previous connection, so that a known faulty channel is not reported again.
+    def TakeOver(self, old):
+        SerialDevice.TakeOver( self, old )
+        self.warning = old.warning
+
+        
     # TPG366 uses a slightly different flowcontrol.
     # Everytime a command is sent, the device will send back either acknowledgement or negative acknowledgement
     def getAck(self):
         repl = self.read( '\r\n', size=256 )
-        repl = repl.replace('\r','').replace('\n','')
         if repl==self.char_ack:
             return True
         else:
@@ -55,6 +60,32 @@ class PfeifferGauge( SerialDevice ):
     # Enquiry
     def query(self):
         self.write('\x05')
+    
+    
+    # Read the reply to an enquiry. The gauge controller sends NAK+\r\n after the main message.
+    # The full reply of PRx takes longer than the timeout to transmit, so reads that time out are repeated;
+    # a truncated line stays in the receive buffer and is completed by the next read (see SerialDevice.read).
+    # Returns the message without NAK, or None if NAK was not received.
+    def ReadReply(self, key):
+        reply = ''
+        for i in range( 1, self.MaxAttempt+1 ):
+            line = self.read( '\r\n', size=256 )
+            if self.status in ('partial','timeout'):
+                self.stats.Retry( key+' ENQ' )
+                continue
+            if self.status!='complete':
+                return None
+            if line.endswith( self.char_nak ):
+                return reply + line[:-1]
+            reply += line
+        return None
+    
+    
+    # The data read after an enquiry is recorded under the command it answers, e.g. 'PRx ENQ'.
+    def CommandKey(self, msg):
+        if msg.startswith( self.char_enq ):
+            return '%s ENQ' % self.stats.current
+        return SerialDevice.CommandKey(self, msg)
         
     
     # Send command until acknowledged
@@ -71,6 +102,7 @@ class PfeifferGauge( SerialDevice ):
                 return True
             
             self.log("# Attempt %d to send command %s" %(i, cmd) )
+            self.stats.Retry( self.CommandKey(cmd) )
             self.reset_input()
             self.write(cmd)
     
@@ -89,8 +121,8 @@ class PfeifferGauge( SerialDevice ):
             self.query()
             
             # For some reason, the gauge controller appends NAK+\r\n after the main message.
-            resp = self.read('\x15\r\n', size=256).replace(self.char_nak,'').replace('\r','').replace('\n','')
-            if len(resp)>5:
+            resp = self.ReadReply( cmd )
+            if resp!=None and len(resp)>5:
                 stat = resp.split(',')[0]
                 pres = resp.split(',')[1]
                 if stat=='0':
@@ -108,34 +140,27 @@ class PfeifferGauge( SerialDevice ):
             
     # Read pressure from all channels from the gauge.
     # Note that TPG366 sometimes truncates the message
-    # In such cases, read again and add them together to form the response.
+    # In such cases, read again and add them together to form the response (see ReadReply).
     def ReadPressure( self ):
         
         for h in range( 1, self.MaxAttempt+1):
             
+            if h>1:
+                self.stats.Retry('PRx')
+                self.reset_input()
+            
             self.write_until_ack('PRx')
             self.query()
             
             # It seems NAK will always follow the response. So read until one receives NAK
-            repl = self.read('\r\n', size=256)
-            
-            # If on the first read, message is broken and NAK is not received, then repeat to get the whole message.
-            if repl.find( self.char_nak ) < 0:
-                
-                for i in range( 1, self.MaxAttempt+1):
-                    
-                    #self.log( '# readPressure response not containing NAK symbol. Appending another readline' )
-                    repl += self.read('\r\n', size=256)
-                    if repl.find( self.char_nak ) >= 0:
-                        break
-            
-            # Remove the meta-characters from the message string.
-            # If message is longer than 0, then it's a valid message, so return.
-            # If not, then repeat the above process.
-            result = repl.replace(self.char_nak,'').replace('\r','').replace('\n','')
-            if repl.find( self.char_nak ) >= 0:
+            # If NAK is not received, then repeat the above process.
+            result = self.ReadReply('PRx')
+            if result!=None:
                 break
         
+        if result==None:
+            raise IOError( 'no reply from TPG gauge to PRx after %d attempts' % self.MaxAttempt )
+        
         pres = [ float(v) for i,v in enumerate(result.split(',')) if i%2==1 ]
         stat = [ v for i,v in enumerate(result.split(',')) if i%2==0 ]
         
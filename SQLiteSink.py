@@ -0,0 +1,98 @@
+# SQLite database of the readings of LeidenLogger, written alongside or instead of the text files.
+
+# There is one narrow table per stream, with the Unix time of each reading:
+#     temperature ( time, channel, kelvin, ohm )
+#     pressure    ( time, gauge, mbar )
+#     level       ( time, cryogen, cm )
+# and indexes on time and on ( channel/gauge/cryogen, time ), so that time ranges of one or all channels can be
+# selected and the streams joined on time, e.g.
+#     SELECT p.time, p.mbar, t.kelvin FROM pressure p JOIN temperature t ON t.channel=16 AND t.time BETWEEN p.time-60 AND p.time
+#     WHERE p.gauge='IVC' AND p.time > strftime('%s','now')-86400;
+# The database is in WAL mode, so other programs can query it while the logger is writing.
+# Readings are buffered and inserted in one transaction once batch rows are pending or interval seconds have passed.
+# Update() is called regularly by the logger, so that buffered readings are inserted even if no further reading arrives.
+# Missing values (nan) are stored as NULL.
+
+import time
+import sqlite3
+
+
+Schema = """
+CREATE TABLE IF NOT EXISTS temperature ( time REAL NOT NULL, channel INTEGER NOT NULL, kelvin REAL, ohm REAL );
+CREATE INDEX IF NOT EXISTS temperature_time ON temperature ( time );
+CREATE INDEX IF NOT EXISTS temperature_channel_time ON temperature ( channel, time );
+
+CREATE TABLE IF NOT EXISTS pressure ( time REAL NOT NULL, gauge TEXT NOT NULL, mbar REAL );
+CREATE INDEX IF NOT EXISTS pressure_time ON pressure ( time );
+CREATE INDEX IF NOT EXISTS pressure_gauge_time ON pressure ( gauge, time );
+
+CREATE TABLE IF NOT EXISTS level ( time REAL NOT NULL, cryogen TEXT NOT NULL, cm REAL );
+CREATE INDEX IF NOT EXISTS level_time ON level ( time );
+CREATE INDEX IF NOT EXISTS level_cryogen_time ON level ( cryogen, time );
+"""
+
+
+class SQLiteSink( object ):
+
+    def __init__( self, filename, batch=1000, interval=10. ):
+        self.filename = filename
+        self.batch = batch
+        self.interval = interval
+
+        self.db = sqlite3.connect( filename )
+        self.db.execute( 'PRAGMA journal_mode=WAL' )
+        self.db.execute( 'PRAGMA synchronous=NORMAL' )
+        self.db.executescript( Schema )
+
+        # Rows waiting to be inserted, by table.
+        self.pending = { 'temperature' : [], 'pressure' : [], 'level' : [] }
+        self.npending = 0
+        self.committed = time.time()
+
+
+    def Temperature( self, t, channel, kelvin, ohm ):
+        self.Add( 'temperature', ( t, int(channel), kelvin, ohm ) )
+
+
+    # Pressures of several gauges read at the same time, as lists of names and values.
+    def Pressure( self, t, gauges, values ):
+        for g, p in zip( gauges, values ):
+            self.Add( 'pressure', ( t, g, p ) )
+
+
+    def Level( self, t, cryogens, values ):
+        for c, v in zip( cryogens, values ):
+            self.Add( 'level', ( t, c, v ) )
+
+
+    def Add( self, table, row ):
+        self.pending[ table ].append( row )
+        self.npending += 1
+        if self.npending >= self.batch or time.time()-self.committed >= self.interval:
+            self.Flush()
+
+
+    # Insert the pending rows if interval seconds have passed since the last insert.
+    def Update( self ):
+        if self.npending and time.time()-self.committed >= self.interval:
+            self.Flush()
+
+
+    # Insert the pending rows in one transaction.
+    def Flush( self ):
+        self.committed = time.time()
+        if self.npending==0:
+            return
+        with self.db:
+            for table, rows in self.pending.items():
+                if rows:
+                    self.db.executemany( 'INSERT INTO %s VALUES (%s)' % ( table, ','.join( '?'*len(rows[0]) ) ), rows )
+                    rows.clear()
+        self.npending = 0
+
+
+    def Close( self ):
+        if self.db:
+            self.Flush()
+            self.db.close()
+            self.db = None
@@ -0,0 +1,456 @@
+# Broker process that owns the serial ports and shares them between several programs.
+
+# Normally each program opens its serial ports directly, so LeidenLogger and LeidenSequencer cannot use the
+# LakeShore controller at the same time. When the broker is running, the programs send their commands to the
+# broker instead (option --broker of LeidenLogger and LeidenSequencer), and the broker
+#   1) serializes the transactions on each port, serving the waiting requests in order of priority,
+#   2) answers identical queries waiting at the same time (e.g. SCAN? from two clients) with a single transaction,
+#   3) lets a client reserve a port for a sequence of transactions (e.g. switch scanner, settle, read),
+#   4) broadcasts every transaction to all subscribers, so that readings requested by one program
+#      are recorded by the others as well.
+
+# The broker listens on localhost TCP (default port 50372) and speaks JSON, one message per line.
+# Requests are {"op": ..., ...} and every request is answered by one line, {"ok": true, ...} or {"error": "..."}:
+#     open      port, term, params      open the port (if not yet open) with the serial parameters
+#     xfer      port, data, prio        write data and return all reply frames until the line is quiet
+#     read      port, prio              read one more frame
+#     reset     port, prio              clear the input buffer of the port
+#     lock      port, prio, block, ttl  reserve the port: commands of other clients starting with one of the
+#                                       prefixes in block (all commands if block is null) are held back until
+#                                       unlock or until ttl seconds have elapsed
+#     unlock    port
+#     subscribe                         from now on, the connection receives one line per transaction:
+#                                       {"port", "cmd", "reply", "client", "time"}
+
+# Start the broker with:
+#     python SerialBroker.py [--listen port]
+# On the client side, SerialDevice opens ports named broker/<port> through BrokerConnection below.
+
+import sys
+import json
+import time
+import socket
+import getopt
+import threading
+import socketserver
+
+
+# Address of the broker used by BrokerConnection, and priority of the requests of this process.
+# Lower numbers are served first. Programs change these from their commandline options.
+address = ('localhost', 50372)
+priority = 10
+
+
+# A request waiting to be executed by a port worker.
+class Request( object ):
+
+    def __init__( self, op, client, prio, seq, **args ):
+        self.op = op
+        self.client = client
+        self.prio = prio
+        self.seq = seq
+        self.args = args
+        self.reply = None
+        self.error = None
+        self.done = threading.Event()
+
+
+
+# Thread owning one serial port. Requests are queued and executed one at a time.
+class PortWorker( threading.Thread ):
+
+    # Maximum number of frames collected for one transaction, in case a device keeps talking.
+    MaxFrames = 16
+
+    def __init__( self, broker, name, connection, term ):
+        threading.Thread.__init__( self, name='port '+name, daemon=True )
+        self.broker = broker
+        self.name = name
+        self.connection = connection
+        self.term = term.encode('ascii')
+
+        self.queue = []
+        self.cond = threading.Condition()
+        self.seq = 0
+
+        # Client holding the reservation, prefixes of the commands held back and the expiry time.
+        self.owner = None
+        self.block = None
+        self.expiry = 0
+
+
+    # Queue a request and wait for its execution.
+    def Submit( self, op, client, prio, **args ):
+        with self.cond:
+            self.seq += 1
+            req = Request( op, client, prio, self.seq, **args )
+            self.queue.append( req )
+            self.cond.notify_all()
+        req.done.wait()
+        if req.error:
+            raise IOError( req.error )
+        return req.reply
+
+
+    # If the port is reserved, only the owner and commands not held back may proceed.
+    def Eligible( self, req ):
+        if self.owner==None or req.client==self.owner:
+            return True
+        if self.expiry<time.time():
+            self.owner = None
+            return True
+        if req.op=='lock':
+            return False
+        if self.block==None:
+            return False
+        data = req.args.get('data','')
+        return req.op=='xfer' and not any( data.startswith(b) for b in self.block )
+
+
+    # Take the eligible request with the highest priority (lowest number, then first come).
+    def Next( self ):
+        with self.cond:
+            while True:
+                eligible = [ r for r in self.queue if self.Eligible(r) ]
+                if eligible:
+                    req = min( eligible, key=lambda r : (r.prio, r.seq) )
+                    self.queue.remove( req )
+                    return req
+                self.cond.wait( timeout = max( 0.01, self.expiry-time.time() ) if self.owner!=None else None )
+
+
+    # Other queued requests for exactly the same query. They are answered by the same transaction.
+    def Identical( self, req ):
+        with self.cond:
+            same = [ r for r in self.queue if r.op=='xfer' and r.args['data']==req.args['data'] and self.Eligible(r) ]
+            for r in same:
+                self.queue.remove( r )
+            return same
+
+
+    # Read frames until the line is quiet (a read returns nothing within the timeout).
+    def ReadFrames( self, nmax ):
+        frames = []
+        for i in range( nmax ):
+            f = self.connection.read_until( self.term )
+            if not f:
+                break
+            frames.append( f )
+        return b''.join( frames ).decode('latin-1')
+
+
+    def run( self ):
+        while True:
+            req = self.Next()
+            group = [ req ]
+            try:
+                if req.op=='xfer':
+                    data = req.args['data']
+                    if '?' in data:
+                        group += self.Identical( req )
+                    self.connection.write( data.encode('latin-1') )
+                    req.reply = self.ReadFrames( self.MaxFrames )
+                    self.broker.Publish( { 'port' : self.name, 'cmd' : data, 'reply' : req.reply, 'client' : req.client, 'time' : time.time() } )
+
+                elif req.op=='read':
+                    req.reply = self.ReadFrames( 1 )
+
+                elif req.op=='reset':
+                    self.connection.reset_input_buffer()
+
+                elif req.op=='lock':
+                    with self.cond:
+                        self.owner = req.client
+                        self.block = req.args.get('block')
+                        self.expiry = time.time()+req.args.get('ttl',30)
+
+                elif req.op=='unlock':
+                    with self.cond:
+                        if self.owner==req.client:
+                            self.owner = None
+                        self.cond.notify_all()
+
+            except Exception as e:
+                req.error = '%s: %s' % ( type(e).__name__, e )
+
+            for r in group:
+                r.reply, r.error = req.reply, req.error
+                r.done.set()
+
+
+    # Drop the reservation of a client that disconnected.
+    def Release( self, client ):
+        with self.cond:
+            if self.owner==client:
+                self.owner = None
+                self.cond.notify_all()
+
+
+
+# The broker: port workers by port name and the list of subscribers.
+class Broker( object ):
+
+    def __init__( self ):
+        self.workers = {}
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self.clients = 0
+
+
+    # Open a port, or return the worker if it is already open.
+    def Open( self, port, term, params ):
+        from SerialDevice import OpenConnection
+        with self.lock:
+            if port not in self.workers:
+                if port.startswith('broker/'):
+                    raise IOError( 'broker cannot open port %s' % port )
+                print( '# SerialBroker: opening port', port, params )
+                worker = PortWorker( self, port, OpenConnection( port, term=term, **params ), term )
+                worker.start()
+                self.workers[port] = worker
+            return self.workers[port]
+
+
+    def Worker( self, port ):
+        if port not in self.workers:
+            raise IOError( 'port %s is not open' % port )
+        return self.workers[port]
+
+
+    # Send a transaction to all subscribers. Subscribers that cannot be reached are dropped.
+    def Publish( self, event ):
+        line = ( json.dumps( event )+'\n' ).encode('utf-8')
+        with self.lock:
+            for s in list( self.subscribers ):
+                try:
+                    s.sendall( line )
+                except OSError:
+                    self.subscribers.remove( s )
+
+
+    def NewClient( self ):
+        with self.lock:
+            self.clients += 1
+            return self.clients
+
+
+
+# Connection handler: one thread per client connection.
+class BrokerHandler( socketserver.StreamRequestHandler ):
+
+    def handle( self ):
+        broker = self.server.broker
+        client = broker.NewClient()
+        print( '# SerialBroker: client %d connected from %s' % ( client, self.client_address ) )
+
+        try:
+            for line in self.rfile:
+                msg = json.loads( line )
+                op = msg.get('op')
+                try:
+                    if op=='open':
+                        broker.Open( msg['port'], msg['term'], msg.get('params',{}) )
+                        reply = { 'ok' : True, 'client' : client }
+
+                    elif op=='subscribe':
+                        self.Subscribe()
+                        return
+
+                    elif op in ('xfer','read','reset','lock','unlock'):
+                        worker = broker.Worker( msg['port'] )
+                        args = { k:v for k,v in msg.items() if k in ('data','block','ttl') }
+                        data = worker.Submit( op, client, msg.get('prio',10), **args )
+                        reply = { 'ok' : True, 'reply' : data }
+
+                    else:
+                        reply = { 'error' : 'unknown operation %s' % op }
+
+                except Exception as e:
+                    reply = { 'error' : '%s: %s' % ( type(e).__name__, e ) }
+
+                self.wfile.write( ( json.dumps( reply )+'\n' ).encode('utf-8') )
+
+        except (OSError, ValueError):
+            pass
+
+        finally:
+            for w in list( broker.workers.values() ):
+                w.Release( client )
+            with broker.lock:
+                if self.connection in broker.subscribers:
+                    broker.subscribers.remove( self.connection )
+            print( '# SerialBroker: client %d disconnected' % client )
+
+
+    # Register the connection as subscriber and keep it open until the client disconnects.
+    # The timeout prevents a stalled subscriber from blocking the port workers for long.
+    def Subscribe( self ):
+        self.wfile.write( b'{"ok": true}\n' )
+        self.connection.settimeout( 1 )
+        with self.server.broker.lock:
+            self.server.broker.subscribers.append( self.connection )
+
+        while True:
+            try:
+                if not self.connection.recv( 256 ):
+                    return
+            except socket.timeout:
+                continue
+
+
+class BrokerServer( socketserver.ThreadingTCPServer ):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+
+# Client side: behaves like a pyserial Serial object, but executes every write as a transaction on the broker.
+# The reply frames are kept in a local buffer from which read_until serves the driver.
+class BrokerConnection( object ):
+
+    def __init__( self, port, *, term='\r\n', timeout=0.05, **params ):
+        self.port = port
+        self.term = term
+        self.timeout = timeout
+        self.rxbuf = bytearray()
+        self.lock = threading.Lock()
+
+        self.socket = socket.create_connection( address )
+        self.file = self.socket.makefile( 'rwb' )
+        params['timeout'] = timeout
+        self.client = self.Call( op='open', port=port, term=term, params=params )['client']
+        self.is_open = True
+
+
+    # Send one request and wait for the answer.
+    def Call( self, **msg ):
+        with self.lock:
+            self.file.write( ( json.dumps( msg )+'\n' ).encode('utf-8') )
+            self.file.flush()
+            reply = self.file.readline()
+        if not reply:
+            raise IOError( 'connection to serial broker lost' )
+        reply = json.loads( reply )
+        if 'error' in reply:
+            raise IOError( 'serial broker: '+reply['error'] )
+        return reply
+
+
+    @property
+    def in_waiting( self ):
+        return len( self.rxbuf )
+
+
+    def write( self, data ):
+        reply = self.Call( op='xfer', port=self.port, data=data.decode('latin-1'), prio=priority )['reply']
+        self.rxbuf += reply.encode('latin-1')
+        return len(data)
+
+
+    # Same semantics as pyserial, applied to the local buffer. If the buffer is empty, one more frame is read.
+    def read_until( self, expected=b'\n', size=None ):
+        if not self.rxbuf:
+            self.rxbuf += self.Call( op='read', port=self.port, prio=priority )['reply'].encode('latin-1')
+
+        n = len( self.rxbuf )
+        if isinstance( expected, bytes ) and expected:
+            k = self.rxbuf.find( expected )
+            if k>=0:
+                n = k+len(expected)
+        if size!=None:
+            n = min( n, size )
+
+        line = bytes( self.rxbuf[:n] )
+        del self.rxbuf[:n]
+        return line
+
+
+    def read( self, size=1 ):
+        return self.read_until( None, size )
+
+
+    def reset_input_buffer( self ):
+        self.rxbuf.clear()
+        self.Call( op='reset', port=self.port, prio=priority )
+
+
+    # Reserve the port. Commands of other clients starting with one of the prefixes in block are held back.
+    def Lock( self, block=None, ttl=30 ):
+        self.Call( op='lock', port=self.port, prio=priority, block=block, ttl=ttl )
+
+
+    def Unlock( self ):
+        self.Call( op='unlock', port=self.port, prio=priority )
+
+
+    def close( self ):
+        if self.is_open:
+            self.file.close()
+            self.socket.close()
+            self.is_open = False
+
+
+
+# Client side subscription to the transactions of all clients.
+# Events are collected by a background thread and retrieved with Events().
+class BrokerSubscription( object ):
+
+    def __init__( self ):
+        self.socket = socket.create_connection( address )
+        self.file = self.socket.makefile( 'rwb' )
+        self.file.write( b'{"op": "subscribe"}\n' )
+        self.file.flush()
+        self.file.readline()
+
+        self.events = []
+        self.lock = threading.Lock()
+        self.thread = threading.Thread( target=self.Receive, name='BrokerSubscription', daemon=True )
+        self.thread.start()
+
+
+    def Receive( self ):
+        try:
+            for line in self.file:
+                event = json.loads( line )
+                with self.lock:
+                    self.events.append( event )
+        except (OSError, ValueError):
+            pass
+
+
+    # Return and clear the events received so far.
+    def Events( self ):
+        with self.lock:
+            events, self.events = self.events, []
+        return events
+
+
+    def close( self ):
+        self.socket.close()
+
+
+
+def main():
+    opts, _ = getopt.getopt( sys.argv[1:], "h", ["listen=","help"] )
+
+    port = address[1]
+    for opt, arg in opts:
+        if opt=="--listen":
+            port = int(arg)
+        if opt in ("-h","--help"):
+            print( "usage: "+sys.argv[0]+" [--listen port]\n" )
+            print( "Shares serial ports between LeidenLogger and LeidenSequencer (see --broker option of these programs)." )
+            print( "\t--listen port\t listen on localhost:port (default %d).\n" % address[1] )
+            sys.exit()
+
+    server = BrokerServer( ('localhost', port), BrokerHandler )
+    server.broker = Broker()
+    print( '# SerialBroker: listening on localhost:%d' % port )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print( '# SerialBroker: exiting...' )
+
+
+if __name__ == "__main__":
+    main()
@@ -15,10 +15,32 @@
 import serial
 import sys
 import time
+import contextlib
+
+from DeviceStats import DeviceStats
+import DeviceStats as DeviceStatsModule
+
+
+# Open the connection object for the specified port.
+# Port names of the form sim/<instrument> open a simulated instrument (see SimulatedInstruments.py),
+# port names of the form broker/<port> use the port through the serial broker (see SerialBroker.py),
+# all other names are passed on to pyserial.
+# The termination characters are only needed by the broker, which has to find the end of the replies.
+def OpenConnection( port, term='\r\n', **params ):
+    if port.startswith('sim/'):
+        from SimulatedInstruments import OpenSimulatedPort
+        return OpenSimulatedPort( port[4:], **params )
+    if port.startswith('broker/'):
+        from SerialBroker import BrokerConnection
+        return BrokerConnection( port[7:], term=term, **params )
+    return serial.Serial( port=port, **params )
 
 
 class SerialDevice(object):
 
+    # Largest frame accepted when read() is called without size. Longer frames are discarded.
+    MaxFrame = 4096
+
     # Constructor
     # Use named arguments for configurations with default settings.
     # logs is a list of file objects for recording the output or for debugging
@@ -27,24 +49,35 @@ class SerialDevice(object):
         
         # Attempt to open the serial connection with the default/specified parameters
         self.term = term
-        self.logfiles = logs
+        # Copy the list, since AddLogFile must not modify the default argument shared by all devices.
+        self.logfiles = list( logs )
+        
+        # Counters and latency histograms of the transactions, by command.
+        self.stats = DeviceStats( '%s %s' % ( type(self).__name__, port ) )
+        
+        # Received bytes that are not part of a returned frame yet (see read), and the outcome of the last read.
+        self.buffer = bytearray()
+        self.status = None
         
         print("# Creating SerialDevice at", port)
         
         try:
-            self.connection = serial.Serial(port = port,
-                                            baudrate = baudrate,
-                                            bytesize = bytesize,
-                                            parity = parity,
-                                            stopbits = stopbits,
-                                            timeout = timeout )
+            self.connection = OpenConnection( port,
+                                              term = term,
+                                              baudrate = baudrate,
+                                              bytesize = bytesize,
+                                              parity = parity,
+                                              stopbits = stopbits,
+                                              timeout = timeout )
             # termination characters that should be removed from reply strings or should be appended to strings being sent out.
             
         except serial.SerialException:
             self.log( '# Serial port', port, 'not found.' )
+            DeviceStatsModule.Unregister( self.stats )
             raise
         except:
             self.log( '# Failed to open serial port', port )
+            DeviceStatsModule.Unregister( self.stats )
             raise
         else:
             self.log('# Opened serial port', port )
@@ -61,6 +94,7 @@ class SerialDevice(object):
     
     # Clear the input buffer
     def reset_input(self):
+        self.buffer.clear()
         self.connection.reset_input_buffer()
     
     # Reconfigure the log file to be a single log file
@@ -75,15 +109,81 @@ class SerialDevice(object):
     # Read the serial port
     # Note this function will read the input buffer until the termination character
     # After the read, the delimiter is removed from the line.
+    # Received bytes are collected in self.buffer: whatever arrives after the terminator is kept for the next read,
+    # and the terminator is searched only in the new bytes. All bytes waiting on the port are read at once.
+    # The outcome is left in self.status:
+    #     complete   a frame ending on the terminator was returned,
+    #     partial    some bytes arrived but no terminator within the timeout. They are kept in the buffer, so that
+    #                the next read returns the whole frame if the rest arrives late, and '' is returned meanwhile.
+    #                They are discarded when the next command is written (see write);
+    #     timeout    nothing arrived within the timeout, '' is returned;
+    #     overflow   size bytes (MaxFrame if not specified) arrived without terminator. They are discarded.
+    # A partial frame is therefore never returned as a reply.
     def read(self, char=None, size=None):
-        if char==None:
-            char = self.term
-        response = self.connection.read_until( char, size )
-        response = response.decode('ascii')
-        for c in char:
-            response = response.replace( char,'')
+        term = ( self.term if char==None else char ).encode('ascii')
+        size = size or self.MaxFrame
+        buffer = self.buffer
+        
+        scanned = 0
+        while True:
+            n = buffer.find( term, scanned )
+            if n>=0:
+                response = buffer[:n].decode('ascii')
+                del buffer[:n+len(term)]
+                self.status = 'complete'
+                break
+            
+            if len( buffer )>=size:
+                self.log( '# Discarding %d bytes received without terminator: %r...' % ( len(buffer), bytes(buffer[:32]) ) )
+                buffer.clear()
+                response = ''
+                self.status = 'overflow'
+                break
+            
+            # Only the end of the buffer may contain the beginning of the terminator.
+            scanned = max( 0, len(buffer)-len(term)+1 )
+            
+            # Blocks until at least one byte arrives or the timeout has elapsed.
+            data = self.connection.read( max( 1, self.connection.in_waiting ) )
+            if not data:
+                response = ''
+                self.status = 'partial' if buffer else 'timeout'
+                break
+            buffer += data
+        
+        self.stats.Read( self.status )
         return response
 
+    # Read the reply to the query cmd, or None if it was not received.
+    # Drivers override this if the replies need to be checked, e.g. for an echo of the command.
+    def ReceiveReply(self, cmd):
+        reply = self.read()
+        return reply if self.status=='complete' else None
+    
+    
+    # Pipelined transactions: send all queries back to back, then read their replies in the same order,
+    # so that the device can answer a query while the next one is still being sent, and the batch costs about
+    # one round trip instead of one per query. Each reply is read with ReceiveReply.
+    # Returns the list of replies, with None for the queries that were not answered. After the first query
+    # without answer the input is cleared, and the following queries get None as well, since their replies
+    # could no longer be matched to them reliably. The drivers retry these queries one by one.
+    def Pipeline(self, queries):
+        for q in queries:
+            self.write(q)
+        
+        replies = []
+        for q in queries:
+            if None in replies:
+                replies.append( None )
+                continue
+            self.stats.current = self.CommandKey(q)
+            replies.append( self.ReceiveReply(q) )
+        
+        if None in replies:
+            self.reset_input()
+        return replies
+    
+    
     # Send command through the serial port to the device
     # If wait is specified, function will pause for the specified seconds for proper response.
     def write(self, msg, *, wait=0 ):
@@ -93,8 +193,16 @@ class SerialDevice(object):
         if msg.find( self.term )<0:
             msg += self.term
         
+        # Bytes left in the buffer belong to the reply of an earlier command that was not completed in time.
+        # They are discarded together with the input waiting on the port, so that the rest of that reply
+        # is not returned as the reply to this command.
+        if self.buffer:
+            self.log( '# Discarding %d bytes of an earlier reply: %r' % ( len(self.buffer), bytes(self.buffer[:32]) ) )
+            self.reset_input()
+        
         # Send the command and return the number of bytes written
         reply = self.connection.write( msg.encode('ascii') )
+        self.stats.Write( self.CommandKey( msg ), reply )
         
         self.wait(wait)
 
@@ -103,7 +211,38 @@ class SerialDevice(object):
     # Wait for t seconds
     # Needed when serial device needs time for update.
     def wait(self, t):
+        self.stats.Sleep(t)
         time.sleep(t)
+    
+    
+    # Take over the state of a previous connection to the same device, after the port has been reopened.
+    # The statistics are continued, so that the device appears only once in the reports.
+    def TakeOver(self, old):
+        DeviceStatsModule.Unregister( self.stats )
+        self.stats = old.stats
+        self.logfiles = old.logfiles
+    
+    
+    # Reserve the port for a sequence of transactions that must not be interleaved with other programs.
+    # Commands of other programs starting with one of the prefixes in block (all if None) are held back.
+    # This only has an effect if the port is shared through the serial broker.
+    # The reservation is released by the broker after ttl seconds in case the program hangs.
+    @contextlib.contextmanager
+    def Exclusive(self, block=None, ttl=30):
+        shared = hasattr( self.connection, 'Lock' )
+        if shared:
+            self.connection.Lock( block, ttl )
+        try:
+            yield
+        finally:
+            if shared:
+                self.connection.Unlock()
+    
+    
+    # Key under which the statistics of a command are recorded, e.g. RDGK? for RDGK?05.
+    # Devices can override this to group commands differently.
+    def CommandKey(self, msg):
+        return self.stats.Key(msg)
         
         
     # log some output. This is a wrapper for python's print function except output is printed to all log destinations
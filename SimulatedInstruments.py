@@ -0,0 +1,365 @@
+# Simulated serial instruments for benchmarking and offline development.
+
+# This module implements software stand-ins for the three instruments of the Leiden fridge:
+# the LakeShore 372 temperature controller, the Pfeiffer TPG366 gauge controller and the
+# CryoMagnetics LM-510 liquid level meter.
+# Each simulated port mimics the part of the pyserial Serial interface used by SerialDevice
+# (write, read_until, reset_input_buffer, in_waiting, close, is_open), including the
+# transmission time at the configured baudrate and the read timeout.
+
+# A simulated port is opened by using sim/<instrument> as the serial port name, e.g.
+#     python LeidenLogger.py --port sim/lakeshore:sim/pfeiffer:sim/cryomag ...
+
+# Time is taken from a clock object. By default it is the wall clock, but a VirtualClock can be
+# installed so that days of fridge operation can be simulated in seconds (see benchmark.py).
+
+import math
+import random
+import time
+
+
+# Raised by VirtualClock when the end of the simulated period has been reached.
+# Derived from BaseException like KeyboardInterrupt, so that it is not caught by the device supervision of LeidenLogger.
+class SimulationFinished( BaseException ):
+    pass
+
+
+# Wall clock: time passes for real.
+class WallClock( object ):
+
+    def time( self ):
+        return time.time()
+
+    def sleep( self, t ):
+        if t>0:
+            time.sleep( t )
+
+    def strftime( self, fmt ):
+        return time.strftime( fmt )
+
+
+# Virtual clock: sleeping only advances the simulated time.
+# If stop is specified, SimulationFinished is raised once the simulated time passes it.
+class VirtualClock( object ):
+
+    def __init__( self, start=None, stop=None ):
+        self.now = time.time() if start==None else start
+        self.stop = stop
+
+    def time( self ):
+        return self.now
+
+    def sleep( self, t ):
+        if t>0:
+            self.now += t
+        if self.stop!=None and self.now>self.stop:
+            raise SimulationFinished()
+
+    def strftime( self, fmt ):
+        return time.strftime( fmt, time.localtime( self.now ) )
+
+
+# Clock used by newly created ports. Replace it before opening ports to run in virtual time.
+clock = WallClock()
+
+
+# Base class of the simulated ports.
+# Derived classes implement Respond(), which receives one complete command line
+# and returns the reply string (possibly empty).
+class SimulatedPort( object ):
+
+    # Termination of the command lines received from the host.
+    term = '\r\n'
+
+    # Default parameters common to all instruments. Latency is the processing time of the instrument.
+    def __init__( self, *, baudrate=9600, bytesize=8, parity='N', stopbits=1, timeout=0.05, latency=0.005 ):
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.term = self.term.encode('ascii')
+        self.latency = latency
+        self.clock = clock
+
+        # Time to transmit one byte: start bit, data bits, parity and stop bits.
+        self.byte_time = ( 1 + bytesize + ( 0 if parity=='N' else 1 ) + stopbits ) / baudrate
+
+        # Bytes received from the host but not yet terminated, bytes ready for the host,
+        # and replies still in transit as a list of [time of arrival, bytes]
+        self.txbuf = bytearray()
+        self.rxbuf = bytearray()
+        self.pending = []
+
+        # Number of commands received, by command mnemonic.
+        self.counts = {}
+
+        # Wall time at which the last reply became available. Used to measure reading-to-file latency.
+        self.last_reply = 0
+
+        self.is_open = True
+
+
+    # Move the replies that have arrived by now into the receive buffer.
+    def Deliver( self ):
+        now = self.clock.time()
+        while self.pending and self.pending[0][0]<=now:
+            self.rxbuf += self.pending.pop(0)[1]
+
+
+    # Number of bytes that can be read without waiting.
+    @property
+    def in_waiting( self ):
+        self.Deliver()
+        return len( self.rxbuf )
+
+
+    # Receive bytes from the host. Every complete command line is answered by the instrument.
+    def write( self, data ):
+        self.txbuf += data
+        self.clock.sleep( len(data)*self.byte_time )
+
+        while True:
+            n = self.txbuf.find( self.term )
+            if n<0:
+                break
+            cmd = self.txbuf[:n].decode('ascii')
+            del self.txbuf[:n+len(self.term)]
+
+            reply = self.Respond( cmd )
+            if reply:
+                start = max( [self.clock.time()]+[p[0] for p in self.pending] ) + self.latency
+                self.pending.append( [ start+len(reply)*self.byte_time, reply.encode('ascii') ] )
+                self.last_reply = time.perf_counter()
+
+        return len(data)
+
+
+    # Read up to size bytes, blocking until timeout.
+    def read( self, size=1 ):
+        return self.read_until( None, size )
+
+
+    # Same semantics as pyserial: stop at the expected sequence, at size bytes, or when timeout has elapsed.
+    # Note: like pyserial, expected is compared with the received bytes, so a str never matches.
+    def read_until( self, expected=b'\n', size=None ):
+        line = bytearray()
+        deadline = self.clock.time() + self.timeout
+
+        while True:
+            self.Deliver()
+
+            while self.rxbuf:
+                line.append( self.rxbuf.pop(0) )
+                if expected and line[-len(expected):]==expected:
+                    return bytes(line)
+                if size!=None and len(line)>=size:
+                    return bytes(line)
+
+            now = self.clock.time()
+            if now>=deadline:
+                return bytes(line)
+
+            if self.pending:
+                self.clock.sleep( min( self.pending[0][0], deadline )-now )
+            else:
+                self.clock.sleep( deadline-now )
+
+
+    # Discard the bytes that have already been received.
+    def reset_input_buffer( self ):
+        self.Deliver()
+        self.rxbuf.clear()
+
+
+    def close( self ):
+        self.is_open = False
+
+
+    # Count one command for the statistics
+    def Count( self, key ):
+        self.counts[key] = self.counts.get(key,0)+1
+
+
+    def Respond( self, cmd ):
+        return ''
+
+
+
+# LakeShore 372 with 16 scanner channels and a sample heater.
+# Channel n sits at a fixed temperature with relative noise, except the sample channel,
+# which relaxes exponentially towards base + power/conductance when the heater is on.
+class LakeShore372Sim( SimulatedPort ):
+
+    def __init__( self, **params ):
+        SimulatedPort.__init__( self, **params )
+
+        self.channel = 1
+        self.noise = 1e-3
+        self.base = { ch : 0.01 * 2**(ch/2) for ch in range(1,17) }
+
+        self.sample = 16
+        self.conductance = 1e-6
+        self.tau = 600
+        self.sample_start = self.base[ self.sample ]
+        self.sample_target = self.base[ self.sample ]
+        self.heater_time = self.clock.time()
+
+        self.heater_resistance = 10.0
+        self.heater_range = '0'
+        self.heater_power = 0.0
+
+        # Calibration curve 21 (log Ohm/K) is assigned to every channel: 150 breakpoints from 5 mK to 40 K.
+        self.curve = 21
+        kelvin = [ 0.005 * 8000**(i/149.) for i in range(150) ]
+        self.curve_points = [ ( math.log10( self.Ohm(T) ), T ) for T in reversed( kelvin ) ]
+
+
+    # Present temperature of a channel in Kelvin.
+    def Kelvin( self, ch ):
+        if ch==self.sample:
+            dt = self.clock.time()-self.heater_time
+            T = self.sample_target + (self.sample_start-self.sample_target)*math.exp( -dt/self.tau )
+        else:
+            T = self.base[ch]
+        return T * ( 1+random.gauss( 0, self.noise ) )
+
+
+    # Resistance of a generic NTC thermometer at temperature T.
+    def Ohm( self, T ):
+        return 1000. * math.exp( 2.0/T**0.5 )
+
+
+    def Respond( self, cmd ):
+        mnemonic = cmd.split(' ')[0].split('?')[0]+( '?' if '?' in cmd else '' )
+        self.Count( mnemonic )
+
+        if cmd=='SCAN?':
+            return '%02d,0\r\n' % self.channel
+
+        elif cmd.startswith('SCAN '):
+            self.channel = int( cmd[5:].split(',')[0] )
+
+        elif cmd.startswith('RDGK?'):
+            return '%+.4E\r\n' % self.Kelvin( int(cmd[5:]) )
+
+        elif cmd.startswith('RDGR?'):
+            return '%+.4E\r\n' % self.Ohm( self.Kelvin( int(cmd[5:]) ) )
+
+        elif cmd.startswith('INCRV?'):
+            return '%d\r\n' % self.curve
+
+        elif cmd.startswith('CRVHDR?'):
+            return 'RX-SIM,SIM0001,4,40.000,1\r\n'
+
+        elif cmd.startswith('CRVPT?'):
+            i = int( cmd[6:].split(',')[1] )
+            units, T = self.curve_points[i-1] if i<=len( self.curve_points ) else ( 0., 0. )
+            return '%+.5f,%+.6f,+0.00000\r\n' % ( units, T )
+
+        elif cmd.startswith('HTRSET?'):
+            return '%.3f,0,0,+0.000,2\r\n' % self.heater_resistance
+
+        elif cmd.startswith('HTRSET '):
+            self.heater_resistance = float( cmd[7:].split(',')[1] )
+
+        elif cmd.startswith('RANGE?'):
+            return self.heater_range+'\r\n'
+
+        elif cmd.startswith('RANGE '):
+            self.heater_range = cmd[6:].split(',')[1]
+
+        elif cmd.startswith('MOUT?'):
+            return '%+.4E\r\n' % self.heater_power
+
+        elif cmd.startswith('MOUT '):
+            self.sample_start = self.Kelvin( self.sample )
+            self.heater_time = self.clock.time()
+            self.heater_power = float( cmd[5:].split(',')[1] )
+            self.sample_target = self.base[ self.sample ] + self.heater_power/self.conductance
+
+        return ''
+
+
+
+# Pfeiffer TPG366 with six gauges.
+# Every command is acknowledged, and the data is sent after the enquiry character.
+# As observed on the real controller, the data is followed by NAK + CR LF.
+class TPG366Sim( SimulatedPort ):
+
+    def __init__( self, **params ):
+        SimulatedPort.__init__( self, **params )
+        self.pressure = [ 1e-1, 1e-2, 5e2, 1e1, 1e-6, 1e-3 ]
+        self.mnemonic = ''
+
+
+    def Respond( self, cmd ):
+
+        if cmd=='\x05':
+            self.Count( self.mnemonic )
+
+            # pressures perform a small random walk
+            self.pressure = [ p*( 1+random.gauss( 0, 1e-3 ) ) for p in self.pressure ]
+
+            if self.mnemonic=='PRx':
+                data = ','.join( '0,%.4E' % p for p in self.pressure )
+            elif self.mnemonic.startswith('PR'):
+                data = '0,%.4E' % self.pressure[ int(self.mnemonic[2:])-1 ]
+            else:
+                return '\x15\r\n'
+            return data+'\r\n\x15\r\n'
+
+        self.mnemonic = cmd
+        return '\x06\r\n'
+
+
+
+# CryoMagnetics LM-510 level meter. Every command is echoed back before the reply.
+# Liquid helium boils off at a constant rate, liquid nitrogen is kept full.
+class LM510Sim( SimulatedPort ):
+
+    term = '\n'
+
+    def __init__( self, **params ):
+        SimulatedPort.__init__( self, **params )
+        self.channel = '1'
+        self.fill_level = 140.
+        self.boiloff = 1.0 / 3600
+        self.fill_time = self.clock.time()
+
+
+    # Present liquid helium level in cm.
+    def Level( self ):
+        return max( 0, self.fill_level - self.boiloff*( self.clock.time()-self.fill_time ) )
+
+
+    def Respond( self, cmd ):
+        echo = cmd+'\r\n'
+        self.Count( cmd.split(' ')[0] )
+
+        if cmd.startswith('MEAS?'):
+            ch = cmd[5:].strip() or self.channel
+            lev = self.Level() if ch=='1' else 35.
+            return echo + '%.1f cm\r\n' % ( lev+random.gauss( 0, 0.05 ) )
+
+        elif cmd=='CHAN?':
+            return echo + self.channel+'\r\n'
+
+        elif cmd.startswith('CHAN '):
+            self.channel = cmd[5:]
+
+        elif cmd=='UNIT?':
+            return echo + 'cm\r\n'
+
+        return echo
+
+
+
+# Simulated instruments by name as used in the port name sim/<name>.
+Instruments = { 'lakeshore' : LakeShore372Sim,
+                'pfeiffer'  : TPG366Sim,
+                'cryomag'   : LM510Sim }
+
+
+# Open a simulated port. Called by SerialDevice for port names starting with sim/.
+def OpenSimulatedPort( name, **params ):
+    if name not in Instruments:
+        raise ValueError( 'Unknown simulated instrument %s. Available: %s' % ( name, ', '.join(Instruments) ) )
+    return Instruments[name]( **params )
@@ -0,0 +1,180 @@
+# Align readings of the LeidenLogger output files, which all have different and irregular time bases, on a common time grid.
+
+# Each temperature channel has its own time column (time16 for T16 and R16), pressures and liquid levels are
+# written at intervals or when they change. For every point of the grid, the value of each series is taken from
+#     previous   the last reading at or before the grid point (as-of join),
+#     nearest    the reading closest in time,
+#     linear     linear interpolation between the readings before and after.
+# If the reading(s) used are more than staleness seconds away from the grid point, the value is nan instead.
+# The lookup is done with numpy.searchsorted over whole arrays, so a week of readings is aligned in well under a second;
+# most of the time is spent reading the files (see LogReader.py).
+
+# The files are read with LogReader, so they may still be written by LeidenLogger, be merged by merge_log.py or be compressed.
+# Their times are converted to Unix time with the timestamp on their first line, so files of the same run with
+# slightly different start times are aligned correctly. The output has the format of the logger files, with
+# a timestamp line and times in seconds since that timestamp, so that it can be read again with LogReader.
+
+import sys
+import getopt
+import numpy
+
+from LogReader import LogReader
+
+
+Methods = ( 'previous', 'nearest', 'linear' )
+
+
+# Values of the series y(t) at the times grid. See above for method and staleness (None for no limit).
+def AsOf( t, y, grid, method='previous', staleness=None ):
+    if method not in Methods:
+        raise ValueError( 'unknown method %s' % method )
+
+    t = numpy.asarray( t, dtype=float )
+    y = numpy.asarray( y, dtype=float )
+    grid = numpy.asarray( grid, dtype=float )
+
+    keep = ~numpy.isnan( t )
+    t, y = t[keep], y[keep]
+    order = numpy.argsort( t, kind='stable' )
+    t, y = t[order], y[order]
+
+    result = numpy.full( len(grid), numpy.nan )
+    if len( t )==0:
+        return result
+
+    # Index of the last reading at or before each grid point, and of the first one after it.
+    i = numpy.searchsorted( t, grid, side='right' )-1
+    j = i+1
+    before = i>=0
+    after = j<len( t )
+    ic = numpy.clip( i, 0, len(t)-1 )
+    jc = numpy.clip( j, 0, len(t)-1 )
+    dprev = numpy.where( before, grid-t[ic], numpy.inf )
+    dnext = numpy.where( after, t[jc]-grid, numpy.inf )
+
+    if method=='previous':
+        value = y[ic]
+        distance = dprev
+    elif method=='nearest':
+        value = numpy.where( dprev<=dnext, y[ic], y[jc] )
+        distance = numpy.minimum( dprev, dnext )
+    else:
+        # A grid point coinciding with the last reading takes its value.
+        span = numpy.where( before & after, t[jc]-t[ic], 1. )
+        w = numpy.where( before & after, dprev/numpy.where( span>0, span, 1. ), 0. )
+        value = y[ic] + w*( y[jc]-y[ic] )
+        distance = numpy.where( dprev==0, 0., numpy.maximum( dprev, dnext ) )
+
+    valid = numpy.isfinite( distance )
+    if staleness!=None:
+        valid &= distance<=staleness
+    result[valid] = value[valid]
+    return result
+
+
+# Time column belonging to a column of a log file: time16 for T16 and R16 of temperature files, time otherwise.
+def TimeColumn( reader, name ):
+    if name[:1] in ('T','R') and 'time'+name[1:] in reader.columns:
+        return 'time'+name[1:]
+    return 'time'
+
+
+# Read the series given as (filename, column) between t0 and t1 seconds since the start of the earliest file (None for no limit).
+# Returns a list of (Unix times, values) and the start time of the earliest file.
+def Load( specs, t0=None, t1=None ):
+    readers = {}
+    for filename, column in specs:
+        if filename not in readers:
+            readers[ filename ] = LogReader( filename )
+            if readers[ filename ].start==None:
+                raise ValueError( '%s: no timestamp on the first line' % filename )
+
+    start = min( r.start for r in readers.values() )
+    series = []
+    for filename, column in specs:
+        r = readers[ filename ]
+        tc = TimeColumn( r, column )
+        data = r.Read( None if t0==None else start+t0-r.start, None if t1==None else start+t1-r.start, [ tc, column ] )
+        series.append( ( numpy.asarray( data[tc] )+r.start, numpy.asarray( data[column] ) ) )
+    return series, start
+
+
+# Align the series on a grid of step seconds between t0 and t1 (Unix times; by default the range of the readings).
+# Returns the grid and the list of aligned columns.
+def Align( series, step, t0=None, t1=None, method='previous', staleness=None ):
+    times = [ t for t, y in series if len(t)>0 ]
+    if t0==None:
+        t0 = min( t.min() for t in times ) if times else 0.
+    if t1==None:
+        t1 = max( t.max() for t in times ) if times else 0.
+    grid = numpy.arange( t0, t1+step/2, step )
+    return grid, [ AsOf( t, y, grid, method, staleness ) for t, y in series ]
+
+
+def main():
+    opts, args = getopt.getopt( sys.argv[1:], "ho:", ["output=","step=","start=","stop=","method=","staleness=","help"] )
+
+    output = None
+    step = 60.
+    start = stop = None
+    method = 'previous'
+    staleness = None
+
+    for opt, arg in opts:
+        if opt in ("-o","--output"):
+            output = arg
+        if opt=="--step":
+            step = float(arg)
+        if opt=="--start":
+            start = float(arg)
+        if opt=="--stop":
+            stop = float(arg)
+        if opt=="--method":
+            method = arg
+        if opt=="--staleness":
+            staleness = float(arg)
+        if opt in ("-h","--help"):
+            print("usage: "+sys.argv[0]+" [options] file:column file:column ...\n")
+            print("Align columns of LeidenLogger output files on a common time grid, e.g.")
+            print("\t"+sys.argv[0]+" --step 60 foo_temp.txt:T16 foo_pres.txt:IVC 'foo_liqlev.txt:LHe (cm)'\n")
+            print("options:\n")
+            print("\t--step T\t\t interval of the grid in seconds (default 60).")
+            print("\t--start T / --stop T\t range of the grid in seconds since the start of the earliest file (default: all readings).")
+            print("\t--method foo\t\t previous (default), nearest or linear.")
+            print("\t--staleness T\t\t nan where the readings used are more than T seconds from the grid point.")
+            print("\t-o/--output foo\t\t output file (default: standard output).\n")
+            print("\t-h/--help \t\t display help message.\n")
+            sys.exit()
+
+    if method not in Methods:
+        print('# TimeAlign: unknown method %s. Use one of %s.' % ( method, ', '.join(Methods) ))
+        sys.exit(1)
+    if not args or any( ':' not in a for a in args ):
+        print('# TimeAlign: specify the columns as file:column (see --help).')
+        sys.exit(1)
+
+    # Readings up to staleness (or one step) outside of the grid are needed for its first and last points.
+    specs = [ tuple( a.rsplit(':',1) ) for a in args ]
+    margin = staleness if staleness!=None else step
+    try:
+        series, t_start = Load( specs, None if start==None else start-margin, None if stop==None else stop+margin )
+    except ( OSError, ValueError, KeyError ) as e:
+        print('# TimeAlign:', e)
+        sys.exit(1)
+
+    t0 = None if start==None else t_start+start
+    t1 = None if stop==None else t_start+stop
+    grid, columns = Align( series, step, t0, t1, method, staleness )
+
+    file = open( output, 'w' ) if output else sys.stdout
+    print( '#', t_start, file=file )
+    print( '# time, '+', '.join( c for f,c in specs ), file=file )
+    print( '# Aligned with method %s, step %g s%s' % ( method, step, '' if staleness==None else ', staleness %g s' % staleness ), file=file )
+    for n, t in enumerate( grid ):
+        print( '%d' % round( t-t_start ) + ''.join( ', %e' % c[n] for c in columns ), file=file )
+    if output:
+        file.close()
+
+
+if __name__ == "__main__":
+    main()
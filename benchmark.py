@@ -0,0 +1,469 @@
+# Benchmark suite for the acquisition chain: SerialDevice, the three drivers and LeidenLogger.
+
+# The benchmarks drive the real code against the simulated instruments of SimulatedInstruments.py.
+# They report:
+#   1) samples per second for each device (driver level, wall clock),
+#   2) time of a full LakeShore scan for N channels,
+#   3) time from the last reply of a device to the corresponding row in the output file,
+#   4) jitter of the start of each reading with respect to --freq after the previous row,
+#   5) CPU time per sample and memory growth over a simulated multi-day run,
+#   6) cold start time of the entry points (LeidenLogger.py --help, LeidenSequencer.py --help, merge_log.py),
+#   7) rows written after a channel is added through --config in the middle of a run,
+#   8) rows written while the Pfeiffer fails from the first reading and the LHe level is invalid.
+# Benchmarks 2), 4), 5), 7) and 8) run LeidenLogger in virtual time, so that days of operation take seconds.
+
+# Results are written as JSON together with the git commit, so that runs on different commits can be compared:
+#     python benchmark.py -o before.json
+#     (apply change)
+#     python benchmark.py -o after.json --compare before.json
+
+import sys
+import os
+import io
+import json
+import time
+import getopt
+import datetime
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+import contextlib
+
+import SerialDevice
+import SimulatedInstruments
+import LeidenLogger
+import LakeShoreController as LakeShoreModule
+from SimulatedInstruments import VirtualClock, WallClock, SimulationFinished
+from LakeShoreController import LakeShoreController
+from PfeifferGauge       import PfeifferGauge
+from CryoMagLevelMeter   import CryoMagLevelMeter
+
+
+# Virtual clock that additionally probes the traced memory once per simulated hour.
+class BenchClock( VirtualClock ):
+
+    def __init__( self, start=None, stop=None, probe=False ):
+        VirtualClock.__init__( self, start, stop )
+        self.probe = probe
+        self.next_probe = self.now
+        self.memory = []
+
+    def sleep( self, t ):
+        VirtualClock.sleep( self, t )
+        if self.probe and self.now>=self.next_probe:
+            self.memory.append( ( self.now, tracemalloc.get_traced_memory()[0] ) )
+            self.next_probe += 3600
+
+
+# Virtual clock that calls action once, when the simulated time has advanced by at seconds.
+class ActionClock( VirtualClock ):
+
+    def __init__( self, at, action, stop=None ):
+        VirtualClock.__init__( self, None, stop )
+        self.at = self.now+at
+        self.action = action
+
+    def sleep( self, t ):
+        VirtualClock.sleep( self, t )
+        if self.action and self.now>=self.at:
+            self.action()
+            self.action = None
+
+
+# Run LeidenLogger, SerialDevice and the simulated instruments on the given clock.
+@contextlib.contextmanager
+def UseClock( clock ):
+    saved = ( LeidenLogger.time, LeidenLogger.Now, SerialDevice.time, LakeShoreModule.time, SimulatedInstruments.clock )
+
+    LeidenLogger.time = clock
+    LeidenLogger.Now = lambda : datetime.datetime.fromtimestamp( clock.time() )
+    SerialDevice.time = clock
+    LakeShoreModule.time = clock
+    SimulatedInstruments.clock = clock
+    try:
+        yield clock
+    finally:
+        LeidenLogger.time, LeidenLogger.Now, SerialDevice.time, LakeShoreModule.time, SimulatedInstruments.clock = saved
+
+
+# Output file wrapper that records the (virtual) time at which each row is completed
+# and the wall-clock delay since the last reply of the simulated instrument.
+# If duration is given, it returns the time taken by the reading of the row (the LakeShore scan), and the start of the
+# reading is recorded as well.
+class TimedFile( object ):
+
+    def __init__( self, f, clock, port, duration=None ):
+        self.file = f
+        self.name = f.name
+        self.clock = clock
+        self.port = port
+        self.duration = duration
+        self.rows = []
+        self.starts = []
+        self.latency = []
+
+    def write( self, s ):
+        n = self.file.write( s )
+        if s.endswith('\n'):
+            self.rows.append( self.clock.time() )
+            self.starts.append( self.clock.time()-( self.duration() if self.duration else 0. ) )
+            if self.port and self.port.last_reply:
+                self.latency.append( time.perf_counter()-self.port.last_reply )
+        return n
+
+    def flush( self ):
+        self.file.flush()
+
+    def close( self ):
+        self.file.close()
+
+
+# Create a LeidenLogger with simulated instruments writing into directory.
+def CreateLogger( directory, ports, channels, freq, options=[ '--no-server' ] ):
+    argv = [ 'LeidenLogger.py',
+             '--port', ports,
+             '--channel', ':'.join( str(c) for c in channels ),
+             '--freq', ':'.join( str(f) for f in freq ),
+             '--prefix', os.path.join( directory, 'bench' ) ] + options
+    with contextlib.redirect_stdout( io.StringIO() ):
+        return LeidenLogger.LeidenLogger( argv )
+
+
+# Simple statistics of a list of numbers.
+def Summary( values ):
+    if len(values)==0:
+        return {}
+    values = sorted( values )
+    n = len( values )
+    mean = sum( values )/n
+    return { 'n' : n,
+             'mean' : mean,
+             'std' : ( sum( (v-mean)**2 for v in values )/n )**0.5,
+             'p50' : values[ n//2 ],
+             'p99' : values[ min( n-1, int(0.99*n) ) ],
+             'max' : values[-1] }
+
+
+# 1) Samples per second of each driver in wall-clock time.
+# A sample is one channel (K and Ohm) for LakeShore, all six gauges for Pfeiffer, and both levels for CryoMagnetics.
+def BenchDevices( seconds ):
+
+    def Rate( func ):
+        n = 0
+        start = time.perf_counter()
+        while time.perf_counter()-start < seconds:
+            func()
+            n += 1
+        return n/( time.perf_counter()-start )
+
+    results = {}
+    with UseClock( WallClock() ), contextlib.redirect_stdout( io.StringIO() ) as out:
+        ls = LakeShoreController( 'sim/lakeshore', logs=[out] )
+        ls.SetChannel( 1 )
+        results['lakeshore'] = Rate( lambda : ls.ReadKelvinOhm('01') )
+        ls.close()
+
+        pf = PfeifferGauge( 'sim/pfeiffer', logs=[out] )
+        results['pfeiffer'] = Rate( pf.ReadPressure )
+        pf.close()
+
+        cm = CryoMagLevelMeter( 'sim/cryomag', logs=[out] )
+        results['cryomag'] = Rate( lambda : cm.GetLiquidLevels( (1,2) ) )
+        cm.close()
+
+    return results
+
+
+# 2) Duration of one full LakeShore scan for N channels, in simulated time and in CPU time.
+def BenchScan( directory, nchannels ):
+    results = {}
+    for n in nchannels:
+        with UseClock( VirtualClock() ) as clock:
+            ll = CreateLogger( directory, 'sim/lakeshore', range(1,n+1), [0,10,60] )
+            ll.starttime = LeidenLogger.TimeStamp()
+
+            start, cpu = clock.time(), time.process_time()
+            ll.UpdateTemperature()
+            results[ str(n) ] = { 'scan_s' : clock.time()-start, 'cpu_s' : time.process_time()-cpu }
+            ll.Close()
+    return results
+
+
+# 3) - 5) Run the whole logger in simulated time for the specified number of days.
+def BenchRun( directory, days, channels, freq, memory=False ):
+
+    with UseClock( BenchClock( probe=memory ) ) as clock:
+        clock.stop = clock.time() + days*86400
+
+        ll = CreateLogger( directory, 'sim/lakeshore:sim/pfeiffer:sim/cryomag', channels, freq )
+        controllers = [ ll.lscontroller, ll.pfcontroller, ll.cmcontroller ]
+
+        # The timing wrappers keep every row in memory, so they are left out of the memory run.
+        if not memory:
+            # A LakeShore scan is due --freq after the end of the previous one, so the jitter is that of its start.
+            files = [ TimedFile( ll.output[0], clock, controllers[0].connection, lambda : ll.ScanDuration ) ]
+            files += [ TimedFile( f, clock, c.connection ) for f,c in zip( ll.output[1:], controllers[1:] ) ]
+            ll.output = files
+
+        if memory:
+            tracemalloc.start()
+        cpu = time.process_time()
+        try:
+            with contextlib.redirect_stdout( io.StringIO() ):
+                ll.Execute()
+        except SimulationFinished:
+            pass
+        cpu = time.process_time()-cpu
+        if memory:
+            tracemalloc.stop()
+
+    if memory:
+        # Fit a straight line to the memory probes after the first simulated hour to get the growth rate.
+        probes = clock.memory[1:]
+        if len(probes)<2:
+            return { 'bytes_per_day' : None }
+        t0 = probes[0][0]
+        x = [ (t-t0)/86400 for t,m in probes ]
+        y = [ m for t,m in probes ]
+        mx, my = sum(x)/len(x), sum(y)/len(y)
+        slope = sum( (a-mx)*(b-my) for a,b in zip(x,y) ) / sum( (a-mx)**2 for a in x )
+        return { 'bytes_per_day' : slope, 'start_bytes' : y[0], 'end_bytes' : y[-1] }
+
+    samples = { 'lakeshore' : controllers[0].connection.counts.get( 'RDGK?', 0 ),
+                'pfeiffer'  : controllers[1].connection.counts.get( 'PRx', 0 ),
+                'cryomag'   : controllers[2].connection.counts.get( 'MEAS?', 0 ) }
+
+    names = [ 'lakeshore', 'pfeiffer', 'cryomag' ]
+    jitter = {}
+    latency = {}
+    for name, f, interval in zip( names, files, freq ):
+        jitter[name] = Summary( [ (b-a)-interval for a,b in zip( f.rows[:-1], f.starts[1:] ) ] )
+        latency[name] = Summary( f.latency )
+
+    return { 'simulated_days' : days,
+             'samples' : samples,
+             'cpu_s' : cpu,
+             'cpu_per_sample_s' : cpu/max( 1, sum( samples.values() ) ),
+             'jitter_s' : jitter,
+             'reading_to_file_s' : latency }
+
+
+# 6) Cold start of the entry points, each in a new interpreter: --help of LeidenLogger and LeidenSequencer, and
+# merge_log.py joining two short files. The start of a bare interpreter is given for reference; the difference
+# is the time spent importing modules, which grows whenever an entry point imports more than it needs.
+def BenchStartup( directory, repeat ):
+    here = os.path.dirname( os.path.abspath( __file__ ) )
+
+    files = []
+    for n in range(2):
+        name = os.path.join( directory, 'startup_%d_pres.txt' % n )
+        with open( name, 'w' ) as f:
+            print( '# %f' % ( 1.6e9+1000*n ), file=f )
+            print( '# time since start, condsr, still, dump, pot, IVC, custom', file=f )
+            for t in range( 100 ):
+                print( '%d, 1.000000e-01, 1.000000e-02, 5.000000e+02, 1.000000e+01, 1.000000e-06, 1.000000e-03' % t, file=f )
+        files.append( name )
+
+    commands = { 'interpreter' : [ '-c', 'pass' ],
+                 'logger_help' : [ os.path.join( here, 'LeidenLogger.py' ), '--help' ],
+                 'sequencer_help' : [ os.path.join( here, 'LeidenSequencer.py' ), '--help' ],
+                 'merge_log' : [ os.path.join( here, 'merge_log.py' ) ]+files }
+
+    results = {}
+    for name, args in commands.items():
+        times = []
+        for i in range( repeat ):
+            start = time.perf_counter()
+            subprocess.run( [ sys.executable ]+args, cwd=directory, stdout=subprocess.DEVNULL, check=True )
+            times.append( time.perf_counter()-start )
+        results[ name ] = { 'min_s' : min( times ), 'p50_s' : sorted( times )[ repeat//2 ] }
+    return results
+
+
+# 7) Add a LakeShore channel through --config after 10 simulated minutes of a one hour run, with the status file
+# enabled. The reload must not interrupt the acquisition: the temperatures continue in a new file with a column
+# for the new channel, and at least one complete scan must be written there.
+def BenchReload( directory ):
+    config = os.path.join( directory, 'reload.json' )
+    def Write( channels ):
+        with open( config, 'w' ) as f:
+            json.dump( { 'channel' : channels, 'freq' : [60, 10, 60] }, f )
+    Write( [1, 2] )
+
+    with UseClock( ActionClock( 600, lambda : Write( [1, 2, 5] ) ) ) as clock:
+        clock.stop = clock.time() + 3600
+        ll = CreateLogger( directory, 'sim/lakeshore', [1, 2], [60, 10, 60],
+                           [ '--config', config, '--server-file', os.path.join( directory, 'reload_status.txt' ) ] )
+        try:
+            with contextlib.redirect_stdout( io.StringIO() ):
+                ll.Execute()
+        except SimulationFinished:
+            pass
+
+    with open( ll.output[ ll.lsindex ].name ) as f:
+        rows = [ line for line in f if not line.startswith('#') ]
+    complete = [ row for row in rows if 'nan' not in row and len( row.split(',') )==9 ]
+    if len( ll.lschannels )!=3 or not complete:
+        raise RuntimeError( 'no temperatures of the channels %s were written after the reload' % ':'.join( ll.lschannels ) )
+    return { 'rows_after_reload' : len( rows ), 'complete_rows' : len( complete ) }
+
+
+# 8) Run all three devices for one simulated hour with the status file enabled, while every Pfeiffer reading fails
+# and the LHe level is always invalid. The failures must stay confined to their devices: the temperatures and the
+# LN2 level are still read, and the logger is still running at the end.
+def BenchFailure( directory ):
+    def FailPressure( self ):
+        raise IOError( 'simulated failure' )
+    def InvalidLevels( self, channels=(1,2) ):
+        return [ None, 50. ]
+
+    saved = PfeifferGauge.ReadPressure, CryoMagLevelMeter.GetLiquidLevels
+    PfeifferGauge.ReadPressure, CryoMagLevelMeter.GetLiquidLevels = FailPressure, InvalidLevels
+    try:
+        with UseClock( VirtualClock() ) as clock:
+            clock.stop = clock.time() + 3600
+            ll = CreateLogger( directory, 'sim/lakeshore:sim/pfeiffer:sim/cryomag', [1, 2], [60, 10, 60],
+                               [ '--server-file', os.path.join( directory, 'failure_status.txt' ) ] )
+            try:
+                with contextlib.redirect_stdout( io.StringIO() ):
+                    ll.Execute()
+            except SimulationFinished:
+                pass
+    finally:
+        PfeifferGauge.ReadPressure, CryoMagLevelMeter.GetLiquidLevels = saved
+
+    with open( ll.output[ ll.lsindex ].name ) as f:
+        rows = [ line for line in f if not line.startswith('#') ]
+    if not rows or ll.Watchdog[ ll.pfindex ].failures==0:
+        raise RuntimeError( 'the logger did not continue after the failure of the Pfeiffer' )
+    return { 'temperature_rows' : len( rows ), 'level_readings' : ll.Samples['liquid_level'],
+             'pfeiffer_failures' : ll.Watchdog[ ll.pfindex ].failures }
+
+
+# Flatten the nested result dictionary into 'a.b.c' keys.
+def Flatten( d, prefix='' ):
+    flat = {}
+    for k,v in d.items():
+        if isinstance( v, dict ):
+            flat.update( Flatten( v, prefix+k+'.' ) )
+        elif isinstance( v, (int,float) ) and not isinstance( v, bool ):
+            flat[ prefix+k ] = v
+    return flat
+
+
+# Print the relative change of every metric with respect to a previous result file.
+def Compare( base, result ):
+    old = Flatten( base['results'] )
+    new = Flatten( result['results'] )
+    print( '# Comparison with commit %s' % base.get('commit') )
+    print( '# %-50s %14s %14s %10s' % ( 'metric', 'base', 'new', 'ratio' ) )
+    for key in sorted( new ):
+        if key in old:
+            ratio = new[key]/old[key] if old[key] else float('nan')
+            print( '  %-50s %14.6g %14.6g %10.3f' % ( key, old[key], new[key], ratio ) )
+
+
+# Commit of the working tree, so that results can be attributed.
+def GitCommit():
+    try:
+        return subprocess.check_output( ['git','rev-parse','HEAD'], cwd=os.path.dirname( os.path.abspath(__file__) ), stderr=subprocess.DEVNULL ).decode().strip()
+    except Exception:
+        return None
+
+
+def Usage():
+    print( "usage: "+sys.argv[0]+" [options]\n" )
+    print( "options:\n" )
+    print( "\t-o/--output foo.json\t write the results to foo.json (default benchmark.json)." )
+    print( "\t--compare foo.json\t print the change of each metric relative to an earlier result file." )
+    print( "\t--days D\t\t simulated days for the logger run (default 1)." )
+    print( "\t--channel L1:L2:L3\t LakeShore channels enabled in the logger run (default 1:2:...:12)." )
+    print( "\t--freq t1:t2:t3\t\t logger sampling intervals in seconds (default 60:10:60)." )
+    print( "\t--scan N1:N2:...\t numbers of channels for the LakeShore scan benchmark (default 1:4:8:16)." )
+    print( "\t--seconds T\t\t duration of each device throughput benchmark (default 2)." )
+    print( "\t--startup N\t\t number of cold starts of each entry point (default 10, 0 to skip)." )
+    print( "\t--startup-only\t\t run only the cold start benchmark." )
+    print( "\t-h/--help \t\t display help message.\n" )
+
+
+def main():
+    opts, _ = getopt.getopt( sys.argv[1:], "ho:", ["output=","compare=","days=","channel=","freq=","scan=","seconds=","startup=","startup-only","help"] )
+
+    output = 'benchmark.json'
+    compare = None
+    days = 1.
+    channels = list( range(1,13) )
+    freq = [60, 10, 60]
+    nchannels = [1, 4, 8, 16]
+    seconds = 2.
+    startup = 10
+    only = False
+
+    for opt, arg in opts:
+        if opt in ("-o","--output"):
+            output = arg
+        if opt=="--compare":
+            compare = arg
+        if opt=="--days":
+            days = float(arg)
+        if opt=="--channel":
+            channels = arg.split(':')
+        if opt=="--freq":
+            freq = [ float(f) for f in arg.split(':') ]
+        if opt=="--scan":
+            nchannels = [ int(n) for n in arg.split(':') ]
+        if opt=="--seconds":
+            seconds = float(arg)
+        if opt=="--startup":
+            startup = int(arg)
+        if opt=="--startup-only":
+            only = True
+        if opt in ("-h","--help"):
+            Usage()
+            sys.exit()
+
+    result = { 'commit' : GitCommit(),
+               'date' : datetime.datetime.now().isoformat(),
+               'python' : platform.python_version(),
+               'platform' : platform.platform(),
+               'results' : {} }
+
+    with tempfile.TemporaryDirectory() as directory:
+        if startup>0:
+            print( '# Benchmarking cold start...' )
+            result['results']['startup'] = BenchStartup( directory, startup )
+        
+        if not only:
+            print( '# Benchmarking device throughput...' )
+            result['results']['samples_per_second'] = BenchDevices( seconds )
+
+            print( '# Benchmarking LakeShore scan time...' )
+            result['results']['scan'] = BenchScan( directory, nchannels )
+
+            print( '# Running logger for %g simulated days...' % days )
+            result['results']['run'] = BenchRun( directory, days, channels, freq )
+
+            print( '# Reloading the channels through --config...' )
+            result['results']['reload'] = BenchReload( directory )
+
+            print( '# Running logger with failing devices...' )
+            result['results']['failure'] = BenchFailure( directory )
+
+            print( '# Measuring memory growth over %g simulated days...' % days )
+            result['results']['memory'] = BenchRun( directory, days, channels, freq, memory=True )
+
+    with open( output, 'w' ) as f:
+        json.dump( result, f, indent=2 )
+    print( '# Results written to', output )
+
+    for key, value in sorted( Flatten( result['results'] ).items() ):
+        print( '  %-50s %.6g' % ( key, value ) )
+
+    if compare:
+        with open( compare ) as f:
+            Compare( json.load(f), result )
+
+
+if __name__ == "__main__":
+    main()
@@ -15,15 +15,19 @@
 #    this script can be used for all of pressure, temperature and liquid level outputs.
 
 # Note: this file cannot process files of different variables at the same time (e.g. pressure and temperature).
+# The segments of a rotated output file (see --segment-size of LeidenLogger) all have the timestamp of the start of the run.
+# They are merged in the order of their names, which contain the date and time they were started, and copied without offset.
+# Compressed files (.gz, .zst, see Archive.py) are decompressed while they are read.
 
 import sys
-import pandas as pd
+
+import Archive
 
 # Function to get the time stamp from the input file.
 # The format of the file should always be that the beginning is # + timestamp
 
 def GetTimeStampFromFile( filename ):
-    with open( filename, 'r') as f:
+    with Archive.Open( filename, 'rt') as f:
         for n,l in enumerate(f):
             if n==0:
                 return float(l.replace('#',''))
@@ -45,11 +49,9 @@ files = sys.argv[1:]
 # Timestamps of each file specified by the commandline.
 timestamps = [GetTimeStampFromFile(i) for i in sys.argv[1:]]
 
-# Dictionary structure that uses the timestamp as key and filename as value.
-# It's easier to go through in chronological order in this way
-dict_timestamp = {}
-for f in files:
-    dict_timestamp[ str(GetTimeStampFromFile(f)) ] = f
+# Pairs of timestamp and filename, sorted in chronological order.
+# Segments of the same run have the same timestamp and are sorted by name.
+runs = sorted( zip( timestamps, files ) )
 
     
 global_timestamp = 0
@@ -58,23 +60,30 @@ global_timestamp = 0
 with open( 'merge.txt', 'w') as Output:
     
     # Iterate over all files.
-    for n,timestamp in enumerate( sorted(dict_timestamp.keys()) ):
+    for n,(timestamp,filename) in enumerate( runs ):
         
         # Get the time offset from the difference of timestamps
-        offset = float(timestamp) - global_timestamp
+        offset = timestamp - global_timestamp
         
-        print('Processing '+dict_timestamp[timestamp] +' timestamp: ' + timestamp + ' offset: %d' % offset)
+        print('Processing '+filename +' timestamp: ' + str(timestamp) + ' offset: %d' % offset)
             
         # If the file is first in chronological order, then keep its content.
         if n==0:
-            with open( dict_timestamp[timestamp],'r') as Input:
+            with Archive.Open( filename,'rt') as Input:
                 Output.write( Input.read() )
-                global_timestamp = float(timestamp)
+                global_timestamp = timestamp
                 Input.close()
+        
+        # A later segment of the first run: copy the rows as they are.
+        elif offset==0:
+            with Archive.Open( filename,'rt') as Input:
+                for l in Input:
+                    if len(l) >= 2 and l.find('#') < 0:
+                        Output.write( l )
             
-        # If not, then read the file into a pandas data structure and dump the output with time offset.
+        # If not, then read the file line by line and dump the output with time offset.
         else:
-            with open( dict_timestamp[timestamp],'r') as Input:
+            with Archive.Open( filename,'rt') as Input:
                 
                 for l in Input.readlines():
                     
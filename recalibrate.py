@@ -0,0 +1,253 @@
+# Recompute the temperatures of LeidenLogger temperature files (_temp.txt) from the recorded resistances
+# with new calibration curves, e.g. after the calibration of a thermometer has been corrected.
+
+# The temperature file holds a triplet time, T, R per channel on each row. For each channel with a new curve,
+# the T column is replaced by the temperature interpolated from the R column (see CalibrationCurve.py).
+# Comment lines are copied unchanged, and so are rows that cannot be parsed.
+# The output is either a text file of the same format, or a binary column store: a directory with one file
+# of float64 values per column (time1, T1, R1, time2, ...) and columns.json describing them, which can be
+# loaded e.g. with numpy.fromfile or numpy.memmap.
+
+# The input is memory-mapped and cut into chunks at line boundaries, which are converted in parallel by
+# several processes and written in order. Files produced by merge_log.py may contain several headers with
+# different channels; chunks never cross a header, so each chunk is converted with the channels of its header.
+# Compressed segments (.gz, .zst, see Archive.py) cannot be mapped; they are decompressed into memory instead,
+# and the chunks are passed to the processes with the tasks.
+
+import os
+import sys
+import json
+import mmap
+import getopt
+import multiprocessing
+from array import array
+
+import CalibrationCurve
+
+
+# Channels of a header line "#, time, T1, R1, time, T16, R16, " as a list of strings, or None for other lines.
+def ParseHeader( line ):
+    fields = [ f.strip() for f in line.lstrip('#').split(',') ]
+    fields = [ f for f in fields if f!='' ]
+    if len( fields )<3 or len( fields )%3!=0 or fields[0]!='time':
+        return None
+    channels = [ f[1:] for f in fields[1::3] ]
+    if fields[0::3]!=['time']*len( channels ) or fields[2::3]!=[ 'R'+c for c in channels ]:
+        return None
+    return channels
+
+
+# Cut the mapped file into segments starting at each header, and the segments into chunks of about chunksize bytes
+# ending at a newline. Returns a list of ( start, end, channels ).
+def MakeChunks( mm, chunksize ):
+    size = len( mm )
+
+    # Start of every header line and its channels.
+    headers = []
+    pos = 0
+    while pos<size:
+        end = mm.find( b'\n', pos )
+        end = size if end<0 else end+1
+        if mm[pos:pos+1]==b'#':
+            channels = ParseHeader( mm[pos:end].decode( errors='replace' ) )
+            if channels!=None:
+                headers.append( ( pos, channels ) )
+            pos = end
+        else:
+            # Skip the data rows up to the next comment line.
+            nxt = mm.find( b'\n#', pos )
+            pos = size if nxt<0 else nxt+1
+
+    chunks = []
+    bounds = [ h[0] for h in headers ] + [ size ]
+    if not headers or headers[0][0]>0:
+        bounds.insert( 0, 0 )
+        headers.insert( 0, ( 0, None ) )
+
+    for ( start, channels ), stop in zip( headers, bounds[1:] ):
+        while start<stop:
+            end = mm.find( b'\n', min( start+chunksize, stop )-1, stop )
+            end = stop if end<0 else end+1
+            chunks.append( ( start, end, channels ) )
+            start = end
+    return chunks
+
+
+# Convert the rows of one chunk. This runs in the worker processes.
+# The chunk is given by the name of the file and its position in the file, or as bytes (from a compressed file).
+# Returns the converted text (as bytes), or for the column store, the rows of every column as float64 bytes.
+def ConvertChunk( task ):
+    source, start, end, channels, curves, binary = task
+
+    if isinstance( source, bytes ):
+        lines = source.decode( errors='replace' ).splitlines( True )
+    else:
+        with open( source, 'rb' ) as f:
+            with mmap.mmap( f.fileno(), 0, access=mmap.ACCESS_READ ) as mm:
+                lines = mm[start:end].decode( errors='replace' ).splitlines( True )
+
+    # Rows that can be converted, as lists of fields.
+    rows = []
+    for n, line in enumerate( lines ):
+        if channels==None or line.startswith('#'):
+            continue
+        fields = [ f.strip() for f in line.split(',') ]
+        if len( fields )==3*len( channels ):
+            rows.append( ( n, fields ) )
+
+    # Interpolate each channel with a new curve at once.
+    for k, ch in enumerate( channels or [] ):
+        if ch not in curves:
+            continue
+        ohms = []
+        for n, fields in rows:
+            try:
+                ohms.append( float( fields[3*k+2] ) )
+            except ValueError:
+                ohms.append( float('nan') )
+        for ( n, fields ), T in zip( rows, curves[ch].KelvinArray( ohms ) ):
+            fields[3*k+1] = '%e' % T
+
+    if binary:
+        columns = [ array('d') for i in range( 3*len( channels or [] ) ) ]
+        for n, fields in rows:
+            for c, value in zip( columns, fields ):
+                try:
+                    c.append( float( value ) )
+                except ValueError:
+                    c.append( float('nan') )
+        return [ c.tobytes() for c in columns ]
+
+    for n, fields in rows:
+        lines[n] = ', '.join( fields )+'\n'
+    return ''.join( lines ).encode()
+
+
+# Convert filename into output (a text file, or the directory of the column store if binary is set).
+def Recalibrate( filename, output, curves, binary=False, jobs=None, chunksize=16<<20 ):
+    import Archive
+
+    # An empty file cannot be mapped, and has nothing to convert.
+    data = None
+    if Archive.Compressed( filename ):
+        try:
+            with Archive.Open( filename ) as f:
+                data = f.read()
+        except ( OSError, ImportError, EOFError ) as e:
+            print( '# %s: cannot read the compressed file: %s' % ( filename, e ) )
+            return False
+        chunks = MakeChunks( data, chunksize ) if data else []
+    elif os.path.getsize( filename )>0:
+        with open( filename, 'rb' ) as f:
+            with mmap.mmap( f.fileno(), 0, access=mmap.ACCESS_READ ) as mm:
+                chunks = MakeChunks( mm, chunksize )
+    else:
+        chunks = []
+
+    if not chunks:
+        print( '# %s: the file is empty.' % filename )
+        return False
+
+    segments = set( tuple(c[2]) for c in chunks if c[2]!=None )
+    if not segments:
+        print( '# %s: no header with the channels found.' % filename )
+        return False
+    for ch in curves:
+        if not any( ch in s for s in segments ):
+            print( '# %s: warning: channel %s is not recorded in this file.' % ( filename, ch ) )
+
+    if binary:
+        if len( segments )>1:
+            print( '# %s: the channels change within the file. Split it before writing a column store.' % filename )
+            return False
+        channels = list( segments.pop() )
+        names = sum( [ [ 'time'+c, 'T'+c, 'R'+c ] for c in channels ], [] )
+        os.makedirs( output, exist_ok=True )
+        files = [ open( os.path.join( output, name+'.f64' ), 'wb' ) for name in names ]
+    else:
+        files = [ open( output, 'wb' ) ]
+
+    if data!=None:
+        tasks = [ ( data[start:end], 0, end-start, channels, curves, binary ) for start, end, channels in chunks ]
+    else:
+        tasks = [ ( filename, start, end, channels, curves, binary ) for start, end, channels in chunks ]
+    rows = 0
+    try:
+        with multiprocessing.Pool( jobs ) as pool:
+            for result in pool.imap( ConvertChunk, tasks ):
+                if binary:
+                    for f, data in zip( files, result ):
+                        f.write( data )
+                    rows += len( result[0] )//8 if result else 0
+                else:
+                    files[0].write( result )
+    finally:
+        for f in files:
+            f.close()
+
+    if binary:
+        manifest = { 'source' : os.path.abspath( filename ), 'columns' : names, 'rows' : rows,
+                     'dtype' : 'float64', 'byteorder' : sys.byteorder,
+                     'curves' : { ch : '%s %s' % ( c.name, c.serial ) for ch, c in curves.items() } }
+        with open( os.path.join( output, 'columns.json' ), 'w' ) as f:
+            json.dump( manifest, f, indent=1 )
+
+    print( '# %s -> %s' % ( filename, output ) )
+    return True
+
+
+def main():
+    opts, files = getopt.getopt( sys.argv[1:], "ho:j:", ["curve=","output=","binary","jobs=","help"] )
+
+    curves = {}
+    output = None
+    binary = False
+    jobs = None
+
+    for opt, arg in opts:
+        if opt=="--curve":
+            ch, filename = arg.split('=',1)
+            curves[ '%d' % int(ch) ] = CalibrationCurve.Read340( filename )
+        if opt in ("-o","--output"):
+            output = arg
+        if opt=="--binary":
+            binary = True
+        if opt in ("-j","--jobs"):
+            jobs = int(arg)
+        if opt in ("-h","--help"):
+            print("usage: "+sys.argv[0]+" [options] foo_temp.txt ...\n")
+            print("The input files may be compressed segments (foo_temp.txt.gz or .zst, see Archive.py).\n")
+            print("options:\n")
+            print("\t--curve ch=foo.340\t recompute the temperature of channel ch with the curve in foo.340. Repeat for several channels.")
+            print("\t-o/--output foo\t\t output file (only with a single input). By default, foo_temp.txt is written to foo_temp_recal.txt.")
+            print("\t--binary\t\t write a column store (directory foo_temp_recal with one float64 file per column) instead of text.")
+            print("\t-j/--jobs N\t\t number of processes (default: number of cores).\n")
+            print("\t-h/--help \t\t display help message.\n")
+            sys.exit()
+
+    if not curves or not files:
+        print( '# recalibrate: specify at least one --curve and one input file (see --help).' )
+        sys.exit(1)
+    if output!=None and len( files )>1:
+        print( '# recalibrate: --output can only be used with a single input file.' )
+        sys.exit(1)
+
+    ok = True
+    for filename in files:
+        name = output
+        if name==None:
+            # foo_temp.txt.gz is written to foo_temp_recal.txt as well.
+            import Archive
+            base = filename
+            for ext in Archive.Extensions:
+                if base.endswith( ext ):
+                    base = base[:-len(ext)]
+            name = os.path.splitext( base )[0]+'_recal'+( '' if binary else '.txt' )
+        ok = Recalibrate( filename, name, curves, binary, jobs ) and ok
+
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()